@@ -1,8 +1,16 @@
-from flask import Flask, session, send_from_directory
+from flask import Flask, session, send_from_directory, request, abort
 import os
+import posixpath
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, WatchedFileHandler
+import database
 from database import init_db, close_db
+from jobs import requeue_pending
+from sweeper import start_sweeper
+from reassign import resume_reassignments
+from reaper import resume_deletions
+import metrics
+import profiler
 from routes.auth import auth_bp
 from routes.main import main_bp
 from routes.admin import admin_bp
@@ -10,20 +18,63 @@ from routes.notes import notes_bp
 from routes.upload import upload_bp
 
 
-def create_app():
+# Held open by the process that runs the once-per-deployment background tasks
+_task_lock = None
+
+
+def create_app(prefork=False, background_tasks=True):
+    """
+    Create the app. With prefork=True (see wsgi.py) the app is built once in a
+    pre-fork server's master process: the log file is shared by the workers,
+    no connections stay open across the fork and the background tasks are
+    left to init_worker, which the server calls in each worker.
+    background_tasks=False only opens (and migrates) the database, for
+    one-off maintenance commands.
+    """
     app = Flask(__name__)
     app.secret_key = "your-secret-key-change-in-production"
     app.config["UPLOAD_FOLDER"] = "static/uploads"
     app.config["UPLOAD_TEMP_FOLDER"] = os.path.join(app.config["UPLOAD_FOLDER"], "temp")
     app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50MB max request size
+    # Write chunks carrying a byte offset straight into a preallocated file
+    app.config["UPLOAD_DIRECT_WRITE"] = True
+    # Largest file accepted through chunked uploads
+    app.config["UPLOAD_MAX_FILE_SIZE"] = 200 * 1024 * 1024
+    # Background image processing processes; None = one per CPU, 0 = process inline.
+    # Each worker of a pre-fork server has its own pool (see gunicorn.conf.py).
+    image_workers = os.environ.get("CAIYUAN_IMAGE_WORKERS")
+    app.config["IMAGE_WORKERS"] = int(image_workers) if image_workers else None
+    # Upload garbage collection: seconds between passes (0 = off), age after which
+    # unattached uploads are removed, and upload directories visited per pass
+    app.config["UPLOAD_GC_INTERVAL"] = 600
+    app.config["UPLOAD_GC_MAX_AGE"] = 24 * 3600
+    app.config["UPLOAD_GC_DIRS"] = 16
+    # Images are served by /api/images/<id>/<name>; set to an nginx internal location
+    # (e.g. "/protected-uploads/" aliased to UPLOAD_FOLDER) to hand files to the proxy.
+    # USE_X_SENDFILE = True does the same for Apache/lighttpd.
+    app.config["IMAGE_ACCEL_REDIRECT"] = None
+    # Lets Prometheus scrape /api/admin/metrics with "Authorization: Bearer <token>"
+    # (None = admin session only)
+    app.config["METRICS_TOKEN"] = os.environ.get("CAIYUAN_METRICS_TOKEN")
+    # Directory where each worker process writes its metrics, so a scrape reports
+    # the sum over all workers (None = this process only)
+    app.config["METRICS_DIR"] = os.environ.get("CAIYUAN_METRICS_DIR") or ("metrics" if prefork else None)
+    # Log statements slower than this many milliseconds with their query plan (None = off)
+    app.config["SLOW_QUERY_MS"] = float(os.environ.get("CAIYUAN_SLOW_QUERY_MS", 0)) or None
+    # Admins sending this request header get a summary of the request's SQL back in it
+    app.config["SQL_PROFILE_HEADER"] = "X-SQL-Profile"
 
     # Configure logging
     if not os.path.exists("logs"):
         os.makedirs("logs", exist_ok=True)
 
-    file_handler = RotatingFileHandler(
-        "logs/caiyuan.log", maxBytes=102400, backupCount=10
-    )
+    if prefork:
+        # Workers cannot coordinate rotation; reopen the file once logrotate moves it
+        file_handler = WatchedFileHandler("logs/caiyuan.log")
+    else:
+        file_handler = RotatingFileHandler(
+            "logs/caiyuan.log", maxBytes=102400, backupCount=10
+        )
     file_handler.setFormatter(
         logging.Formatter(
             "%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]"
@@ -48,12 +99,29 @@ def create_app():
     # Register teardown
     app.teardown_appcontext(close_db)
 
+    # Request latency and SQL metrics, served at /api/admin/metrics
+    metrics.init_app(app)
+    profiler.init_app(app)
+
+    # Uploads are only reachable through the scoped image route, not as static files
+    @app.before_request
+    def block_static_uploads():
+        if request.endpoint == "static":
+            path = posixpath.normpath(request.view_args["filename"]).lstrip("/")
+            if path.split("/", 1)[0] == "uploads":
+                abort(404)
+
     # Context processor to make session available to all templates (though it usually is)
     @app.context_processor
     def inject_user():
         return dict(session=session)
 
     init_db(app)
+    if prefork:
+        # Workers must not share SQLite connections opened before the fork
+        database.pool.close_all()
+    elif background_tasks:
+        init_worker(app)
 
     @app.route("/favicon.ico")
     def favicon():
@@ -68,6 +136,47 @@ def create_app():
     return app
 
 
+def hold_task_lock():
+    """
+    Whether this process runs the background tasks that must run once per
+    deployment. The first process to take an exclusive lock next to the
+    database keeps it until it exits; a worker started after that takes over.
+    """
+    global _task_lock
+    if _task_lock is not None:
+        return True
+    try:
+        import fcntl
+    except ImportError:
+        return True  # No pre-fork servers without fcntl; single process
+    lock_file = open(database.DATABASE + ".tasks.lock", "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _task_lock = lock_file
+    return True
+
+
+def init_worker(app):
+    """
+    Start the background work of a serving process: resume interrupted image
+    processing, team reassignments and deletions, and run the upload sweeper.
+    One process of a deployment does this (see hold_task_lock); image pools,
+    connection pools and the deletion reaper are set up per process on first use.
+    """
+    # A checked connection per worker before the first request
+    database.release_db(database.acquire_db())
+    if not hold_task_lock():
+        return
+    app.logger.info(f"Process {os.getpid()} runs the background tasks")
+    requeue_pending(app)
+    start_sweeper(app)
+    resume_reassignments(app)
+    resume_deletions(app)
+
+
 if __name__ == "__main__":
     app = create_app()
     app.run(debug=False, host="0.0.0.0", port=5000)
@@ -0,0 +1,186 @@
+"""
+Synthetic data generator for the benchmarks.
+
+Creates a notes.db through the real init_db schema (create_app in the target
+directory) and fills it with projects, teams, users, groups, notes and image
+rows. Every image row gets its own small JPEG and thumbnail in the content
+store, so routes that touch files see real ones. The same seed always
+produces the same data.
+
+Usage: python bench/generate.py WORKDIR [--notes N] [--users N] ...
+"""
+from PIL import Image
+from datetime import date, timedelta
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import sqlite3
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+# Every generated user (including those of the benchmark runs) logs in with this password
+PASSWORD = 'bench-password'
+
+DEFAULTS = {
+    'projects': 3,
+    'teams': 5,
+    'users': 50,
+    # Share of users without a team, whose data is private to them
+    'teamless_share': 0.2,
+    'groups': 8,  # per team (or team-less user) and project
+    'notes': 5000,
+    'images_per_note': 2,
+    'image_size': 64,
+    'days': 365,
+    'seed': 1,
+}
+
+WORDS = ['番茄', '黄瓜', '辣椒', '茄子', '白菜', '浇水', '施肥', '发芽', '开花', '结果', '病虫害', '修剪',
+         '温度', '湿度', '日照', 'tomato', 'seedling', 'compost', 'harvest', 'greenhouse']
+
+INSERT_BATCH_SIZE = 1000
+
+
+def note_content(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 40)))
+
+
+def write_image(upload_folder, rng, size):
+    """Write a unique small JPEG and its thumbnail into the content store; returns (filename, content_hash)"""
+    img = Image.new('RGB', (size, size), tuple(rng.randrange(256) for _ in range(3)))
+    img.putpixel((0, 0), tuple(rng.randrange(256) for _ in range(3)))
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG')
+    data = buf.getvalue()
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    directory = os.path.join(upload_folder, 'cas', content_hash[:2])
+    os.makedirs(directory, exist_ok=True)
+    for name in (f'{content_hash}.jpg', f'thumb_{content_hash}.jpg'):
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+    return f'cas/{content_hash[:2]}/{content_hash}.jpg', content_hash
+
+
+def insert_rows(conn, sql, rows):
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        conn.executemany(sql, rows[start:start + INSERT_BATCH_SIZE])
+
+
+def generate(workdir, **options):
+    """
+    Build the benchmark dataset in workdir (which must not contain a notes.db
+    yet). Returns a summary dict with the options and the row counts.
+    """
+    options = {**DEFAULTS, **options}
+    rng = random.Random(options['seed'])
+    os.makedirs(workdir, exist_ok=True)
+    if os.path.exists(os.path.join(workdir, 'notes.db')):
+        raise SystemExit(f'{workdir} already contains a notes.db')
+    os.chdir(workdir)
+
+    from app import create_app
+    from werkzeug.security import generate_password_hash
+    app = create_app(background_tasks=False)
+    upload_folder = app.config['UPLOAD_FOLDER']
+
+    conn = sqlite3.connect('notes.db')
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+
+    with conn:
+        # init_db seeded the default project; the others follow it
+        insert_rows(conn, 'INSERT INTO projects (name) VALUES (?)',
+                    [(f'bench-project-{i}',) for i in range(1, options['projects'])])
+        project_ids = [row[0] for row in conn.execute('SELECT id FROM projects ORDER BY id')]
+
+        insert_rows(conn, 'INSERT INTO user_teams (name) VALUES (?)',
+                    [(f'bench-team-{i}',) for i in range(options['teams'])])
+        team_ids = [row[0] for row in conn.execute('SELECT id FROM user_teams ORDER BY id')]
+
+        # One hash for everyone: hashing is deliberately slow
+        password_hash = generate_password_hash(PASSWORD)
+        users = []
+        for i in range(options['users']):
+            team_id = None if not team_ids or rng.random() < options['teamless_share'] else team_ids[i % len(team_ids)]
+            users.append((f'bench-user-{i}', password_hash, team_id, project_ids[0]))
+        insert_rows(conn, '''
+            INSERT INTO users (username, password_hash, role, status, team_id, current_project_id)
+            VALUES (?, ?, 'user', 'approved', ?, ?)
+        ''', users)
+        user_rows = conn.execute("SELECT id, team_id FROM users WHERE username LIKE 'bench-user-%' ORDER BY id").fetchall()
+
+        # Teams share their groups; team-less users have their own
+        members = {}
+        for user_id, team_id in user_rows:
+            members.setdefault(('team', team_id) if team_id else ('user', user_id), []).append(user_id)
+        groups = []
+        for (kind, owner), owner_members in members.items():
+            for project_id in project_ids:
+                for i in range(options['groups']):
+                    groups.append((f'bench-group-{i}', owner if kind == 'team' else None, project_id, owner_members[0]))
+        insert_rows(conn, 'INSERT INTO groups (name, team_id, project_id, user_id) VALUES (?, ?, ?, ?)', groups)
+        group_rows = conn.execute('SELECT id, team_id, project_id, user_id FROM groups ORDER BY id').fetchall()
+        scope_members = {(team_id, project_id): members[('team', team_id)] for _, team_id, project_id, _ in group_rows if team_id}
+
+    first_day = date.today() - timedelta(days=options['days'])
+    notes_done = images_done = 0
+    while notes_done < options['notes']:
+        batch = min(INSERT_BATCH_SIZE, options['notes'] - notes_done)
+        with conn:
+            for _ in range(batch):
+                group_id, team_id, project_id, owner_id = rng.choice(group_rows)
+                user_id = rng.choice(scope_members[(team_id, project_id)]) if team_id else owner_id
+                note_date = (first_day + timedelta(days=rng.randrange(options['days']))).isoformat()
+                cursor = conn.execute('''
+                    INSERT INTO notes (content, date, group_id, user_id, team_id, project_id)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (note_content(rng), note_date, group_id, user_id, team_id, project_id))
+                note_id = cursor.lastrowid
+
+                images = []
+                for index in range(options['images_per_note']):
+                    filename, content_hash = write_image(upload_folder, rng, options['image_size'])
+                    images.append((filename, f'photo_{index}.jpg', note_id, note_date, group_id, user_id, team_id,
+                                   project_id, content_hash))
+                conn.executemany('''
+                    INSERT INTO images (filename, original_filename, note_id, date, group_id, user_id, team_id,
+                                        project_id, status, content_hash)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'ready', ?)
+                ''', images)
+                images_done += len(images)
+        notes_done += batch
+
+    conn.close()
+
+    return {
+        'options': options,
+        'rows': {
+            'projects': len(project_ids), 'teams': len(team_ids), 'users': len(user_rows),
+            'groups': len(group_rows), 'notes': notes_done, 'images': images_done,
+        },
+    }
+
+
+def add_arguments(parser):
+    """Dataset options shared with bench/run.py"""
+    for name, default in DEFAULTS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(default), default=default)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill a new notes.db with synthetic benchmark data.')
+    parser.add_argument('workdir', help='directory for notes.db and static/uploads')
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+    workdir = os.path.abspath(args.pop('workdir'))
+    print(json.dumps(generate(workdir, **args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""
+Concurrent load scenarios against a running server.
+
+Logs in N simulated users (the bench-user-* accounts of bench/generate.py)
+through /login and lets each run a weighted mix of actions until the level's
+duration is up:
+
+    browse  - groups, a page of notes and one note
+    switch  - list the projects and switch through /api/projects/switch
+    upload  - a photo sent in chunks to /api/upload/chunk, merged with
+              /api/upload/merge and attached to a new note (queues processing)
+
+Every level of --users is run in turn, so contention shows up as concurrency
+grows. Each level reports throughput, error rate, per-action latency and the
+"database is locked" failures the server counted during the level (read
+from /api/admin/metrics as admin). Under the pre-fork server that count is
+the total over all workers, which write their metrics every few seconds, so
+the final scrape waits METRICS_SETTLE_SECONDS; a single-process server
+reports its own count.
+
+Each simulated user is a coroutine; its blocking HTTP calls run on a thread
+pool sized to the number of users, over one keep-alive connection per user.
+
+Usage:
+    python bench/generate.py /tmp/caiyuan-data && cd /tmp/caiyuan-data && python /path/to/app.py
+    python bench/load.py --url http://127.0.0.1:5000 --users 1,4,16,64 --duration 30 [--output FILE]
+"""
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from urllib.parse import urlencode, urlsplit
+import argparse
+import asyncio
+import http.client
+import io
+import json
+import math
+import os
+import random
+import re
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import generate
+
+ACTIONS = ('browse', 'switch', 'upload')
+DEFAULT_MIX = 'browse=6,switch=1,upload=2'
+CHUNK_SIZE = 256 * 1024
+PERCENTILES = (50, 95, 99)
+# Longer than the workers' interval between metrics writes (metrics.FLUSH_INTERVAL)
+METRICS_SETTLE_SECONDS = 3
+LOCKED_METRIC = re.compile(r'^caiyuan_sql_errors_total\{error="locked"\} (\S+)$', re.MULTILINE)
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class Session:
+    """One simulated user: a keep-alive connection plus its cookies"""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(parts.hostname, parts.port, timeout=timeout)
+        self.cookies = {}
+        self.samples = []  # (action, seconds, ok)
+        self.group_ids = []
+
+    def request(self, method, path, body=None, headers=None, expect=(200,)):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in self.cookies.items())
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.connection.close()
+            raise RequestFailed(f'{method} {path}: {e}')
+        for cookie in response.headers.get_all('Set-Cookie') or []:
+            name, _, value = cookie.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value
+        if response.status not in expect:
+            raise RequestFailed(f'{method} {path}: HTTP {response.status}')
+        return data
+
+    def get_json(self, path):
+        return json.loads(self.request('GET', path))
+
+    def post_form(self, path, fields, expect=(200,)):
+        return self.request('POST', path, urlencode(fields),
+                            {'Content-Type': 'application/x-www-form-urlencoded'}, expect)
+
+    def post_json(self, path, payload):
+        return json.loads(self.request('POST', path, json.dumps(payload), {'Content-Type': 'application/json'}))
+
+    def post_multipart(self, path, fields, file_field, file_name, file_data):
+        boundary = uuid.uuid4().hex
+        body = io.BytesIO()
+        for name, value in fields.items():
+            body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                   f'filename="{file_name}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+        body.write(file_data)
+        body.write(f'\r\n--{boundary}--\r\n'.encode())
+        return self.request('POST', path, body.getvalue(),
+                            {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+    def login(self, username, password):
+        self.post_form('/login', {'username': username, 'password': password}, expect=(302,))
+        if 'session' not in self.cookies:
+            raise RequestFailed(f'login as {username} failed')
+
+
+def make_photo(width=2000, height=1500):
+    """A noisy JPEG, so decoding and resizing cost about as much as a real photo"""
+    noise = Image.effect_noise((width, height), 48)
+    img = Image.merge('RGB', (noise, noise.rotate(90, expand=False), noise.transpose(Image.FLIP_LEFT_RIGHT)))
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=85)
+    return buf.getvalue()
+
+
+def browse(session, rng):
+    groups = session.get_json('/api/groups')
+    session.group_ids = [group['id'] for group in groups]
+    path = '/api/notes?limit=50'
+    if session.group_ids and rng.random() < 0.5:
+        path += f'&group_id={rng.choice(session.group_ids)}'
+    notes = session.get_json(path)['notes']
+    if notes:
+        session.get_json(f'/api/notes/{rng.choice(notes)["id"]}')
+
+
+def switch(session, rng):
+    projects = session.get_json('/api/projects')
+    session.post_json('/api/projects/switch', {'project_id': rng.choice(projects)['id']})
+    session.group_ids = [group['id'] for group in session.get_json('/api/groups')]
+
+
+def upload(session, rng, photo):
+    # Trailing bytes after the JPEG end marker make every upload unique content
+    data = photo + uuid.uuid4().bytes
+    upload_id = uuid.uuid4().hex
+    chunks = [data[start:start + CHUNK_SIZE] for start in range(0, len(data), CHUNK_SIZE)]
+    for index, chunk in enumerate(chunks):
+        session.post_multipart('/api/upload/chunk', {
+            'dzuuid': upload_id, 'dzchunkindex': index,
+            'dzchunkbyteoffset': index * CHUNK_SIZE, 'dztotalfilesize': len(data),
+        }, 'file', 'blob', chunk)
+    merged = session.post_json('/api/upload/merge', {
+        'dzuuid': upload_id, 'filename': 'photo.jpg', 'dztotalchunkcount': len(chunks),
+    })
+    if not session.group_ids:
+        session.group_ids = [group['id'] for group in session.get_json('/api/groups')]
+    if session.group_ids:
+        session.post_form('/api/notes', {
+            'content': 'load test', 'date': time.strftime('%Y-%m-%d'),
+            'group_id': rng.choice(session.group_ids), 'uploaded_chunks': json.dumps([merged]),
+        })
+
+
+def run_action(session, action, rng, photo):
+    start = time.perf_counter()
+    try:
+        if action == 'browse':
+            browse(session, rng)
+        elif action == 'switch':
+            switch(session, rng)
+        else:
+            upload(session, rng, photo)
+        ok = True
+    except (RequestFailed, ValueError, KeyError, IndexError):
+        ok = False
+    session.samples.append((action, time.perf_counter() - start, ok))
+
+
+async def simulate_user(session, mix, deadline, seed, photo):
+    rng = random.Random(seed)
+    actions, weights = zip(*mix.items())
+    while time.monotonic() < deadline:
+        action = rng.choices(actions, weights)[0]
+        await asyncio.to_thread(run_action, session, action, rng, photo)
+
+
+def locked_errors(admin):
+    """The server's count of "database is locked" failures, None if unavailable"""
+    try:
+        match = LOCKED_METRIC.search(admin.request('GET', '/api/admin/metrics').decode())
+    except RequestFailed:
+        return None
+    return float(match.group(1)) if match else 0.0
+
+
+def locked_delta(before, after):
+    """Failures between two scrapes; None if unavailable or the server restarted in between"""
+    if before is None or after is None or after < before:
+        return None
+    return int(after - before)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+async def run_level(args, users, mix, photo, admin):
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=users + 1))
+    sessions = []
+    for index in range(users):
+        session = Session(args.url, args.timeout)
+        await asyncio.to_thread(session.login, f'{args.user_prefix}{index % args.accounts}', args.password)
+        sessions.append(session)
+
+    locked_before = await asyncio.to_thread(locked_errors, admin)
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(
+        simulate_user(session, mix, deadline, args.seed * 1000 + index, photo)
+        for index, session in enumerate(sessions)
+    ))
+    elapsed = time.monotonic() - started
+    await asyncio.sleep(METRICS_SETTLE_SECONDS)
+    locked_after = await asyncio.to_thread(locked_errors, admin)
+    for session in sessions:
+        session.connection.close()
+
+    samples = [sample for session in sessions for sample in session.samples]
+    failed = sum(1 for _, _, ok in samples if not ok)
+    result = {
+        'users': users,
+        'seconds': round(elapsed, 2),
+        'actions': len(samples),
+        'throughput_aps': round(len(samples) / elapsed, 2),
+        'error_rate': round(failed / len(samples), 4) if samples else None,
+        'database_locked': locked_delta(locked_before, locked_after),
+        'by_action': {},
+    }
+    for action in mix:
+        latencies = sorted(seconds for name, seconds, _ in samples if name == action)
+        if not latencies:
+            continue
+        stats = {'count': len(latencies), 'errors': sum(1 for name, _, ok in samples if name == action and not ok)}
+        for p in PERCENTILES:
+            stats[f'p{p}_ms'] = round(percentile(latencies, p) * 1000, 1)
+        result['by_action'][action] = stats
+    return result
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError(f'unknown action {name!r} (choose from {", ".join(ACTIONS)})')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run concurrent user scenarios against a running server.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--users', default='1,4,16', help='comma-separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per level')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'action weights ({DEFAULT_MIX})')
+    parser.add_argument('--accounts', type=int, default=generate.DEFAULTS['users'],
+                        help='generated accounts to log in as (users beyond this share accounts)')
+    parser.add_argument('--user-prefix', default='bench-user-')
+    parser.add_argument('--password', default=generate.PASSWORD)
+    parser.add_argument('--admin-password', default='admin123', help='used to read the lock counter from the metrics')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds before a request counts as failed')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    photo = make_photo()
+    admin = Session(args.url, args.timeout)
+    try:
+        admin.login('admin', args.admin_password)
+    except RequestFailed as e:
+        print(f'Cannot read server metrics: {e}', file=sys.stderr)
+
+    levels = []
+    for users in (int(value) for value in args.users.split(',')):
+        level = asyncio.run(run_level(args, users, args.mix, photo, admin))
+        print(f'{users} users: {level["throughput_aps"]} actions/s, error rate {level["error_rate"]}, '
+              f'database locked {level["database_locked"]}', file=sys.stderr)
+        levels.append(level)
+
+    report = {
+        'url': args.url,
+        'duration_per_level': args.duration,
+        'mix': args.mix,
+        'levels': levels,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+Benchmark runner.
+
+Generates a dataset with bench/generate.py (or reuses --workdir), then drives
+the routes through the Flask test client as a generated team member and as
+admin, one scenario after the other. Reports per scenario the request count,
+errors, p50/p95/p99/mean/max latency and throughput, plus the peak RSS of
+the process, as JSON (stdout or --output) so runs on different commits can
+be compared.
+
+Usage: python bench/run.py [--requests N] [--scenarios get_notes,create_note] [--output FILE] [dataset options]
+"""
+from PIL import Image
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import generate
+
+PERCENTILES = (50, 95, 99)
+CHUNK_SIZE = 256 * 1024
+
+
+def image_bytes(index, size=(640, 480)):
+    buf = io.BytesIO()
+    Image.new('RGB', size, (index % 256, 120, 60)).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+# Each scenario prepares one request (untimed) and returns (client, callable sending it)
+
+def get_notes(ctx, i):
+    return ctx['user'], lambda client: client.get('/api/notes')
+
+
+def get_notes_page(ctx, i):
+    return ctx['user'], lambda client: client.get('/api/notes?limit=50')
+
+
+def get_groups(ctx, i):
+    return ctx['user'], lambda client: client.get('/api/groups')
+
+
+def create_note(ctx, i):
+    data = image_bytes(i)
+
+    def send(client):
+        return client.post('/api/notes', data={
+            'content': f'bench note {i}', 'date': '2026-01-01', 'group_id': str(ctx['group_id']),
+            'images': [(io.BytesIO(data), f'bench_{i}.jpg')],
+        }, content_type='multipart/form-data')
+    return ctx['user'], send
+
+
+def upload_chunk(ctx, i):
+    data = image_bytes(i, (1600, 1200))[:CHUNK_SIZE]
+
+    def send(client):
+        return client.post('/api/upload/chunk', data={
+            'file': (io.BytesIO(data), 'chunk'), 'dzuuid': f'bench-chunk-{i}', 'dzchunkindex': '0',
+            'dzchunkbyteoffset': '0', 'dztotalfilesize': str(len(data)),
+        }, content_type='multipart/form-data')
+    return ctx['user'], send
+
+
+def merge_chunks(ctx, i):
+    data = image_bytes(i, (1600, 1200))
+    chunks = [data[start:start + CHUNK_SIZE] for start in range(0, len(data), CHUNK_SIZE)]
+    uuid = f'bench-merge-{i}'
+    for index, chunk in enumerate(chunks):
+        ctx['user'].post('/api/upload/chunk', data={
+            'file': (io.BytesIO(chunk), 'chunk'), 'dzuuid': uuid, 'dzchunkindex': str(index),
+            'dzchunkbyteoffset': str(index * CHUNK_SIZE), 'dztotalfilesize': str(len(data)),
+        }, content_type='multipart/form-data')
+
+    def send(client):
+        return client.post('/api/upload/merge', json={
+            'dzuuid': uuid, 'filename': f'bench_{i}.jpg', 'dztotalchunkcount': len(chunks),
+        })
+    return ctx['user'], send
+
+
+def admin_users(ctx, i):
+    return ctx['admin'], lambda client: client.get('/api/admin/users')
+
+
+def admin_projects(ctx, i):
+    return ctx['admin'], lambda client: client.get('/api/admin/projects')
+
+
+def admin_teams(ctx, i):
+    return ctx['admin'], lambda client: client.get('/api/admin/teams')
+
+
+SCENARIOS = {scenario.__name__: scenario for scenario in [
+    get_notes, get_notes_page, get_groups, create_note, upload_chunk, merge_chunks,
+    admin_users, admin_projects, admin_teams,
+]}
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list"""
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def run_scenario(ctx, scenario, requests, warmup):
+    latencies = []
+    errors = 0
+    elapsed = 0.0
+    for i in range(warmup + requests):
+        client, send = scenario(ctx, i)
+        start = time.perf_counter()
+        response = send(client)
+        # Streamed bodies are produced while they are read
+        response.get_data()
+        response.close()
+        duration = time.perf_counter() - start
+        if i < warmup:
+            continue
+        latencies.append(duration)
+        elapsed += duration
+        if response.status_code >= 400:
+            errors += 1
+
+    latencies.sort()
+    result = {'requests': requests, 'errors': errors}
+    for p in PERCENTILES:
+        result[f'p{p}_ms'] = round(percentile(latencies, p) * 1000, 3)
+    result['mean_ms'] = round(elapsed / requests * 1000, 3)
+    result['max_ms'] = round(latencies[-1] * 1000, 3)
+    result['throughput_rps'] = round(requests / elapsed, 1) if elapsed else None
+    return result
+
+
+def login(app, username, password):
+    client = app.test_client()
+    response = client.post('/login', data={'username': username, 'password': password})
+    if response.status_code != 302:
+        raise SystemExit(f'Login as {username} failed')
+    return client
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {number}')
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the API routes against a synthetic dataset.')
+    parser.add_argument('--workdir', help='reuse the dataset in this directory, or generate it there (default: a new temp dir)')
+    parser.add_argument('--requests', type=positive_int, default=200, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests per scenario before measuring')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated scenario names')
+    parser.add_argument('--image-workers', type=int, default=None,
+                        help='IMAGE_WORKERS for the run (default: CAIYUAN_IMAGE_WORKERS, else one per CPU)')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    generate.add_arguments(parser)
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(unknown)}')
+
+    options = {name: getattr(args, name) for name in generate.DEFAULTS}
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='caiyuan-bench-'))
+    if os.path.exists(os.path.join(workdir, 'notes.db')):
+        dataset = {'reused': True}
+        os.chdir(workdir)
+    else:
+        dataset = generate.generate(workdir, **options)
+
+    from app import create_app
+    import jobs
+    app = create_app()
+    if args.image_workers is not None:
+        app.config['IMAGE_WORKERS'] = args.image_workers
+
+    user = login(app, 'bench-user-0', generate.PASSWORD)
+    ctx = {
+        'user': user,
+        'admin': login(app, 'admin', 'admin123'),
+        'group_id': user.get('/api/groups').get_json()[0]['id'],
+    }
+
+    started = time.time()
+    results = {}
+    for name in scenarios:
+        results[name] = run_scenario(ctx, SCENARIOS[name], args.requests, args.warmup)
+        results[name]['peak_rss_kb'] = peak_rss_kb()
+    jobs.shutdown()
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+        'workdir': workdir,
+        'dataset': dataset,
+        'requests_per_scenario': args.requests,
+        'scenarios': results,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Process-local TTL cache for small, hot lookups (default project, user info).
+
+Every worker process keeps its own entries. Routes that change the
+underlying rows call invalidate(), so the change is visible at once in that
+process and after at most the entry's TTL in the others.
+"""
+import threading
+import time
+
+DEFAULT_TTL = 60
+# Expired entries are pruned (and, failing that, everything dropped) past this size
+MAX_ENTRIES = 10000
+
+_ALL = object()
+_entries = {}
+_lock = threading.Lock()
+
+
+def cached(namespace, key, loader, ttl=DEFAULT_TTL):
+    """
+    Value of (namespace, key), calling loader() on a miss or once the entry is
+    older than ttl seconds. None results are not cached.
+    """
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get((namespace, key))
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    value = loader()
+    if value is not None:
+        with _lock:
+            if len(_entries) >= MAX_ENTRIES:
+                _prune(now)
+            _entries[(namespace, key)] = (now + ttl, value)
+    return value
+
+
+def invalidate(namespace, key=_ALL):
+    """Drop one entry, or every entry of the namespace if no key is given"""
+    with _lock:
+        if key is not _ALL:
+            _entries.pop((namespace, key), None)
+            return
+        for entry_key in [k for k in _entries if k[0] == namespace]:
+            del _entries[entry_key]
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+def _prune(now):
+    for key in [k for k, (expires, _) in _entries.items() if expires <= now]:
+        del _entries[key]
+    if len(_entries) >= MAX_ENTRIES:
+        _entries.clear()
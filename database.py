@@ -2,162 +2,603 @@ from flask import g
 import sqlite3
 from werkzeug.security import generate_password_hash
 import logging
+import os
+import threading
+import time
+import cache
+import metrics
+import profiler
+
+# Secondary indexes managed by init_db, matching the scoped access patterns of
+# the routes. Plain ascending columns let SQLite walk them backwards for the
+# `date DESC, created_at DESC, id DESC` listings (rowid is the implicit tail).
+MANAGED_INDEXES = [
+    ('idx_groups_team_project', 'groups (team_id, project_id, created_at)'),
+    ('idx_groups_user_team_project', 'groups (user_id, team_id, project_id, created_at)'),
+    ('idx_groups_project', 'groups (project_id)'),
+    ('idx_notes_team_project_date', 'notes (team_id, project_id, date, created_at)'),
+    ('idx_notes_user_team_project_date', 'notes (user_id, team_id, project_id, date, created_at)'),
+    ('idx_notes_group_date', 'notes (group_id, date, created_at)'),
+    ('idx_notes_project', 'notes (project_id)'),
+    ('idx_notes_team_project_calendar', 'notes (team_id, project_id, date, group_id)'),
+    ('idx_notes_user_team_project_calendar', 'notes (user_id, team_id, project_id, date, group_id)'),
+    ('idx_images_note_project', 'images (note_id, project_id, created_at)'),
+    ('idx_images_group', 'images (group_id)'),
+    ('idx_images_project', 'images (project_id)'),
+    ('idx_images_pending', "images (id) WHERE status = 'pending'"),
+    ('idx_images_content_hash', 'images (content_hash) WHERE content_hash IS NOT NULL'),
+    ('idx_images_filename', 'images (filename)'),
+    ('idx_images_team_project_calendar', 'images (team_id, project_id, date, group_id)'),
+    ('idx_images_user_team_project_calendar', 'images (user_id, team_id, project_id, date, group_id)'),
+    ('idx_users_team', 'users (team_id)'),
+    ('idx_users_status', 'users (status, created_at)'),
+    ('idx_users_current_project', 'users (current_project_id)'),
+]
+
+DATABASE = 'notes.db'
+
+# Applied to every new connection. journal_mode=WAL lets readers proceed while a
+# writer commits. foreign_keys stays OFF: delete_user and delete_user_team
+# intentionally leave rows pointing at the removed user/team.
+CONNECTION_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('cache_size', -16000),  # negative = KiB, i.e. 16 MB per connection
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+    ('foreign_keys', 'OFF'),
+]
+
+# Idle connections kept per worker process
+POOL_SIZE = 8
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor reporting the time of each execute() (fetching is not included) to
+    metrics and the SQL profiler
+    """
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        except sqlite3.OperationalError as e:
+            metrics.record_sql_error(e)
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            metrics.record_query(seconds)
+            profiler.record_query(self.connection, sql, parameters, seconds)
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors, including those of the execute() shortcut, are
+    TimedCursors; failed commits are counted like failed statements
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def commit(self):
+        try:
+            return super().commit()
+        except sqlite3.OperationalError as e:
+            metrics.record_sql_error(e)
+            raise
+
+def connect_db():
+    """Open a new configured database connection not bound to the app context"""
+    conn = sqlite3.connect(DATABASE, check_same_thread=False, factory=TimedConnection)
+    conn.row_factory = sqlite3.Row
+    for name, value in CONNECTION_PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+class ConnectionPool:
+    """
+    Per-process pool of configured connections. A connection is used by one
+    thread at a time; after a fork the child discards the parent's connections.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.pid = os.getpid()
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            # Inherited from the parent process; never share them across a fork
+            self.pid = os.getpid()
+            self.idle = []
+
+    def acquire(self):
+        with self.lock:
+            self._check_pid()
+            if self.idle:
+                return self.idle.pop()
+        return connect_db()
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.ProgrammingError:
+            return  # Already closed by the caller
+        with self.lock:
+            self._check_pid()
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+pool = ConnectionPool()
+
+def acquire_db():
+    """Take a connection from the pool; hand it back with release_db"""
+    return pool.acquire()
+
+def release_db(conn):
+    """Return a connection obtained from acquire_db to the pool"""
+    pool.release(conn)
 
 def get_db():
     """Get database connection"""
     if 'db' not in g:
-        g.db = sqlite3.connect('notes.db')
-        g.db.row_factory = sqlite3.Row
+        g.db = acquire_db()
     return g.db
 
 def close_db(e=None):
-    """Close database connection"""
+    """Return database connection to the pool"""
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        release_db(db)
 
-def init_db(app):
-    """Initialize database tables"""
-    with app.app_context():
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # User teams table - for grouping users who share notes
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_teams (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+# Tables whose rows belong to one team/user and project. Every write to them
+# bumps the version counter of that scope in data_versions (see
+# migrate_data_versions), which the listing routes use as their ETag.
+VERSIONED_TABLES = ['groups', 'notes', 'images']
+# Version counter of the project list
+PROJECTS_SCOPE = 'projects'
 
-        # Projects table - all groups/notes belong to a project
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS projects (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Users table with role, status, and team
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                role TEXT DEFAULT 'user',
-                status TEXT DEFAULT 'pending',
-                team_id INTEGER,
-                current_project_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (team_id) REFERENCES user_teams (id),
-                FOREIGN KEY (current_project_id) REFERENCES projects (id)
-            )
-        ''')
-        
-        # Note groups table - now shared within user teams
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS groups (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                team_id INTEGER,
-                project_id INTEGER,
-                user_id INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (team_id) REFERENCES user_teams (id),
-                FOREIGN KEY (project_id) REFERENCES projects (id),
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Notes table
+def scope_key(team_id, user_id, project_id):
+    """data_versions key of a team's (or a team-less user's) data in a project"""
+    if team_id:
+        return f'team:{team_id}:{project_id}'
+    return f'user:{user_id}:{project_id}'
+
+def get_data_version(cursor, scope):
+    cursor.execute('SELECT version FROM data_versions WHERE scope = ?', (scope,))
+    row = cursor.fetchone()
+    return row['version'] if row else 0
+
+def ensure_indexes(cursor):
+    """Create managed indexes and drop stale idx_* indexes no longer in MANAGED_INDEXES"""
+    managed = dict(MANAGED_INDEXES)
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx\\_%' ESCAPE '\\'")
+    for row in cursor.fetchall():
+        if row['name'] not in managed:
+            cursor.execute(f'DROP INDEX IF EXISTS {row["name"]}')
+    
+    for name, definition in MANAGED_INDEXES:
+        try:
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {definition}')
+        except sqlite3.OperationalError as e:
+            # Column is added by a later migration, which re-runs ensure_indexes
+            if 'no such column' not in str(e):
+                raise
+
+# Columns added after the first release; legacy databases get them via ALTER TABLE
+ADDED_COLUMNS = [
+    ('users', 'role', "ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'"),
+    ('users', 'status', "ALTER TABLE users ADD COLUMN status TEXT DEFAULT 'approved'"),
+    ('users', 'team_id', "ALTER TABLE users ADD COLUMN team_id INTEGER REFERENCES user_teams(id)"),
+    ('users', 'current_project_id', "ALTER TABLE users ADD COLUMN current_project_id INTEGER REFERENCES projects(id)"),
+    ('groups', 'team_id', "ALTER TABLE groups ADD COLUMN team_id INTEGER REFERENCES user_teams(id)"),
+    ('groups', 'project_id', "ALTER TABLE groups ADD COLUMN project_id INTEGER REFERENCES projects(id)"),
+    ('notes', 'team_id', "ALTER TABLE notes ADD COLUMN team_id INTEGER REFERENCES user_teams(id)"),
+    ('notes', 'project_id', "ALTER TABLE notes ADD COLUMN project_id INTEGER REFERENCES projects(id)"),
+    ('images', 'team_id', "ALTER TABLE images ADD COLUMN team_id INTEGER REFERENCES user_teams(id)"),
+    ('images', 'note_id', "ALTER TABLE images ADD COLUMN note_id INTEGER REFERENCES notes(id)"),
+    ('images', 'project_id', "ALTER TABLE images ADD COLUMN project_id INTEGER REFERENCES projects(id)"),
+]
+
+# Rows covered per transaction by batched backfills, so other writers can interleave
+BACKFILL_BATCH_SIZE = 5000
+
+def get_default_project_id(cursor):
+    """Get default project id (legacy data belongs to '种植')."""
+    cursor.execute('SELECT id FROM projects WHERE name = ? AND deleted_at IS NULL', ('种植',))
+    project = cursor.fetchone()
+    if project:
+        return project['id']
+    cursor.execute('SELECT id FROM projects WHERE deleted_at IS NULL ORDER BY id ASC LIMIT 1')
+    project = cursor.fetchone()
+    return project['id'] if project else None
+
+def cached_default_project_id(cursor):
+    """get_default_project_id through the process cache (invalidated by the project admin routes)"""
+    return cache.cached('default_project', None, lambda: get_default_project_id(cursor))
+
+def batched_update(conn, table, assignment, condition, params=()):
+    """
+    Run `UPDATE table SET assignment WHERE condition` over successive rowid
+    ranges of BACKFILL_BATCH_SIZE rows, committing after each range. params
+    bind the assignment. The condition must be false for updated rows, so an
+    interrupted backfill can simply run again. Returns the number of rows updated.
+    """
+    cursor = conn.cursor()
+    total = 0
+    last_rowid = 0
+    while True:
+        cursor.execute(f'''
+            SELECT MAX(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)
+        ''', (last_rowid, BACKFILL_BATCH_SIZE))
+        end_rowid = cursor.fetchone()[0]
+        if end_rowid is None:
+            return total
+        cursor.execute(f'''
+            UPDATE {table} SET {assignment} WHERE rowid > ? AND rowid <= ? AND ({condition})
+        ''', tuple(params) + (last_rowid, end_rowid))
+        conn.commit()
+        total += cursor.rowcount
+        last_rowid = end_rowid
+
+def add_missing_columns(cursor, columns):
+    """Run the ALTER TABLE of each (table, column, sql) entry whose column does not exist yet"""
+    for table, column, sql in columns:
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in {row['name'] for row in cursor.fetchall()}:
+            cursor.execute(sql)
+
+def migrate_create_tables(conn):
+    """Create base tables and add columns missing from databases created by older versions"""
+    cursor = conn.cursor()
+    
+    # User teams table - for grouping users who share notes
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_teams (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Projects table - all groups/notes belong to a project
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS projects (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Users table with role, status, and team
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            role TEXT DEFAULT 'user',
+            status TEXT DEFAULT 'pending',
+            team_id INTEGER,
+            current_project_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (team_id) REFERENCES user_teams (id),
+            FOREIGN KEY (current_project_id) REFERENCES projects (id)
+        )
+    ''')
+    
+    # Note groups table - now shared within user teams
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            team_id INTEGER,
+            project_id INTEGER,
+            user_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (team_id) REFERENCES user_teams (id),
+            FOREIGN KEY (project_id) REFERENCES projects (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Notes table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content TEXT DEFAULT '',
+            date TEXT NOT NULL,
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            team_id INTEGER,
+            project_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (group_id) REFERENCES groups (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (team_id) REFERENCES user_teams (id),
+            FOREIGN KEY (project_id) REFERENCES projects (id)
+        )
+    ''')
+    
+    # Images table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT NOT NULL,
+            original_filename TEXT NOT NULL,
+            note_id INTEGER,
+            date TEXT NOT NULL,
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            team_id INTEGER,
+            project_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (note_id) REFERENCES notes (id),
+            FOREIGN KEY (group_id) REFERENCES groups (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (team_id) REFERENCES user_teams (id),
+            FOREIGN KEY (project_id) REFERENCES projects (id)
+        )
+    ''')
+    
+    add_missing_columns(cursor, ADDED_COLUMNS)
+
+def migrate_create_indexes(conn):
+    """Create the managed secondary indexes"""
+    ensure_indexes(conn.cursor())
+
+def migrate_seed_defaults(conn):
+    """Ensure default project and admin user exist and backfill legacy rows without a project"""
+    cursor = conn.cursor()
+    cursor.execute('INSERT OR IGNORE INTO projects (name) VALUES (?)', ('种植',))
+    # Not get_default_project_id: projects.deleted_at is only added by a later step
+    cursor.execute('SELECT id FROM projects WHERE name = ?', ('种植',))
+    default_project_id = cursor.fetchone()['id']
+    
+    # Create default admin user if not exists
+    cursor.execute('SELECT * FROM users WHERE username = ?', ('admin',))
+    if not cursor.fetchone():
+        password_hash = generate_password_hash('admin123')
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS notes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                content TEXT DEFAULT '',
-                date TEXT NOT NULL,
-                group_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                team_id INTEGER,
-                project_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (group_id) REFERENCES groups (id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (team_id) REFERENCES user_teams (id),
-                FOREIGN KEY (project_id) REFERENCES projects (id)
-            )
-        ''')
-        
-        # Images table
+            INSERT INTO users (username, password_hash, role, status, current_project_id)
+            VALUES (?, ?, 'admin', 'approved', ?)
+        ''', ('admin', password_hash, default_project_id))
+    else:
+        # Ensure admin has correct role and status
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                filename TEXT NOT NULL,
-                original_filename TEXT NOT NULL,
-                note_id INTEGER,
-                date TEXT NOT NULL,
-                group_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                team_id INTEGER,
-                project_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (note_id) REFERENCES notes (id),
-                FOREIGN KEY (group_id) REFERENCES groups (id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (team_id) REFERENCES user_teams (id),
-                FOREIGN KEY (project_id) REFERENCES projects (id)
-            )
+            UPDATE users SET role = 'admin', status = 'approved', current_project_id = COALESCE(current_project_id, ?)
+            WHERE username = 'admin'
+        ''', (default_project_id,))
+    
+    conn.commit()
+    
+    # Backfill legacy data without project_id
+    for table in ('groups', 'notes', 'images'):
+        batched_update(conn, table, 'project_id = ?', 'project_id IS NULL', (default_project_id,))
+    batched_update(conn, 'users', 'current_project_id = ?', 'current_project_id IS NULL', (default_project_id,))
+
+def migrate_image_status(conn):
+    """Track background processing state of images ('pending', 'ready' or 'failed')"""
+    add_missing_columns(conn.cursor(), [
+        ('images', 'status', "ALTER TABLE images ADD COLUMN status TEXT DEFAULT 'ready'"),
+    ])
+
+def migrate_image_variants(conn):
+    """Store the responsive variants written for each image as JSON"""
+    add_missing_columns(conn.cursor(), [
+        ('images', 'variants', "ALTER TABLE images ADD COLUMN variants TEXT"),
+    ])
+
+def migrate_image_content_hash(conn):
+    """SHA-256 of image content for the content-addressed store (NULL for legacy uploads)"""
+    add_missing_columns(conn.cursor(), [
+        ('images', 'content_hash', "ALTER TABLE images ADD COLUMN content_hash TEXT"),
+    ])
+
+def migrate_notes_fts(conn):
+    """
+    Full-text index over notes.content. The trigram tokenizer matches any
+    substring of three or more characters, so unsegmented Chinese text is
+    searchable without a word-segmentation dictionary. notes_fts stores only
+    the index (content='notes') and is kept in sync by triggers.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            content, content='notes', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF content ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO notes_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    # Index notes written before the table existed
+    cursor.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+
+def migrate_sync_image_dates(conn):
+    """Copy date and group_id from notes to their images (update_note used to leave them stale)"""
+    batched_update(
+        conn, 'images',
+        'date = (SELECT n.date FROM notes n WHERE n.id = images.note_id), '
+        'group_id = (SELECT n.group_id FROM notes n WHERE n.id = images.note_id)',
+        'EXISTS (SELECT 1 FROM notes n WHERE n.id = images.note_id '
+        'AND (n.date != images.date OR n.group_id != images.group_id))',
+    )
+
+def migrate_data_versions(conn):
+    """Per-scope version counters, bumped by triggers on every write to the scoped tables"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            scope TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    def bump(scope_sql):
+        return (f'INSERT INTO data_versions (scope, version) VALUES ({scope_sql}, 1) '
+                f'ON CONFLICT (scope) DO UPDATE SET version = version + 1;')
+    
+    def row_scope(row):
+        # Same format as scope_key()
+        return (f"CASE WHEN {row}.team_id IS NOT NULL THEN 'team:' || {row}.team_id "
+                f"ELSE 'user:' || {row}.user_id END || ':' || IFNULL({row}.project_id, '')")
+    
+    for table in VERSIONED_TABLES:
+        for event, statements in [('INSERT', bump(row_scope('new'))),
+                                  ('DELETE', bump(row_scope('old'))),
+                                  ('UPDATE', bump(row_scope('old')) + ' ' + bump(row_scope('new')))]:
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                    {statements}
+                END
+            ''')
+    
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS projects_version_{event.lower()} AFTER {event} ON projects BEGIN
+                {bump(f"'{PROJECTS_SCOPE}'")}
+            END
         ''')
-        
-        # Migration: Add new columns if they don't exist
-        migrations = [
-            ('users', 'role', "ALTER TABLE users ADD COLUMN role TEXT DEFAULT 'user'"),
-            ('users', 'status', "ALTER TABLE users ADD COLUMN status TEXT DEFAULT 'approved'"),
-            ('users', 'team_id', "ALTER TABLE users ADD COLUMN team_id INTEGER REFERENCES user_teams(id)"),
-            ('users', 'current_project_id', "ALTER TABLE users ADD COLUMN current_project_id INTEGER REFERENCES projects(id)"),
-            ('groups', 'team_id', "ALTER TABLE groups ADD COLUMN team_id INTEGER REFERENCES user_teams(id)"),
-            ('groups', 'project_id', "ALTER TABLE groups ADD COLUMN project_id INTEGER REFERENCES projects(id)"),
-            ('notes', 'team_id', "ALTER TABLE notes ADD COLUMN team_id INTEGER REFERENCES user_teams(id)"),
-            ('notes', 'project_id', "ALTER TABLE notes ADD COLUMN project_id INTEGER REFERENCES projects(id)"),
-            ('images', 'team_id', "ALTER TABLE images ADD COLUMN team_id INTEGER REFERENCES user_teams(id)"),
-            ('images', 'note_id', "ALTER TABLE images ADD COLUMN note_id INTEGER REFERENCES notes(id)"),
-            ('images', 'project_id', "ALTER TABLE images ADD COLUMN project_id INTEGER REFERENCES projects(id)"),
-        ]
-        
-        for table, column, sql in migrations:
-            try:
-                cursor.execute(sql)
-            except sqlite3.OperationalError:
-                pass  # Column already exists
-        
-        # Ensure default project exists for backward compatibility
-        cursor.execute('INSERT OR IGNORE INTO projects (name) VALUES (?)', ('种植',))
-        cursor.execute('SELECT id FROM projects WHERE name = ?', ('种植',))
-        default_project = cursor.fetchone()
-        default_project_id = default_project['id'] if default_project else 1
-
-        # Backfill legacy data without project_id
-        cursor.execute('UPDATE groups SET project_id = ? WHERE project_id IS NULL', (default_project_id,))
-        cursor.execute('UPDATE notes SET project_id = ? WHERE project_id IS NULL', (default_project_id,))
-        cursor.execute('UPDATE images SET project_id = ? WHERE project_id IS NULL', (default_project_id,))
-        cursor.execute('UPDATE users SET current_project_id = ? WHERE current_project_id IS NULL', (default_project_id,))
-
-        # Create default admin user if not exists
-        cursor.execute('SELECT * FROM users WHERE username = ?', ('admin',))
-        if not cursor.fetchone():
-            password_hash = generate_password_hash('admin123')
-            cursor.execute('''
-                INSERT INTO users (username, password_hash, role, status, current_project_id)
-                VALUES (?, ?, 'admin', 'approved', ?)
-            ''', ('admin', password_hash, default_project_id))
-        else:
-            # Ensure admin has correct role and status
-            cursor.execute('''
-                UPDATE users SET role = 'admin', status = 'approved', current_project_id = COALESCE(current_project_id, ?)
-                WHERE username = 'admin'
-            ''', (default_project_id,))
-        
+
+def migrate_team_reassignments(conn):
+    """Progress of background team reassignments (see reassign.py), so they can resume after a restart"""
+    conn.cursor().execute('''
+        CREATE TABLE IF NOT EXISTS team_reassignments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_ids TEXT NOT NULL,
+            team_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            total_rows INTEGER NOT NULL DEFAULT 0,
+            moved_rows INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def migrate_soft_delete(conn):
+    """deleted_at on groups/projects and the background deletion jobs that reap them"""
+    cursor = conn.cursor()
+    add_missing_columns(cursor, [
+        ('groups', 'deleted_at', "ALTER TABLE groups ADD COLUMN deleted_at TIMESTAMP"),
+        ('projects', 'deleted_at', "ALTER TABLE projects ADD COLUMN deleted_at TIMESTAMP"),
+    ])
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deletion_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            target_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            total_rows INTEGER NOT NULL DEFAULT 0,
+            removed_rows INTEGER NOT NULL DEFAULT 0,
+            removed_files INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def migrate_reassignment_progress(conn):
+    """Last rowid a team reassignment has passed in each table, as JSON, so a resumed job skips ahead"""
+    add_missing_columns(conn.cursor(), [
+        ('team_reassignments', 'last_rowids', "ALTER TABLE team_reassignments ADD COLUMN last_rowids TEXT"),
+    ])
+
+# Ordered schema migrations; the database's PRAGMA user_version records how many
+# have been applied. Append new steps (e.g. another migrate_create_indexes after
+# changing MANAGED_INDEXES) and never reorder or remove existing ones.
+MIGRATIONS = [
+    migrate_create_tables,
+    migrate_create_indexes,
+    migrate_seed_defaults,
+    migrate_image_status,
+    migrate_create_indexes,
+    migrate_image_variants,
+    migrate_image_content_hash,
+    migrate_create_indexes,
+    migrate_create_indexes,  # idx_images_filename
+    migrate_notes_fts,
+    migrate_create_indexes,  # calendar indexes
+    migrate_sync_image_dates,
+    migrate_data_versions,
+    migrate_team_reassignments,
+    migrate_soft_delete,
+    migrate_reassignment_progress,
+    migrate_create_indexes,  # drops idx_images_user
+]
+
+# Steps that commit their own batches instead of holding the write lock
+# throughout; they must be safe to run again after an interruption
+RESUMABLE_MIGRATIONS = {migrate_seed_defaults, migrate_sync_image_dates}
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def run_migrations(conn, logger=None):
+    """
+    Apply each pending migration exactly once. Returns the number of steps applied.
+    A step runs in the same transaction as its user_version bump, so it must not
+    commit, unless it is in RESUMABLE_MIGRATIONS: those run to completion first
+    and user_version is bumped under a fresh lock afterwards.
+    """
+    applied = 0
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        # Take the write lock and re-check, so concurrently starting workers
+        # don't apply the same step twice
+        conn.execute('BEGIN IMMEDIATE')
+        if get_schema_version(conn) >= version:
+            conn.rollback()
+            continue
+        migration(conn)
+        if migration in RESUMABLE_MIGRATIONS:
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            if get_schema_version(conn) >= version:
+                # Another worker finished the same step meanwhile
+                conn.rollback()
+                continue
+        elif not conn.in_transaction:
+            raise RuntimeError(f'Migration {version} ({migration.__name__}) committed before its version bump')
+        conn.execute(f'PRAGMA user_version = {version}')
         conn.commit()
+        applied += 1
+        if logger:
+            logger.info(f'Applied database migration {version}: {migration.__name__}')
+    return applied
+
+def init_db(app):
+    """Initialize database tables, applying pending schema migrations"""
+    with app.app_context():
+        conn = get_db()
+        if get_schema_version(conn) >= len(MIGRATIONS):
+            return
+        
+        run_migrations(conn, app.logger)
         app.logger.info('Database initialized successfully')
@@ -0,0 +1,52 @@
+"""
+Gunicorn settings for wsgi:app, tuned through environment variables:
+
+    CAIYUAN_BIND             address to listen on (0.0.0.0:5000)
+    CAIYUAN_WORKERS          worker processes (one per CPU)
+    CAIYUAN_THREADS          request threads per worker (4)
+    CAIYUAN_TIMEOUT          seconds before a silent worker is restarted (120)
+    CAIYUAN_IMAGE_WORKERS    image processing processes per worker
+                             (the CPUs divided among the workers)
+
+Workers are processes, so requests scale with cores despite the GIL; the
+threads of a worker overlap SQLite waits, uploads and streamed responses.
+
+Reloads: `kill -HUP <master>` replaces the workers one by one, letting each
+finish its requests within graceful_timeout. The master does not re-import
+the application on HUP (preload_app), so to deploy new code start a new
+master with `kill -USR2 <master>`, then stop the old one with `kill -QUIT`.
+"""
+import os
+
+workers = int(os.environ.get("CAIYUAN_WORKERS") or os.cpu_count() or 1)
+threads = int(os.environ.get("CAIYUAN_THREADS") or 4)
+worker_class = "gthread"
+bind = os.environ.get("CAIYUAN_BIND", "0.0.0.0:5000")
+timeout = int(os.environ.get("CAIYUAN_TIMEOUT") or 120)
+graceful_timeout = 30
+keepalive = 5
+
+# Create the app (and run init_db) once in the master before forking
+preload_app = True
+
+# Each worker has its own image processing pool; share the CPUs between them
+os.environ.setdefault("CAIYUAN_IMAGE_WORKERS", str(max(1, (os.cpu_count() or 1) // workers)))
+
+
+def post_fork(server, worker):
+    from app import init_worker
+    from wsgi import app
+
+    init_worker(app)
+
+
+def worker_exit(server, worker):
+    import database
+    import jobs
+    import metrics
+
+    # Let queued image processing finish; the next worker would requeue it anyway
+    jobs.shutdown(wait=True)
+    database.pool.close_all()
+    # Keep the worker's final counts in the totals
+    metrics.flush()
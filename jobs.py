@@ -0,0 +1,162 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from database import acquire_db, release_db
+from storage import image_files, unlink_files
+from utils import process_image_file, VARIANT_FORMATS
+import json
+import logging
+import metrics
+import multiprocessing
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def relative_to(upload_folder, filepath):
+    return os.path.relpath(filepath, upload_folder).replace(os.sep, '/')
+
+
+def process_image(upload_folder, filename):
+    """
+    Convert an uploaded image to progressive JPEG and create its thumbnails and
+    responsive variants in a single decode. Runs in a worker process.
+    Returns (new relative filename, status, variants with relative paths,
+    seconds per processing stage).
+    """
+    filepath = os.path.join(upload_folder, filename)
+    timings = {}
+    new_filepath, thumbnails, variants = process_image_file(filepath, timings=timings)
+    variants = [
+        {key: relative_to(upload_folder, value) if key in VARIANT_FORMATS else value for key, value in variant.items()}
+        for variant in variants
+    ]
+    return relative_to(upload_folder, new_filepath), 'ready' if thumbnails else 'failed', variants, timings
+
+
+def get_executor(workers):
+    """Lazily create this process's worker pool (spawned, so no Flask/SQLite state is inherited)"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(
+                max_workers=workers or os.cpu_count(),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def shutdown(wait=True):
+    """Stop this process's worker pool"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None and _executor_pid == os.getpid():
+        executor.shutdown(wait=wait)
+
+
+def finish_image(upload_folder, image_id, filename, new_filename, status, variants=None, content_hash=None):
+    """
+    Store the processing result on the image row, or on every row sharing its
+    content. Cleans up the output if those rows were deleted meanwhile.
+    """
+    variants_json = json.dumps(variants) if variants else None
+    conn = acquire_db()
+    try:
+        cursor = conn.cursor()
+        if content_hash:
+            cursor.execute('UPDATE images SET filename = ?, status = ?, variants = ? WHERE content_hash = ? AND filename = ?',
+                           (new_filename, status, variants_json, content_hash, filename))
+        else:
+            cursor.execute('UPDATE images SET filename = ?, status = ?, variants = ? WHERE id = ? AND filename = ?',
+                           (new_filename, status, variants_json, image_id, filename))
+        conn.commit()
+        if cursor.rowcount:
+            return
+
+        if content_hash:
+            # Rows re-uploaded since may still reference the stored content
+            cursor.execute('SELECT 1 FROM images WHERE content_hash = ? LIMIT 1', (content_hash,))
+            if cursor.fetchone():
+                return
+    finally:
+        release_db(conn)
+
+    unlink_files(upload_folder, image_files(new_filename, variants))
+
+
+def enqueue_images(app, images):
+    """
+    Queue processing for committed image rows given as (image_id, filename, content_hash)
+    tuples. With IMAGE_WORKERS = 0 images are processed inline in the calling thread.
+    """
+    upload_folder = app.config['UPLOAD_FOLDER']
+    workers = app.config.get('IMAGE_WORKERS')
+
+    for image_id, filename, content_hash in images:
+        if workers == 0:
+            run_inline(upload_folder, image_id, filename, content_hash)
+            continue
+        try:
+            future = get_executor(workers).submit(process_image, upload_folder, filename)
+        except (BrokenProcessPool, RuntimeError) as e:
+            logger.error(f'Image worker pool unavailable, processing {filename} inline: {e}')
+            shutdown(wait=False)
+            run_inline(upload_folder, image_id, filename, content_hash)
+            continue
+        future.add_done_callback(
+            lambda f, image_id=image_id, filename=filename, content_hash=content_hash:
+                on_image_done(upload_folder, image_id, filename, content_hash, f)
+        )
+
+
+def run_inline(upload_folder, image_id, filename, content_hash=None):
+    try:
+        new_filename, status, variants, timings = process_image(upload_folder, filename)
+        metrics.record_image(timings)
+    except Exception as e:
+        logger.error(f'Error processing image {filename}: {e}')
+        new_filename, status, variants = filename, 'failed', []
+    finish_image(upload_folder, image_id, filename, new_filename, status, variants, content_hash)
+
+
+def on_image_done(upload_folder, image_id, filename, content_hash, future):
+    try:
+        new_filename, status, variants, timings = future.result()
+        metrics.record_image(timings)
+    except BrokenProcessPool as e:
+        logger.error(f'Image worker pool broke, processing {filename} inline: {e}')
+        shutdown(wait=False)
+        run_inline(upload_folder, image_id, filename, content_hash)
+        return
+    except Exception as e:
+        logger.error(f'Error processing image {filename}: {e}')
+        new_filename, status, variants = filename, 'failed', []
+    try:
+        finish_image(upload_folder, image_id, filename, new_filename, status, variants, content_hash)
+    except Exception as e:
+        logger.error(f'Error saving processing result for image {image_id}: {e}')
+
+
+def requeue_pending(app):
+    """Queue images left 'pending' by a previous process (e.g. after a restart)"""
+    conn = acquire_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, filename, content_hash FROM images WHERE status = 'pending'")
+        pending = {}
+        for row in cursor.fetchall():
+            # Rows sharing stored content are processed once
+            pending.setdefault(row['content_hash'] or row['id'], (row['id'], row['filename'], row['content_hash']))
+        pending = list(pending.values())
+    finally:
+        release_db(conn)
+
+    if pending:
+        app.logger.info(f'Requeued {len(pending)} pending images')
+        enqueue_images(app, pending)
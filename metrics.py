@@ -0,0 +1,292 @@
+"""
+Request, SQL and image processing metrics in the Prometheus text format.
+
+init_app() times every request and labels it with its endpoint (e.g.
+notes.get_notes). Pooled connections time each statement they execute (see
+database.TimedConnection), and the statements of a request are added to that
+request's endpoint; statements run by background threads are labelled
+"background". Image processing stages are timed in the worker processes and
+recorded here when the result comes back (see jobs.py).
+
+Values are kept per process. With METRICS_DIR set (the pre-fork server sets
+it, see app.create_app), every process also writes its values to a file of
+its own there every FLUSH_INTERVAL seconds, and /api/admin/metrics reports
+the sum over all those files: whichever worker answers a scrape, the totals
+cover every worker, including workers that have exited since, so counters
+only go up.
+"""
+from flask import request
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+IMAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Endpoint label of statements run outside a request
+BACKGROUND = 'background'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds between writes of a process's values to METRICS_DIR
+FLUSH_INTERVAL = 2
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+# When counting started: server start; forked workers keep the master's value
+_started = time.time()
+# This process's start, naming its file in METRICS_DIR
+_process_started = _started
+_metrics_dir = None
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(label_values), value] for label_values, value in self.values.items()]
+
+    @staticmethod
+    def merge(values, snapshot):
+        for label_values, value in snapshot:
+            label_values = tuple(label_values)
+            values[label_values] = values.get(label_values, 0) + value
+
+    def render(self, values=None):
+        """Lines of this process's values, or of `values` merged from several processes"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            values = dict(self.values if values is None else values)
+        for label_values, value in sorted(values.items()):
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., count, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(label_values), list(series)] for label_values, series in self.values.items()]
+
+    @staticmethod
+    def merge(values, snapshot):
+        for label_values, series in snapshot:
+            label_values = tuple(label_values)
+            if label_values in values:
+                values[label_values] = [a + b for a, b in zip(values[label_values], series)]
+            else:
+                values[label_values] = series
+
+    def render(self, values=None):
+        """Lines of this process's values, or of `values` merged from several processes"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        names = self.labels + ('le',)
+        with self.lock:
+            values = {key: list(series) for key, series in (self.values if values is None else values).items()}
+        for label_values, series in sorted(values.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{format_labels(names, label_values + (bound,))} {count}')
+            lines.append(f'{self.name}_bucket{format_labels(names, label_values + ("+Inf",))} {series[-2]}')
+            labels = format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_count{labels} {series[-2]}')
+            lines.append(f'{self.name}_sum{labels} {format_value(series[-1])}')
+        return lines
+
+
+REQUESTS = Counter('caiyuan_requests_total', 'Requests served, by endpoint, method and status.',
+                   ('endpoint', 'method', 'status'))
+REQUEST_DURATION = Histogram('caiyuan_request_duration_seconds',
+                             'Request latency including streaming the response body.', ('endpoint',))
+REQUEST_QUERIES = Histogram('caiyuan_request_sql_queries', 'SQL statements executed per request.',
+                            ('endpoint',), QUERY_COUNT_BUCKETS)
+SQL_QUERIES = Counter('caiyuan_sql_queries_total', 'SQL statements executed.', ('endpoint',))
+SQL_SECONDS = Counter('caiyuan_sql_query_seconds_total', 'Time spent executing SQL statements.', ('endpoint',))
+SQL_ERRORS = Counter('caiyuan_sql_errors_total',
+                     'Statements failing with an OperationalError; "locked" is SQLITE_BUSY after busy_timeout.',
+                     ('error',))
+IMAGE_SECONDS = Histogram('caiyuan_image_processing_seconds',
+                          'Pillow processing time per image, by stage.', ('stage',), IMAGE_BUCKETS)
+
+REGISTRY = [REQUESTS, REQUEST_DURATION, REQUEST_QUERIES, SQL_QUERIES, SQL_SECONDS, SQL_ERRORS, IMAGE_SECONDS]
+
+
+def record_query(seconds):
+    """Count one executed SQL statement towards the current request, if any"""
+    stats = getattr(_local, 'request', None)
+    if stats is None:
+        SQL_QUERIES.inc((BACKGROUND,))
+        SQL_SECONDS.inc((BACKGROUND,), seconds)
+        return
+    stats['queries'] += 1
+    stats['sql_seconds'] += seconds
+
+
+def record_sql_error(error):
+    SQL_ERRORS.inc(('locked' if 'locked' in str(error) else 'other',))
+
+
+def record_image(timings):
+    """Record the stage timings returned by utils.process_image_file"""
+    for stage, seconds in (timings or {}).items():
+        IMAGE_SECONDS.observe((stage,), seconds)
+
+
+def snapshot_path():
+    return os.path.join(_metrics_dir, f'{os.getpid()}-{int(_process_started * 1000)}.json')
+
+
+def flush():
+    """Write this process's values to its file in METRICS_DIR, if set"""
+    if _metrics_dir is None:
+        return
+    path = snapshot_path()
+    data = {metric.name: metric.snapshot() for metric in REGISTRY}
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+def run_flusher():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError as e:
+            logger.error(f'Cannot write metrics to {_metrics_dir}: {e}')
+
+
+def start_flusher():
+    """Start this process's flusher thread if METRICS_DIR is set and it is not running yet"""
+    global _flusher_pid
+    if _metrics_dir is None or _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            threading.Thread(target=run_flusher, name='metrics-flusher', daemon=True).start()
+            _flusher_pid = os.getpid()
+
+
+def merged_values():
+    """{metric name: values} summed over every process's file in METRICS_DIR"""
+    flush()
+    merged = {metric.name: {} for metric in REGISTRY}
+    for path in glob.glob(os.path.join(_metrics_dir, '*.json')):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue  # Replaced or removed meanwhile
+        for metric in REGISTRY:
+            metric.merge(merged[metric.name], data.get(metric.name, []))
+    return merged
+
+
+def render():
+    lines = [
+        '# HELP caiyuan_start_time_seconds Time the reported values started counting from (server start).',
+        '# TYPE caiyuan_start_time_seconds gauge',
+        f'caiyuan_start_time_seconds {_started}',
+    ]
+    merged = merged_values() if _metrics_dir is not None else {}
+    for metric in REGISTRY:
+        lines += metric.render(merged.get(metric.name))
+    return '\n'.join(lines) + '\n'
+
+
+def reset_after_fork():
+    """A forked worker starts with empty values; its parent's are in the parent's file"""
+    global _process_started, _flusher_pid
+    _process_started = time.time()
+    _flusher_pid = None
+    for metric in REGISTRY:
+        metric.lock = threading.Lock()
+        metric.values = {}
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def finish_request(stats, endpoint, method, status):
+    if getattr(_local, 'request', None) is stats:
+        _local.request = None
+    REQUESTS.inc((endpoint, method, str(status)))
+    REQUEST_DURATION.observe((endpoint,), time.perf_counter() - stats['start'])
+    REQUEST_QUERIES.observe((endpoint,), stats['queries'])
+    SQL_QUERIES.inc((endpoint,), stats['queries'])
+    SQL_SECONDS.inc((endpoint,), stats['sql_seconds'])
+
+
+def init_app(app):
+    """
+    Time every request of the app. With METRICS_DIR set, values of earlier
+    runs are removed from it: call this once per server start, before forking.
+    """
+    global _metrics_dir
+    _metrics_dir = app.config.get('METRICS_DIR')
+    if _metrics_dir is not None:
+        os.makedirs(_metrics_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(_metrics_dir, '*.json')):
+            os.remove(path)
+
+    @app.before_request
+    def start_request():
+        start_flusher()
+        _local.request = {'start': time.perf_counter(), 'queries': 0, 'sql_seconds': 0.0}
+
+    # Recorded once the body has been sent, so streamed responses and the
+    # statements they run are included (the request context is gone by then)
+    @app.after_request
+    def finish_on_close(response):
+        stats = getattr(_local, 'request', None)
+        if stats is not None:
+            labels = (request.endpoint or 'unmatched', request.method, response.status_code)
+            response.call_on_close(lambda: finish_request(stats, *labels))
+        return response
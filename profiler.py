@@ -0,0 +1,106 @@
+"""
+Opt-in SQL profiling for the pooled connections (see database.TimedCursor).
+
+With SLOW_QUERY_MS set, every statement slower than that is logged together
+with the shape of its bound parameters and its EXPLAIN QUERY PLAN, whether it
+ran in a request or a background thread.
+
+An admin sending the SQL_PROFILE_HEADER request header (e.g. "X-SQL-Profile: 1")
+gets a JSON summary of the request's statements back in the same response
+header: {"count", "total_ms", "slowest_ms", "slowest"}. Headers go out before
+a streamed body, so for streamed listings it covers the statements run
+before streaming started.
+"""
+from flask import request, session
+import json
+import logging
+import re
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Longest statement text put in logs and the summary header
+STATEMENT_MAX_LENGTH = 300
+
+_local = threading.local()
+_slow_query_seconds = None
+
+
+def normalize(sql):
+    sql = re.sub(r'\s+', ' ', sql).strip()
+    return sql if len(sql) <= STATEMENT_MAX_LENGTH else sql[:STATEMENT_MAX_LENGTH] + '...'
+
+
+def parameter_shape(parameters):
+    """Types of the bound parameters without their values, e.g. "(int, str*3, NoneType)" """
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{name}: {type(value).__name__}' for name, value in parameters.items()) + '}'
+    runs = []
+    for value in parameters:
+        name = type(value).__name__
+        if runs and runs[-1][0] == name:
+            runs[-1][1] += 1
+        else:
+            runs.append([name, 1])
+    return '(' + ', '.join(name if count == 1 else f'{name}*{count}' for name, count in runs) + ')'
+
+
+def query_plan(connection, sql, parameters):
+    try:
+        # A plain cursor, so the EXPLAIN itself is not timed or profiled
+        rows = connection.cursor(sqlite3.Cursor).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+    except sqlite3.Error as e:
+        return [f'(no plan: {e})']
+    return [row[3] for row in rows]
+
+
+def record_query(connection, sql, parameters, seconds):
+    """Called by TimedCursor after each statement"""
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile['count'] += 1
+        profile['total'] += seconds
+        if seconds >= profile['slowest_seconds']:
+            profile['slowest_seconds'] = seconds
+            profile['slowest'] = sql
+
+    if _slow_query_seconds is not None and seconds >= _slow_query_seconds:
+        plan = '\n    '.join(query_plan(connection, sql, parameters))
+        logger.warning(f'Slow query ({seconds * 1000:.1f} ms): {normalize(sql)}\n'
+                       f'  parameters: {parameter_shape(parameters)}\n  plan:\n    {plan}')
+
+
+def init_app(app):
+    """Apply SLOW_QUERY_MS and serve SQL_PROFILE_HEADER summaries for the app"""
+    global _slow_query_seconds
+    slow_query_ms = app.config.get('SLOW_QUERY_MS')
+    _slow_query_seconds = None if slow_query_ms is None else slow_query_ms / 1000
+    # Module loggers have no handlers of their own; log slow queries to the app log
+    for handler in app.logger.handlers:
+        if handler not in logger.handlers:
+            logger.addHandler(handler)
+
+    header = app.config.get('SQL_PROFILE_HEADER')
+    if not header:
+        return
+
+    @app.before_request
+    def start_profile():
+        _local.profile = None
+        if request.headers.get(header) and session.get('role') == 'admin':
+            _local.profile = {'count': 0, 'total': 0.0, 'slowest_seconds': 0.0, 'slowest': None}
+
+    @app.after_request
+    def attach_profile(response):
+        profile = getattr(_local, 'profile', None)
+        if profile is None:
+            return response
+        _local.profile = None
+        response.headers[header] = json.dumps({
+            'count': profile['count'],
+            'total_ms': round(profile['total'] * 1000, 3),
+            'slowest_ms': round(profile['slowest_seconds'] * 1000, 3),
+            'slowest': normalize(profile['slowest']) if profile['slowest'] else None,
+        }, ensure_ascii=True)
+        return response
@@ -0,0 +1,248 @@
+"""
+Background reaper for soft-deleted groups and projects.
+
+delete_group and delete_project only set deleted_at, which hides the data at
+once, and queue a 'pending' deletion_jobs row. A reaper thread then claims
+the job ('running') and deletes the images, notes and groups rows in batches
+of REAP_BATCH_SIZE, each committed on its own together with the job's
+progress. After each batch it unlinks the files no images row references any
+more (originals, thumbnails and variants) on a small thread pool. The files
+are first renamed aside and the references checked again under the write
+lock, so content an identical upload stored in the meantime is put back; the
+lock is never held while touching the filesystem. Files set aside by a
+process that died are unreferenced and left to sweeper.py.
+
+Any serving process may run a reaper, so a job is claimed with a conditional
+UPDATE; every batch renews the claim, and a claim older than
+REAP_LEASE_SECONDS (its process died) can be taken over. Deleting whatever
+rows remain is idempotent, so taken-over jobs and failed jobs, which are
+queued again on startup, simply run again.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from database import acquire_db, release_db
+from storage import content_key, unreferenced_images, image_files, unlink_files
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+REAP_BATCH_SIZE = 500
+UNLINK_WORKERS = 8
+# A running job whose progress is older than this is taken over; also how
+# often an idle reaper looks for such jobs
+REAP_LEASE_SECONDS = 300
+
+# Rows removed for each kind of job, children first: (table, column matched against target_id)
+REAP_PLANS = {
+    'group': [('images', 'group_id'), ('notes', 'group_id'), ('groups', 'id')],
+    'project': [('images', 'project_id'), ('notes', 'project_id'), ('groups', 'project_id'), ('projects', 'id')],
+}
+
+# Jobs nobody is working on: queued, or claimed by a process that stopped renewing its claim
+CLAIMABLE_CONDITION = f'''
+    (status = 'pending' OR (status = 'running' AND updated_at < datetime('now', '-{REAP_LEASE_SECONDS} seconds')))
+'''
+
+_wakeup = threading.Event()
+_thread = None
+_thread_pid = None
+_thread_lock = threading.Lock()
+
+
+def queue_deletion(cursor, kind, target_id):
+    """
+    Record a deletion job in the caller's transaction (after setting deleted_at).
+    Call wake() once it is committed. Returns the job id.
+    """
+    total = 0
+    for table, column in REAP_PLANS[kind]:
+        cursor.execute(f'SELECT COUNT(*) FROM {table} WHERE {column} = ?', (target_id,))
+        total += cursor.fetchone()[0]
+    cursor.execute("INSERT INTO deletion_jobs (kind, target_id, status, total_rows) VALUES (?, ?, 'pending', ?)",
+                   (kind, target_id, total))
+    return cursor.lastrowid
+
+
+def wake(app):
+    """Start this process's reaper thread if needed and have it look for jobs"""
+    global _thread, _thread_pid
+    with _thread_lock:
+        if _thread is None or _thread_pid != os.getpid() or not _thread.is_alive():
+            _thread = threading.Thread(target=run, args=(app.config['UPLOAD_FOLDER'],),
+                                       name='deletion-reaper', daemon=True)
+            _thread_pid = os.getpid()
+            _thread.start()
+    _wakeup.set()
+
+
+def run(upload_folder):
+    while True:
+        # Woken for new jobs; otherwise look for abandoned ones now and then
+        _wakeup.wait(REAP_LEASE_SECONDS)
+        _wakeup.clear()
+        try:
+            while True:
+                job = next_job()
+                if job is None:
+                    break
+                reap(upload_folder, job)
+        except Exception as e:
+            # e.g. the database is unavailable; retry on the next wake()
+            logger.error(f'Deletion reaper stopped: {e}')
+
+
+def next_job():
+    """Claim the oldest claimable job; None if there is none"""
+    conn = acquire_db()
+    try:
+        cursor = conn.cursor()
+        while True:
+            cursor.execute(f'SELECT id, kind, target_id FROM deletion_jobs WHERE {CLAIMABLE_CONDITION} ORDER BY id LIMIT 1')
+            row = cursor.fetchone()
+            if not row:
+                return None
+            # Another process may claim the same job between the SELECT and here
+            cursor.execute(f'''
+                UPDATE deletion_jobs SET status = 'running', updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND {CLAIMABLE_CONDITION}
+            ''', (row['id'],))
+            conn.commit()
+            if cursor.rowcount:
+                return dict(row)
+    finally:
+        release_db(conn)
+
+
+def reap_batch(cursor, table, column, target_id):
+    """Delete one batch of rows. Returns (rows deleted, deleted images rows)."""
+    if table != 'images':
+        cursor.execute(f'''
+            DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {column} = ? LIMIT ?)
+        ''', (target_id, REAP_BATCH_SIZE))
+        return cursor.rowcount, []
+
+    cursor.execute(f'''
+        SELECT id, filename, variants, content_hash FROM images WHERE {column} = ? LIMIT ?
+    ''', (target_id, REAP_BATCH_SIZE))
+    images = cursor.fetchall()
+    if not images:
+        return 0, []
+    placeholders = ','.join('?' * len(images))
+    cursor.execute(f'DELETE FROM images WHERE id IN ({placeholders})', [img['id'] for img in images])
+    return len(images), images
+
+
+def unreferenced_now(conn, images):
+    """unreferenced_images under the write lock, so uploads still being stored are waited for"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        unreferenced = unreferenced_images(conn.cursor(), images)
+    finally:
+        conn.rollback()
+    return unreferenced
+
+
+def set_aside(upload_folder, name, suffix):
+    """Rename a file out of the way; returns its new name, or None if it is gone"""
+    path = os.path.join(upload_folder, name)
+    try:
+        os.rename(path, path + suffix)
+    except FileNotFoundError:
+        return None  # Never written, or removed by another worker
+    return name + suffix
+
+
+def put_back(upload_folder, name, moved_name):
+    try:
+        os.replace(os.path.join(upload_folder, moved_name), os.path.join(upload_folder, name))
+    except FileNotFoundError:
+        pass  # Swept meanwhile; the new upload's own file (if any) stays
+
+
+def release_files(conn, unlinker, upload_folder, job_id, images):
+    """
+    Unlink the files of committed-away images rows that nothing references.
+    store_upload may store the same content again once the rows are gone, so
+    the files are renamed aside first and only unlinked if the references
+    checked afterwards are still gone; otherwise they are put back (the bytes
+    are identical). Returns the number of files unlinked.
+    """
+    suffix = f'.reaping-{os.getpid()}-{job_id}'
+    files = [(content_key(img), name) for img in unreferenced_now(conn, images)
+             for name in image_files(img['filename'], img['variants'])]
+    moved = unlinker.map(lambda file: set_aside(upload_folder, file[1], suffix), files)
+    aside = [(key, name, moved_name) for (key, name), moved_name in zip(files, moved) if moved_name]
+
+    # Uploads stored since the first check wanted some of this content back
+    unreferenced = {content_key(img) for img in unreferenced_now(conn, images)}
+    for key, name, moved_name in aside:
+        if key not in unreferenced:
+            put_back(upload_folder, name, moved_name)
+    doomed = [moved_name for key, _, moved_name in aside if key in unreferenced]
+    list(unlinker.map(lambda name: unlink_files(upload_folder, [name]), doomed))
+    removed = len(doomed)
+
+    conn.execute('UPDATE deletion_jobs SET removed_files = removed_files + ? WHERE id = ?', (removed, job_id))
+    conn.commit()
+    return removed
+
+
+def reap(upload_folder, job):
+    """Remove a claimed job's rows batch by batch and unlink their files, recording progress"""
+    conn = acquire_db()
+    try:
+        cursor = conn.cursor()
+        with ThreadPoolExecutor(max_workers=UNLINK_WORKERS) as unlinker:
+            for table, column in REAP_PLANS[job['kind']]:
+                while True:
+                    removed, images = reap_batch(cursor, table, column, job['target_id'])
+                    cursor.execute('''
+                        UPDATE deletion_jobs
+                        SET removed_rows = removed_rows + ?, updated_at = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (removed, job['id']))
+                    conn.commit()
+                    # Files go only after their rows are committed away
+                    if images:
+                        release_files(conn, unlinker, upload_folder, job['id'], images)
+                    if removed < REAP_BATCH_SIZE:
+                        break
+
+        cursor.execute('''
+            UPDATE deletion_jobs SET status = 'done', error = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (job['id'],))
+        conn.commit()
+        logger.info(f'Deletion job {job["id"]} ({job["kind"]} {job["target_id"]}) finished')
+    except Exception as e:
+        conn.rollback()
+        logger.error(f'Deletion job {job["id"]} failed: {e}')
+        conn.execute('''
+            UPDATE deletion_jobs SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (str(e), job['id']))
+        conn.commit()
+    finally:
+        release_db(conn)
+
+
+def resume_deletions(app):
+    """
+    Queue failed jobs again and start the reaper, which also picks up jobs a
+    previous process left unfinished. Call in one process per deployment.
+    """
+    conn = acquire_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE deletion_jobs SET status = 'pending' WHERE status = 'failed'")
+        retried = cursor.rowcount
+        conn.commit()
+        cursor.execute("SELECT COUNT(*) FROM deletion_jobs WHERE status IN ('pending', 'running')")
+        pending = cursor.fetchone()[0]
+    finally:
+        release_db(conn)
+
+    if retried:
+        app.logger.info(f'Retrying {retried} failed deletion jobs')
+    if pending:
+        app.logger.info(f'Resuming {pending} deletion jobs')
+    wake(app)
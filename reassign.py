@@ -0,0 +1,144 @@
+"""
+Background team reassignment.
+
+Moving users to another team rewrites team_id on all of their groups, notes
+and images. Instead of one long transaction that blocks every other writer,
+each table is walked in rowid windows of REASSIGN_BATCH_SIZE rows, and the
+job's rows in a window are moved in a transaction of their own together with
+the job's progress in team_reassignments, including the last rowid passed in
+each table. No window is visited twice, and a job resumed after a restart
+continues after the last committed window. users.team_id is switched up
+front and every window moves rows to the user's *current* team, so running
+a job again is harmless and a newer job for the same user wins.
+"""
+from database import acquire_db, release_db
+import cache
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+REASSIGN_TABLES = ['groups', 'notes', 'images']
+# Rows per rowid window, i.e. at most this many rows are moved per transaction
+REASSIGN_BATCH_SIZE = 5000
+
+# Rows of a user not yet in the user's current team; served by the
+# (user_id, team_id, ...) indexes of each table
+PENDING_CONDITION = 'user_id = ? AND team_id IS NOT (SELECT team_id FROM users WHERE id = ?)'
+
+
+def start_reassignment(user_ids, team_id):
+    """
+    Switch users to team_id (None removes them from their team) and move their
+    existing data in a background thread. Returns the job id.
+    """
+    conn = acquire_db()
+    try:
+        cursor = conn.cursor()
+        placeholders = ','.join('?' * len(user_ids))
+        cursor.execute(f'UPDATE users SET team_id = ? WHERE id IN ({placeholders})', [team_id] + user_ids)
+
+        total = 0
+        for user_id in user_ids:
+            for table in REASSIGN_TABLES:
+                cursor.execute(f'SELECT COUNT(*) FROM {table} WHERE {PENDING_CONDITION}', (user_id, user_id))
+                total += cursor.fetchone()[0]
+
+        cursor.execute('INSERT INTO team_reassignments (user_ids, team_id, total_rows) VALUES (?, ?, ?)',
+                       (json.dumps(user_ids), team_id, total))
+        job_id = cursor.lastrowid
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db(conn)
+
+    for user_id in user_ids:
+        cache.invalidate('user_info', user_id)
+    run_in_background(job_id)
+    return job_id
+
+
+def run_in_background(job_id):
+    thread = threading.Thread(target=run_reassignment, args=(job_id,), name=f'team-reassignment-{job_id}', daemon=True)
+    thread.start()
+    return thread
+
+
+def run_reassignment(job_id):
+    """Move the job's remaining rows window by window, recording progress after each window"""
+    conn = acquire_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_ids, last_rowids FROM team_reassignments WHERE id = ?', (job_id,))
+        job = cursor.fetchone()
+        if not job:
+            return
+
+        user_ids = json.loads(job['user_ids'])
+        last_rowids = json.loads(job['last_rowids'] or '{}')
+        placeholders = ','.join('?' * len(user_ids))
+        for table in REASSIGN_TABLES:
+            while True:
+                last_rowid = last_rowids.get(table, 0)
+                cursor.execute(f'''
+                    SELECT MAX(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)
+                ''', (last_rowid, REASSIGN_BATCH_SIZE))
+                end_rowid = cursor.fetchone()[0]
+                if end_rowid is None:
+                    break
+                cursor.execute(f'''
+                    UPDATE {table} SET team_id = (SELECT team_id FROM users WHERE id = {table}.user_id)
+                    WHERE rowid > ? AND rowid <= ? AND user_id IN ({placeholders})
+                      AND team_id IS NOT (SELECT team_id FROM users WHERE id = {table}.user_id)
+                ''', [last_rowid, end_rowid] + user_ids)
+                moved = cursor.rowcount
+                last_rowids[table] = end_rowid
+                cursor.execute('''
+                    UPDATE team_reassignments
+                    SET moved_rows = moved_rows + ?, last_rowids = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (moved, json.dumps(last_rowids), job_id))
+                conn.commit()
+
+        cursor.execute('''
+            UPDATE team_reassignments SET status = 'done', updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (job_id,))
+        conn.commit()
+        logger.info(f'Team reassignment {job_id} finished')
+    except Exception as e:
+        conn.rollback()
+        logger.error(f'Team reassignment {job_id} failed: {e}')
+        conn.execute('''
+            UPDATE team_reassignments SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (str(e), job_id))
+        conn.commit()
+    finally:
+        release_db(conn)
+
+
+def get_reassignment(cursor, job_id):
+    cursor.execute('SELECT * FROM team_reassignments WHERE id = ?', (job_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    job = dict(row)
+    job['user_ids'] = json.loads(job['user_ids'])
+    return job
+
+
+def resume_reassignments(app):
+    """Restart jobs left 'running' by a previous process"""
+    conn = acquire_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM team_reassignments WHERE status = 'running'")
+        job_ids = [row['id'] for row in cursor.fetchall()]
+    finally:
+        release_db(conn)
+
+    for job_id in job_ids:
+        app.logger.info(f'Resuming team reassignment {job_id}')
+        run_in_background(job_id)
@@ -1,9 +1,17 @@
-from flask import Blueprint, jsonify, request, session, current_app
+from flask import Blueprint, jsonify, request, session, current_app, Response
 from database import get_db
 from utils import admin_required, login_required
+from reassign import start_reassignment, get_reassignment
+from reaper import queue_deletion, wake
+import cache
+import hmac
+import metrics
 
 admin_bp = Blueprint('admin', __name__)
 
+# Users per bulk team assignment (bounded by SQLite's host-parameter limit)
+REASSIGN_MAX_USERS = 500
+
 @admin_bp.route('/users', methods=['GET'])
 @admin_required
 def get_all_users():
@@ -47,6 +55,7 @@ def approve_user(user_id):
     ''', (user_id,))
     conn.commit()
     affected = cursor.rowcount
+    cache.invalidate('user_info', user_id)
     
     if affected:
         current_app.logger.info(f'Admin approved user id: {user_id}')
@@ -67,6 +76,7 @@ def reject_user(user_id):
     ''', (user_id,))
     conn.commit()
     affected = cursor.rowcount
+    cache.invalidate('user_info', user_id)
     
     if affected:
         current_app.logger.info(f'Admin rejected user id: {user_id}')
@@ -75,13 +85,8 @@ def reject_user(user_id):
         current_app.logger.warning(f'Admin failed to reject user id: {user_id} (not found or not pending)')
         return jsonify({'error': '用户不存在或已审核'}), 400
 
-@admin_bp.route('/users/<int:user_id>/team', methods=['PUT'])
-@admin_required
-def assign_user_team(user_id):
-    """Assign user to a team (admin only) and migrate their existing notes/groups"""
-    data = request.get_json()
-    team_id = data.get('team_id')  # Can be null to remove from team
-    
+def reassign_users(user_ids, team_id):
+    """Validate the target team and start moving the users' data to it, returns a response"""
     conn = get_db()
     cursor = conn.cursor()
     
@@ -91,22 +96,42 @@ def assign_user_team(user_id):
         if not cursor.fetchone():
             return jsonify({'error': '用户组不存在'}), 400
     
-    # Update user's team
-    cursor.execute('UPDATE users SET team_id = ? WHERE id = ?', (team_id, user_id))
+    # Groups, notes and images follow in committed batches (see reassign.py)
+    job_id = start_reassignment(user_ids, team_id)
     
-    # Migrate user's existing groups to the new team
-    cursor.execute('UPDATE groups SET team_id = ? WHERE user_id = ?', (team_id, user_id))
-    
-    # Migrate user's existing notes to the new team
-    cursor.execute('UPDATE notes SET team_id = ? WHERE user_id = ?', (team_id, user_id))
-    
-    # Migrate user's existing images to the new team
-    cursor.execute('UPDATE images SET team_id = ? WHERE user_id = ?', (team_id, user_id))
-    
-    conn.commit()
+    current_app.logger.info(f'Admin assigned users {user_ids} to team {team_id if team_id else "None"} (job {job_id})')
+    return jsonify({'message': '用户组分配成功，正在迁移用户的历史笔记和品类', 'job_id': job_id}), 202
+
+@admin_bp.route('/users/<int:user_id>/team', methods=['PUT'])
+@admin_required
+def assign_user_team(user_id):
+    """Assign user to a team (admin only) and migrate their existing notes/groups"""
+    data = request.get_json()
+    team_id = data.get('team_id')  # Can be null to remove from team
+    return reassign_users([user_id], team_id)
+
+@admin_bp.route('/users/team', methods=['PUT'])
+@admin_required
+def assign_users_team():
+    """Assign several users to a team (admin only), e.g. {"user_ids": [2, 3], "team_id": 1}"""
+    data = request.get_json()
+    user_ids = data.get('user_ids')
+    team_id = data.get('team_id')
     
-    current_app.logger.info(f'Admin assigned user {user_id} to team {team_id if team_id else "None"}')
-    return jsonify({'message': '用户组分配成功，已迁移用户的历史笔记和品类'})
+    if not user_ids or not isinstance(user_ids, list) or not all(isinstance(i, int) for i in user_ids):
+        return jsonify({'error': '请选择用户'}), 400
+    if len(user_ids) > REASSIGN_MAX_USERS:
+        return jsonify({'error': f'一次最多分配{REASSIGN_MAX_USERS}个用户'}), 400
+    return reassign_users(sorted(set(user_ids)), team_id)
+
+@admin_bp.route('/reassignments/<int:job_id>', methods=['GET'])
+@admin_required
+def get_reassignment_progress(job_id):
+    """Progress of a team reassignment: status ('running', 'done', 'failed'), moved_rows of total_rows"""
+    job = get_reassignment(get_db().cursor(), job_id)
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job)
 
 @admin_bp.route('/users/<int:user_id>', methods=['DELETE'])
 @admin_required
@@ -128,6 +153,7 @@ def delete_user(user_id):
     
     cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
     conn.commit()
+    cache.invalidate('user_info', user_id)
     
     current_app.logger.info(f'Admin deleted user: {user_id}')
     return jsonify({'message': '用户已删除'})
@@ -180,6 +206,8 @@ def update_user_team(team_id):
     cursor = conn.cursor()
     cursor.execute('UPDATE user_teams SET name = ? WHERE id = ?', (name, team_id))
     conn.commit()
+    # Team names are part of every member's cached user info
+    cache.invalidate('user_info')
     
     return jsonify({'message': '用户组更新成功'})
 
@@ -196,6 +224,7 @@ def delete_user_team(team_id):
     # Delete the team
     cursor.execute('DELETE FROM user_teams WHERE id = ?', (team_id,))
     conn.commit()
+    cache.invalidate('user_info')
     
     return jsonify({'message': '用户组已删除'})
 
@@ -211,8 +240,9 @@ def get_projects():
                COUNT(DISTINCT g.id) as group_count,
                COUNT(DISTINCT n.id) as note_count
         FROM projects p
-        LEFT JOIN groups g ON g.project_id = p.id
-        LEFT JOIN notes n ON n.project_id = p.id
+        LEFT JOIN groups g ON g.project_id = p.id AND g.deleted_at IS NULL
+        LEFT JOIN notes n ON n.project_id = p.id AND n.group_id = g.id
+        WHERE p.deleted_at IS NULL
         GROUP BY p.id
         ORDER BY p.created_at DESC
     ''')
@@ -233,17 +263,28 @@ def create_project():
     conn = get_db()
     cursor = conn.cursor()
 
-    cursor.execute('SELECT id FROM projects WHERE name = ?', (name,))
+    cursor.execute('SELECT id FROM projects WHERE name = ? AND deleted_at IS NULL', (name,))
     if cursor.fetchone():
         return jsonify({'error': '项目名称已存在'}), 400
 
+    release_project_name(cursor, name)
     cursor.execute('INSERT INTO projects (name) VALUES (?)', (name,))
     conn.commit()
     project_id = cursor.lastrowid
+    # The new project may be the default one ('种植')
+    cache.invalidate('default_project')
 
     return jsonify({'id': project_id, 'name': name, 'message': '项目创建成功'})
 
 
+def release_project_name(cursor, name):
+    """Rename a soft-deleted project still holding `name` (names are unique) until it is reaped"""
+    cursor.execute('''
+        UPDATE projects SET name = name || ' #deleted-' || id
+        WHERE name = ? AND deleted_at IS NOT NULL
+    ''', (name,))
+
+
 @admin_bp.route('/projects/<int:project_id>', methods=['PUT'])
 @admin_required
 def update_project(project_id):
@@ -257,51 +298,93 @@ def update_project(project_id):
     conn = get_db()
     cursor = conn.cursor()
 
-    cursor.execute('SELECT id FROM projects WHERE id = ?', (project_id,))
+    cursor.execute('SELECT id FROM projects WHERE id = ? AND deleted_at IS NULL', (project_id,))
     if not cursor.fetchone():
         return jsonify({'error': '项目不存在'}), 404
 
-    cursor.execute('SELECT id FROM projects WHERE name = ? AND id != ?', (name, project_id))
+    cursor.execute('SELECT id FROM projects WHERE name = ? AND id != ? AND deleted_at IS NULL', (name, project_id))
     if cursor.fetchone():
         return jsonify({'error': '项目名称已存在'}), 400
 
+    release_project_name(cursor, name)
     cursor.execute('UPDATE projects SET name = ? WHERE id = ?', (name, project_id))
     conn.commit()
+    cache.invalidate('project', project_id)
+    cache.invalidate('default_project')
     return jsonify({'message': '项目更新成功'})
 
 
 @admin_bp.route('/projects/<int:project_id>', methods=['DELETE'])
 @admin_required
 def delete_project(project_id):
-    """Delete project (admin only)"""
+    """
+    Delete project with all its groups/notes/images (admin only). The project
+    is hidden at once; its rows and files are removed by the background reaper.
+    """
     conn = get_db()
     cursor = conn.cursor()
 
-    cursor.execute('SELECT id, name FROM projects WHERE id = ?', (project_id,))
+    cursor.execute('SELECT id, name FROM projects WHERE id = ? AND deleted_at IS NULL', (project_id,))
     project = cursor.fetchone()
     if not project:
         return jsonify({'error': '项目不存在'}), 404
 
-    cursor.execute('SELECT COUNT(*) as count FROM projects')
+    cursor.execute('SELECT COUNT(*) as count FROM projects WHERE deleted_at IS NULL')
     total_projects = cursor.fetchone()['count']
     if total_projects <= 1:
         return jsonify({'error': '至少保留一个项目'}), 400
 
-    cursor.execute('SELECT COUNT(*) as count FROM groups WHERE project_id = ?', (project_id,))
-    group_count = cursor.fetchone()['count']
-    cursor.execute('SELECT COUNT(*) as count FROM notes WHERE project_id = ?', (project_id,))
-    note_count = cursor.fetchone()['count']
-    if group_count > 0 or note_count > 0:
-        return jsonify({'error': '该项目下仍有品类或笔记，无法删除'}), 400
-
-    cursor.execute('DELETE FROM projects WHERE id = ?', (project_id,))
+    cursor.execute('UPDATE projects SET deleted_at = CURRENT_TIMESTAMP WHERE id = ?', (project_id,))
+    cursor.execute('UPDATE groups SET deleted_at = CURRENT_TIMESTAMP WHERE project_id = ? AND deleted_at IS NULL',
+                   (project_id,))
     cursor.execute('''
         UPDATE users
-        SET current_project_id = (SELECT id FROM projects ORDER BY id ASC LIMIT 1)
+        SET current_project_id = (SELECT id FROM projects WHERE deleted_at IS NULL ORDER BY id ASC LIMIT 1)
         WHERE current_project_id = ?
     ''', (project_id,))
+    job_id = queue_deletion(cursor, 'project', project_id)
     conn.commit()
+    wake(current_app._get_current_object())
+    cache.invalidate('project', project_id)
+    cache.invalidate('default_project')
 
-    return jsonify({'message': '项目已删除'})
+    current_app.logger.info(f'Admin deleted project {project_id} ({project["name"]}, job {job_id})')
+    return jsonify({'message': '项目已删除', 'job_id': job_id})
 
 
+@admin_bp.route('/deletions', methods=['GET'])
+@admin_required
+def get_deletions():
+    """Recent group/project deletion jobs, newest first"""
+    cursor = get_db().cursor()
+    cursor.execute('SELECT * FROM deletion_jobs ORDER BY id DESC LIMIT 50')
+    return jsonify([dict(row) for row in cursor.fetchall()])
+
+
+@admin_bp.route('/deletions/<int:job_id>', methods=['GET'])
+@admin_required
+def get_deletion_progress(job_id):
+    """Progress of a deletion job: status ('pending', 'running', 'done', 'failed'), removed_rows of total_rows, removed_files"""
+    cursor = get_db().cursor()
+    cursor.execute('SELECT * FROM deletion_jobs WHERE id = ?', (job_id,))
+    job = cursor.fetchone()
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(dict(job))
+
+
+@admin_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Request, SQL and image processing metrics in the Prometheus text format,
+    summed over all workers when METRICS_DIR is set. Scrapers authenticate
+    with "Authorization: Bearer <METRICS_TOKEN>", people with an admin session.
+    """
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return render_metrics()
+    return admin_required(render_metrics)()
+
+
+def render_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
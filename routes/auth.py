@@ -1,21 +1,11 @@
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash, current_app, jsonify
 from werkzeug.security import generate_password_hash, check_password_hash
-from database import get_db
+from database import get_db, cached_default_project_id
 from utils import login_required
 import sqlite3
 
 auth_bp = Blueprint('auth', __name__)
 
-def get_default_project_id(cursor):
-    """Get default project id (legacy data belongs to '种植')."""
-    cursor.execute('SELECT id FROM projects WHERE name = ?', ('种植',))
-    project = cursor.fetchone()
-    if project:
-        return project['id']
-    cursor.execute('SELECT id FROM projects ORDER BY id ASC LIMIT 1')
-    project = cursor.fetchone()
-    return project['id'] if project else None
-
 @auth_bp.route('/')
 def index():
     """Redirect to main page or login"""
@@ -50,7 +40,7 @@ def login():
             session['username'] = user['username']
             session['role'] = user['role']
             session['team_id'] = user['team_id']
-            default_project_id = get_default_project_id(cursor)
+            default_project_id = cached_default_project_id(cursor)
             current_project_id = user['current_project_id'] if user['current_project_id'] else default_project_id
             session['current_project_id'] = current_project_id
 
@@ -88,7 +78,7 @@ def register():
         
         try:
             password_hash = generate_password_hash(password)
-            default_project_id = get_default_project_id(cursor)
+            default_project_id = cached_default_project_id(cursor)
             # New users start with 'pending' status
             cursor.execute('''
                 INSERT INTO users (username, password_hash, role, status, current_project_id)
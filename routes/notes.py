@@ -1,13 +1,50 @@
-from flask import Blueprint, jsonify, request, session, current_app
-from database import get_db
-from utils import login_required, get_user_team_id, get_current_project_id, allowed_file, convert_to_progressive_jpeg, create_thumbnail
+from flask import Blueprint, jsonify, request, session, current_app, Response, stream_with_context, send_from_directory
+from database import get_db, acquire_db, release_db, scope_key, get_data_version, PROJECTS_SCOPE
+from utils import login_required, get_user_team_id, get_current_project_id, get_user_upload_folder, allowed_file, thumbnail_path
+from routes.upload import redeem_upload_token
+from jobs import enqueue_images
+from reaper import queue_deletion, wake
+from storage import resolve_upload, store_upload, release_images, image_files
 from werkzeug.utils import secure_filename
 from datetime import datetime
 import os
 import json
+import base64
+import cache
+import mimetypes
+import html
+import re
 
 notes_bp = Blueprint('notes', __name__)
 
+
+def data_etag(cursor, scope, *parts):
+    """
+    Weak ETag of a listing: the scope's version counter plus request-specific
+    parts. Read it before the main query, so a concurrent write can only make
+    the tag older than the data, never newer.
+    """
+    return ':'.join(str(part) for part in (scope, get_data_version(cursor, scope)) + parts)
+
+
+def current_scope():
+    return scope_key(get_user_team_id(), session['user_id'], get_current_project_id())
+
+
+def not_modified(etag):
+    """A 304 response if the request's If-None-Match matches etag, else None"""
+    if request.if_none_match.contains_weak(etag):
+        return revalidate(Response(status=304), etag)
+    return None
+
+
+def revalidate(response, etag):
+    """Let the browser cache a listing privately but revalidate it on every use"""
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
 # ============ Note Group API Routes ============
 
 @notes_bp.route('/groups', methods=['GET'])
@@ -20,23 +57,28 @@ def get_groups():
     team_id = get_user_team_id()
     project_id = get_current_project_id()
     
+    etag = data_etag(cursor, current_scope(), 'groups')
+    response = not_modified(etag)
+    if response:
+        return response
+    
     if team_id:
         # Get groups shared within team
         cursor.execute('''
             SELECT * FROM groups 
-            WHERE team_id = ? AND project_id = ?
+            WHERE team_id = ? AND project_id = ? AND deleted_at IS NULL
             ORDER BY created_at DESC
         ''', (team_id, project_id))
     else:
         # User not in a team, get only their own groups
         cursor.execute('''
             SELECT * FROM groups 
-            WHERE user_id = ? AND team_id IS NULL AND project_id = ?
+            WHERE user_id = ? AND team_id IS NULL AND project_id = ? AND deleted_at IS NULL
             ORDER BY created_at DESC
         ''', (session['user_id'], project_id))
     
     groups = [dict(row) for row in cursor.fetchall()]
-    return jsonify(groups)
+    return revalidate(jsonify(groups), etag)
 
 
 @notes_bp.route('/groups', methods=['POST'])
@@ -55,11 +97,18 @@ def create_group():
     conn = get_db()
     cursor = conn.cursor()
     
+    # The session may still point at a project deleted since
+    cursor.execute('SELECT id FROM projects WHERE id = ? AND deleted_at IS NULL', (project_id,))
+    if not cursor.fetchone():
+        return jsonify({'error': '项目不存在'}), 404
+    
     # Check if group name already exists
     if team_id:
-        cursor.execute('SELECT id FROM groups WHERE name = ? AND team_id = ? AND project_id = ?', (name, team_id, project_id))
+        cursor.execute('SELECT id FROM groups WHERE name = ? AND team_id = ? AND project_id = ? AND deleted_at IS NULL',
+                       (name, team_id, project_id))
     else:
-        cursor.execute('SELECT id FROM groups WHERE name = ? AND user_id = ? AND team_id IS NULL AND project_id = ?', (name, session['user_id'], project_id))
+        cursor.execute('SELECT id FROM groups WHERE name = ? AND user_id = ? AND team_id IS NULL AND project_id = ? AND deleted_at IS NULL',
+                       (name, session['user_id'], project_id))
         
     if cursor.fetchone():
         return jsonify({'error': '该品类名称已存在，请使用其他名称'}), 400
@@ -94,12 +143,12 @@ def update_group(group_id):
     if team_id:
         cursor.execute('''
             UPDATE groups SET name = ? 
-            WHERE id = ? AND team_id = ? AND project_id = ?
+            WHERE id = ? AND team_id = ? AND project_id = ? AND deleted_at IS NULL
         ''', (name, group_id, team_id, project_id))
     else:
         cursor.execute('''
             UPDATE groups SET name = ? 
-            WHERE id = ? AND user_id = ? AND team_id IS NULL AND project_id = ?
+            WHERE id = ? AND user_id = ? AND team_id IS NULL AND project_id = ? AND deleted_at IS NULL
         ''', (name, group_id, session['user_id'], project_id))
     
     conn.commit()
@@ -110,133 +159,577 @@ def update_group(group_id):
 @notes_bp.route('/groups/<int:group_id>', methods=['DELETE'])
 @login_required
 def delete_group(group_id):
-    """Delete a group and all its notes/images"""
+    """
+    Delete a group and all its notes/images. The group is hidden at once; its
+    rows and files are removed by the background reaper.
+    """
     team_id = get_user_team_id()
     project_id = get_current_project_id()
     
     conn = get_db()
     cursor = conn.cursor()
     
-    # Get all images in this group to delete files
     if team_id:
         cursor.execute('''
-            SELECT filename FROM images 
-            WHERE group_id = ? AND team_id = ? AND project_id = ?
+            UPDATE groups SET deleted_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND team_id = ? AND project_id = ? AND deleted_at IS NULL
         ''', (group_id, team_id, project_id))
     else:
         cursor.execute('''
-            SELECT filename FROM images 
-            WHERE group_id = ? AND user_id = ? AND team_id IS NULL AND project_id = ?
+            UPDATE groups SET deleted_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND user_id = ? AND team_id IS NULL AND project_id = ? AND deleted_at IS NULL
         ''', (group_id, session['user_id'], project_id))
     
-    images = cursor.fetchall()
+    job_id = None
+    if cursor.rowcount:
+        job_id = queue_deletion(cursor, 'group', group_id)
+    conn.commit()
+    if job_id:
+        wake(current_app._get_current_object())
+    
+    current_app.logger.info(f'User {session["user_id"]} deleted group: {group_id} (team: {team_id}, job: {job_id})')
+    return jsonify({'message': '品类删除成功', 'job_id': job_id})
+
+
+# ============ Note API Routes ============
+
+# SQLite's default host-parameter limit is 999 on older builds; stay below it.
+IMAGE_BATCH_SIZE = 900
+
+# Notes are serialized and streamed in batches of this size
+NOTES_STREAM_BATCH = 100
+# Upper bound for the `limit` parameter of a paginated notes listing
+NOTES_PAGE_MAX = 200
+
+# The trigram full-text index only matches terms of at least three characters;
+# shorter terms are matched with LIKE on the scoped notes
+FTS_MIN_TERM_LENGTH = 3
+SEARCH_MAX_TERMS = 8
+SEARCH_PAGE_DEFAULT = 20
+
+
+def image_dict(row):
+    """Serialize an images row, adding its thumbnail path and decoded variants"""
+    img = dict(row)
+    img['thumbnail'] = thumbnail_path(img['filename'])
+    if 'variants' in img:
+        img['variants'] = json.loads(img['variants']) if img['variants'] else []
+    return img
+
+
+def attach_note_images(cursor, notes, project_id):
+    """Load images for all notes with batched IN queries and attach them as note['images']"""
+    images_by_note = {note['id']: [] for note in notes}
+    note_ids = list(images_by_note)
+    
+    for start in range(0, len(note_ids), IMAGE_BATCH_SIZE):
+        batch = note_ids[start:start + IMAGE_BATCH_SIZE]
+        placeholders = ','.join('?' * len(batch))
+        cursor.execute(f'''
+            SELECT id, filename, original_filename, status, variants, note_id
+            FROM images 
+            WHERE note_id IN ({placeholders}) AND project_id = ?
+            ORDER BY note_id, created_at ASC
+        ''', batch + [project_id])
+        for img_row in cursor.fetchall():
+            img = image_dict(img_row)
+            note_id = img.pop('note_id')
+            images_by_note[note_id].append(img)
     
-    # Delete image files
-    for img in images:
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], img['filename'])
-        if os.path.exists(filepath):
-            os.remove(filepath)
+    for note in notes:
+        note['images'] = images_by_note[note['id']]
+    return notes
+
+
+def encode_note_cursor(note):
+    """Encode the (date, created_at, id) keyset position of a note as an opaque cursor"""
+    raw = json.dumps([note['date'], note['created_at'], note['id']])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def parse_date_arg(name):
+    """
+    Read an optional YYYY-MM-DD query parameter. Returns (value or None, error
+    response or None).
+    """
+    value = request.args.get(name)
+    if not value:
+        return None, None
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return None, (jsonify({'error': '无效的日期'}), 400)
+    return value, None
+
+
+def decode_note_cursor(cursor_value):
+    """
+    Decode a cursor produced by encode_note_cursor, returns None if malformed.
+    created_at is None for notes stored without one.
+    """
+    try:
+        date, created_at, note_id = json.loads(base64.urlsafe_b64decode(cursor_value.encode('ascii')))
+        return str(date), None if created_at is None else str(created_at), int(note_id)
+    except Exception:
+        return None
+
+
+def note_cursor_condition(position):
+    """
+    SQL condition and parameters for notes after `position` in
+    `date DESC, created_at DESC, id DESC` order. NULL created_at sorts after
+    every timestamp of the same date, and comparing with NULL matches nothing,
+    so those notes are matched explicitly.
+    """
+    date, created_at, note_id = position
+    if created_at is None:
+        return '(n.date < ? OR (n.date = ? AND n.created_at IS NULL AND n.id < ?))', [date, date, note_id]
+    return ('((n.date, n.created_at, n.id) < (?, ?, ?) OR (n.date = ? AND n.created_at IS NULL))',
+            [date, created_at, note_id, date])
+
+
+def stream_notes(cursor, project_id, limit=None):
+    """
+    Yield serialized notes from an executed notes query in batches of NOTES_STREAM_BATCH,
+    attaching images per batch so memory stays bounded by the batch size.
+    Yields (note_json, note) tuples; stops after `limit` notes if given.
+    """
+    emitted = 0
+    while limit is None or emitted < limit:
+        size = NOTES_STREAM_BATCH if limit is None else min(NOTES_STREAM_BATCH, limit - emitted)
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        notes = attach_note_images(cursor.connection.cursor(), [dict(row) for row in rows], project_id)
+        for note in notes:
+            yield current_app.json.dumps(note), note
+        emitted += len(notes)
+
+
+@notes_bp.route('/notes', methods=['GET'])
+@login_required
+def get_notes():
+    """
+    Get notes with their images, optionally filtered by group and by an
+    inclusive `from`/`to` date range (YYYY-MM-DD).
+    Without `limit` the full list is streamed as a JSON array. With `limit`
+    (and optional `after` cursor) one keyset page is streamed as
+    {"notes": [...], "next_cursor": "..."}.
+    """
+    group_id = request.args.get('group_id')
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after')
+    date_from, error = parse_date_arg('from')
+    if error:
+        return error
+    date_to, error = parse_date_arg('to')
+    if error:
+        return error
+    team_id = get_user_team_id()
+    project_id = get_current_project_id()
     
-    # Delete records from database
+    conditions = []
+    params = []
+    if group_id:
+        conditions.append('n.group_id = ?')
+        params.append(group_id)
     if team_id:
-        cursor.execute('DELETE FROM images WHERE group_id = ? AND team_id = ? AND project_id = ?',
-                      (group_id, team_id, project_id))
-        cursor.execute('DELETE FROM notes WHERE group_id = ? AND team_id = ? AND project_id = ?',
-                      (group_id, team_id, project_id))
-        cursor.execute('DELETE FROM groups WHERE id = ? AND team_id = ? AND project_id = ?',
-                      (group_id, team_id, project_id))
+        conditions.append('n.team_id = ? AND n.project_id = ?')
+        params.extend([team_id, project_id])
     else:
-        cursor.execute('DELETE FROM images WHERE group_id = ? AND user_id = ? AND team_id IS NULL AND project_id = ?',
-                      (group_id, session['user_id'], project_id))
-        cursor.execute('DELETE FROM notes WHERE group_id = ? AND user_id = ? AND team_id IS NULL AND project_id = ?',
-                      (group_id, session['user_id'], project_id))
-        cursor.execute('DELETE FROM groups WHERE id = ? AND user_id = ? AND team_id IS NULL AND project_id = ?',
-                      (group_id, session['user_id'], project_id))
+        conditions.append('n.user_id = ? AND n.team_id IS NULL AND n.project_id = ?')
+        params.extend([session['user_id'], project_id])
+    if date_from:
+        conditions.append('n.date >= ?')
+        params.append(date_from)
+    if date_to:
+        conditions.append('n.date <= ?')
+        params.append(date_to)
+    # Deleted groups stay in place until the reaper removes their notes
+    conditions.append('g.deleted_at IS NULL')
     
-    conn.commit()
+    if after:
+        position = decode_note_cursor(after)
+        if position is None:
+            return jsonify({'error': '无效的分页游标'}), 400
+        condition, condition_params = note_cursor_condition(position)
+        conditions.append(condition)
+        params.extend(condition_params)
+    
+    if limit is not None:
+        limit = max(1, min(limit, NOTES_PAGE_MAX))
+    
+    # The URL already distinguishes filters and pages; the tag adds the user's scope
+    etag = data_etag(get_db().cursor(), current_scope(), 'notes')
+    response = not_modified(etag)
+    if response:
+        return response
+    
+    query = f'''
+        SELECT n.*, g.name as group_name, u.username as author
+        FROM notes n 
+        JOIN groups g ON n.group_id = g.id 
+        LEFT JOIN users u ON n.user_id = u.id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY n.date DESC, n.created_at DESC, n.id DESC
+        {'LIMIT ?' if limit is not None else ''}
+    '''
+    if limit is not None:
+        params.append(limit + 1)
+    
+    # Rows are read lazily while the body streams (stream_with_context keeps
+    # the request context alive meanwhile). The generator holds its own pooled
+    # connection so the open cursor's lifetime is its own: released in its
+    # finally once the last row is sent or the client disconnects, and never
+    # shared with statements run on the request connection.
+    def generate_list(cursor):
+        yield '['
+        for index, (note_json, _) in enumerate(stream_notes(cursor, project_id)):
+            yield note_json if index == 0 else ',' + note_json
+        yield ']'
     
-    current_app.logger.info(f'User {session["user_id"]} deleted group: {group_id} (team: {team_id})')
-    return jsonify({'message': '品类删除成功'})
+    def generate_page(cursor):
+        yield '{"notes":['
+        last_note = None
+        for index, (note_json, note) in enumerate(stream_notes(cursor, project_id, limit)):
+            yield note_json if index == 0 else ',' + note_json
+            last_note = note
+        # The extra (limit + 1)th row only signals that another page exists
+        has_more = last_note is not None and cursor.fetchone() is not None
+        next_cursor = encode_note_cursor(last_note) if has_more else None
+        yield '],"next_cursor":' + json.dumps(next_cursor) + '}'
+    
+    def generate():
+        conn = acquire_db()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            yield from (generate_list(cursor) if limit is None else generate_page(cursor))
+        finally:
+            release_db(conn)
+    
+    return revalidate(Response(stream_with_context(generate()), mimetype='application/json'), etag)
 
 
-# ============ Note API Routes ============
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
 
-@notes_bp.route('/notes', methods=['GET'])
+
+def highlight_terms(text, terms):
+    """HTML-escape text and wrap every occurrence of a search term in <mark>"""
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    parts = []
+    last = 0
+    for match in pattern.finditer(text):
+        parts.append(html.escape(text[last:match.start()]))
+        parts.append('<mark>' + html.escape(match.group()) + '</mark>')
+        last = match.end()
+    parts.append(html.escape(text[last:]))
+    return ''.join(parts)
+
+
+@notes_bp.route('/notes/search', methods=['GET'])
 @login_required
-def get_notes():
-    """Get notes with their images, optionally filtered by group"""
+def search_notes():
+    """
+    Search note content, e.g. ?q=番茄 施肥&limit=20&offset=0 (optional group_id,
+    from and to).
+    Every whitespace-separated term must occur. Results are ranked by bm25
+    when a term is long enough for the full-text index, newest first otherwise.
+    Returns {"notes": [...], "next_offset": n or null}; each note has
+    `highlight`, its HTML-escaped content with matches wrapped in <mark>.
+    """
+    terms = request.args.get('q', '').split()[:SEARCH_MAX_TERMS]
+    if not terms:
+        return jsonify({'error': '请输入搜索内容'}), 400
+    
     group_id = request.args.get('group_id')
+    date_from, error = parse_date_arg('from')
+    if error:
+        return error
+    date_to, error = parse_date_arg('to')
+    if error:
+        return error
+    limit = max(1, min(request.args.get('limit', SEARCH_PAGE_DEFAULT, type=int), NOTES_PAGE_MAX))
+    offset = max(0, request.args.get('offset', 0, type=int))
     team_id = get_user_team_id()
     project_id = get_current_project_id()
     
+    conditions = []
+    params = []
+    if group_id:
+        conditions.append('n.group_id = ?')
+        params.append(group_id)
+    if team_id:
+        conditions.append('n.team_id = ? AND n.project_id = ?')
+        params.extend([team_id, project_id])
+    else:
+        conditions.append('n.user_id = ? AND n.team_id IS NULL AND n.project_id = ?')
+        params.extend([session['user_id'], project_id])
+    if date_from:
+        conditions.append('n.date >= ?')
+        params.append(date_from)
+    if date_to:
+        conditions.append('n.date <= ?')
+        params.append(date_to)
+    conditions.append('g.deleted_at IS NULL')
+    
+    for term in terms:
+        if len(term) < FTS_MIN_TERM_LENGTH:
+            conditions.append("n.content LIKE ? ESCAPE '\\'")
+            params.append(f'%{escape_like(term)}%')
+    
+    # Each term is quoted as an FTS5 string so operators in the input are literal
+    fts_terms = [term for term in terms if len(term) >= FTS_MIN_TERM_LENGTH]
+    if fts_terms:
+        match = ' '.join('"' + term.replace('"', '""') + '"' for term in fts_terms)
+        query = f'''
+            SELECT n.*, g.name as group_name, u.username as author
+            FROM notes_fts
+            JOIN notes n ON n.id = notes_fts.rowid
+            JOIN groups g ON n.group_id = g.id
+            LEFT JOIN users u ON n.user_id = u.id
+            WHERE notes_fts MATCH ? AND {' AND '.join(conditions)}
+            ORDER BY bm25(notes_fts), n.id DESC
+            LIMIT ? OFFSET ?
+        '''
+        params.insert(0, match)
+    else:
+        query = f'''
+            SELECT n.*, g.name as group_name, u.username as author
+            FROM notes n
+            JOIN groups g ON n.group_id = g.id
+            LEFT JOIN users u ON n.user_id = u.id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY n.date DESC, n.created_at DESC, n.id DESC
+            LIMIT ? OFFSET ?
+        '''
+    # One extra row tells whether another page exists
+    params.extend([limit + 1, offset])
+    
     conn = get_db()
     cursor = conn.cursor()
+    cursor.execute(query, params)
+    notes = [dict(row) for row in cursor.fetchall()]
+    
+    has_more = len(notes) > limit
+    notes = attach_note_images(cursor, notes[:limit], project_id)
+    for note in notes:
+        note['highlight'] = highlight_terms(note['content'] or '', terms)
+    
+    return jsonify({
+        'notes': notes,
+        'next_offset': offset + limit if has_more else None
+    })
+
+
+@notes_bp.route('/notes/calendar', methods=['GET'])
+@login_required
+def get_notes_calendar():
+    """
+    Note and image counts for one month (?month=YYYY-MM, default current month,
+    optional group_id), per day and per group:
+    {"month", "days": [{date, notes, images}], "groups": [{group_id, group_name, notes, images}],
+     "entries": [{date, group_id, notes, images}]}
+    """
+    month = request.args.get('month') or datetime.now().strftime('%Y-%m')
+    try:
+        start = datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        return jsonify({'error': '无效的月份'}), 400
+    end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    group_id = request.args.get('group_id')
+    team_id = get_user_team_id()
+    project_id = get_current_project_id()
     
+    # notes and images both carry date/group_id, so each count is a GROUP BY
+    # over a covering (scope, date, group_id) index in index order
     if team_id:
-        if group_id:
-            cursor.execute('''
-                SELECT n.*, g.name as group_name, u.username as author
-                FROM notes n 
-                JOIN groups g ON n.group_id = g.id 
-                LEFT JOIN users u ON n.user_id = u.id
-                WHERE n.group_id = ? AND n.team_id = ? AND n.project_id = ?
-                ORDER BY n.date DESC, n.created_at DESC
-            ''', (group_id, team_id, project_id))
-        else:
-            cursor.execute('''
-                SELECT n.*, g.name as group_name, u.username as author
-                FROM notes n 
-                JOIN groups g ON n.group_id = g.id 
-                LEFT JOIN users u ON n.user_id = u.id
-                WHERE n.team_id = ? AND n.project_id = ?
-                ORDER BY n.date DESC, n.created_at DESC
-            ''', (team_id, project_id))
+        conditions = ['team_id = ? AND project_id = ?']
+        params = [team_id, project_id]
     else:
-        if group_id:
-            cursor.execute('''
-                SELECT n.*, g.name as group_name, u.username as author
-                FROM notes n 
-                JOIN groups g ON n.group_id = g.id 
-                LEFT JOIN users u ON n.user_id = u.id
-                WHERE n.group_id = ? AND n.user_id = ? AND n.team_id IS NULL AND n.project_id = ?
-                ORDER BY n.date DESC, n.created_at DESC
-            ''', (group_id, session['user_id'], project_id))
-        else:
-            cursor.execute('''
-                SELECT n.*, g.name as group_name, u.username as author
-                FROM notes n 
-                JOIN groups g ON n.group_id = g.id 
-                LEFT JOIN users u ON n.user_id = u.id
-                WHERE n.user_id = ? AND n.team_id IS NULL AND n.project_id = ?
-                ORDER BY n.date DESC, n.created_at DESC
-            ''', (session['user_id'], project_id))
-    
-    notes = []
-    for row in cursor.fetchall():
-        note = dict(row)
-        # Get images for this note
+        conditions = ['user_id = ? AND team_id IS NULL AND project_id = ?']
+        params = [session['user_id'], project_id]
+    conditions.append('date >= ? AND date < ?')
+    params.extend([start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')])
+    if group_id:
+        conditions.append('group_id = ?')
+        params.append(group_id)
+    where = ' AND '.join(conditions)
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    entries = {}
+    for table in ('notes', 'images'):
+        cursor.execute(f'''
+            SELECT date, group_id, COUNT(*) AS count FROM {table}
+            WHERE {where}
+            GROUP BY date, group_id
+        ''', params)
+        for row in cursor.fetchall():
+            entry = entries.setdefault((row['date'], row['group_id']), {
+                'date': row['date'], 'group_id': row['group_id'], 'notes': 0, 'images': 0
+            })
+            entry[table] = row['count']
+    
+    # Rows of deleted groups are left out until the reaper removes them
+    group_names = {}
+    group_ids = {entry_group_id for _, entry_group_id in entries}
+    if group_ids:
+        placeholders = ','.join('?' * len(group_ids))
+        cursor.execute(f'SELECT id, name FROM groups WHERE id IN ({placeholders}) AND deleted_at IS NULL',
+                       list(group_ids))
+        group_names = {row['id']: row['name'] for row in cursor.fetchall()}
+    entries = {key: entry for key, entry in entries.items() if key[1] in group_names}
+    
+    days = {}
+    groups = {}
+    for (date, entry_group_id), entry in sorted(entries.items()):
+        day = days.setdefault(date, {'date': date, 'notes': 0, 'images': 0})
+        group = groups.setdefault(entry_group_id, {
+            'group_id': entry_group_id, 'group_name': group_names[entry_group_id], 'notes': 0, 'images': 0
+        })
+        for key in ('notes', 'images'):
+            day[key] += entry[key]
+            group[key] += entry[key]
+    
+    return jsonify({
+        'month': start.strftime('%Y-%m'),
+        'days': list(days.values()),
+        'groups': list(groups.values()),
+        'entries': [entries[key] for key in sorted(entries)]
+    })
+
+
+@notes_bp.route('/notes/<int:note_id>', methods=['GET'])
+@login_required
+def get_note(note_id):
+    """Get a single note with its images"""
+    team_id = get_user_team_id()
+    project_id = get_current_project_id()
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    if team_id:
         cursor.execute('''
-            SELECT id, filename, original_filename 
-            FROM images 
-            WHERE note_id = ? AND project_id = ?
-            ORDER BY created_at ASC
-        ''', (note['id'], project_id))
-        imgs = []
-        for img_row in cursor.fetchall():
-            img = dict(img_row)
-            # Add thumbnail path (assumes thumb_{filename} exists in same folder)
-            path = img['filename']
-            parts = path.split('/')
-            if len(parts) > 1:
-                parts[-1] = 'thumb_' + parts[-1]
-                img['thumbnail'] = '/'.join(parts)
-            else:
-                img['thumbnail'] = 'thumb_' + path
-            imgs.append(img)
-        note['images'] = imgs
-        notes.append(note)
-    
-    return jsonify(notes)
+            SELECT n.*, g.name as group_name, u.username as author
+            FROM notes n 
+            JOIN groups g ON n.group_id = g.id 
+            LEFT JOIN users u ON n.user_id = u.id
+            WHERE n.id = ? AND n.team_id = ? AND n.project_id = ? AND g.deleted_at IS NULL
+        ''', (note_id, team_id, project_id))
+    else:
+        cursor.execute('''
+            SELECT n.*, g.name as group_name, u.username as author
+            FROM notes n 
+            JOIN groups g ON n.group_id = g.id 
+            LEFT JOIN users u ON n.user_id = u.id
+            WHERE n.id = ? AND n.user_id = ? AND n.team_id IS NULL AND n.project_id = ? AND g.deleted_at IS NULL
+        ''', (note_id, session['user_id'], project_id))
+    
+    row = cursor.fetchone()
+    if not row:
+        return jsonify({'error': '笔记不存在或无权限'}), 403
+    
+    note = attach_note_images(cursor, [dict(row)], project_id)[0]
+    return jsonify(note)
+
+
+def save_uploaded_image(file):
+    """
+    Save an uploaded image as-is under the user's upload folder.
+    Conversion and thumbnailing happen later in the background (see jobs.py).
+    Returns (filename relative to UPLOAD_FOLDER, original_filename).
+    """
+    original_filename = secure_filename(file.filename) or 'image'
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    
+    # Create user directory if not exists
+    # Sanitize username for directory name security
+    username = get_user_upload_folder()
+    
+    user_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], username)
+    os.makedirs(user_folder, exist_ok=True)
+    
+    # Filename without path
+    name = f"{session['user_id']}_{timestamp}_{original_filename}"
+    file.save(os.path.join(user_folder, name))
+    
+    # Use forward slash for web URL compatibility
+    return f"{username}/{name}", original_filename
+
+
+def collect_uploads(uploaded_chunks, files):
+    """
+    Absolute paths of a note's new uploads as (filepath, original_filename):
+    files merged by /api/upload/merge, each claimed with the token it returned,
+    and standard multipart files, which are saved first. A merged file must
+    still sit in the caller's own folder and not belong to any image yet.
+    """
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    user_folder = get_user_upload_folder()
+    cursor = get_db().cursor()
+    uploads = []
+    
+    # Pre-uploaded chunked files; filename is relative path like "username/123_abc.jpg"
+    for chunk_file in uploaded_chunks:
+        if chunk_file and 'filename' in chunk_file:
+            filename = redeem_upload_token(chunk_file.get('token'))
+            filepath = None
+            if filename is not None and filename == chunk_file['filename']:
+                filepath = resolve_upload(upload_folder, user_folder, filename)
+            if filepath is not None:
+                cursor.execute('SELECT 1 FROM images WHERE filename = ? LIMIT 1', (filename,))
+                if cursor.fetchone():
+                    filepath = None
+            if filepath is None:
+                current_app.logger.warning(f'User {session["user_id"]} referenced unknown upload: {chunk_file["filename"]}')
+                continue
+            uploads.append((filepath, chunk_file.get('original_filename', 'image')))
+    
+    # Standard file uploads
+    for file in files:
+        if file and file.filename and allowed_file(file.filename):
+            filename, original_filename = save_uploaded_image(file)
+            uploads.append((os.path.join(upload_folder, filename), original_filename))
+    
+    return uploads
+
+
+def insert_images(cursor, uploads, note_id, date, group_id, team_id, project_id):
+    """
+    Move uploads into the content store and insert their images rows. Must run
+    after the note write so the transaction already holds the write lock.
+    Returns (saved image dicts, jobs for enqueue_images).
+    """
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    saved_images = []
+    jobs = []
+    
+    for filepath, original_filename in uploads:
+        stored = store_upload(cursor, upload_folder, filepath)
+        cursor.execute('''
+            INSERT INTO images (filename, original_filename, note_id, date, group_id, user_id, team_id, project_id,
+                                status, variants, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (stored['filename'], original_filename, note_id, date, group_id, session['user_id'], team_id, project_id,
+              stored['status'], stored['variants'], stored['content_hash']))
+        image_id = cursor.lastrowid
+        
+        # Identical content is converted once; later rows reuse its result
+        if stored['process']:
+            jobs.append((image_id, stored['filename'], stored['content_hash']))
+        saved_images.append(image_dict({
+            'id': image_id,
+            'filename': stored['filename'],
+            'original_filename': original_filename,
+            'status': stored['status'],
+            'variants': stored['variants'],
+        }))
+    
+    return saved_images, jobs
 
 
 @notes_bp.route('/notes', methods=['POST'])
@@ -270,10 +763,10 @@ def create_note():
 
     # Verify selected group belongs to current project and permission scope
     if team_id:
-        cursor.execute('SELECT id FROM groups WHERE id = ? AND team_id = ? AND project_id = ?',
+        cursor.execute('SELECT id FROM groups WHERE id = ? AND team_id = ? AND project_id = ? AND deleted_at IS NULL',
                       (group_id, team_id, project_id))
     else:
-        cursor.execute('SELECT id FROM groups WHERE id = ? AND user_id = ? AND team_id IS NULL AND project_id = ?',
+        cursor.execute('SELECT id FROM groups WHERE id = ? AND user_id = ? AND team_id IS NULL AND project_id = ? AND deleted_at IS NULL',
                       (group_id, session['user_id'], project_id))
 
     if not cursor.fetchone():
@@ -286,78 +779,11 @@ def create_note():
         ''', (content, date, group_id, session['user_id'], team_id, project_id))
         note_id = cursor.lastrowid
         
-        saved_images = []
-        
-        # Process pre-uploaded chunked files
-        for chunk_file in uploaded_chunks:
-            if chunk_file and 'filename' in chunk_file:
-                # filename is relative path like "username/123_abc.jpg"
-                filename = chunk_file['filename']
-                original_filename = chunk_file.get('original_filename', 'image')
-                
-                cursor.execute('''
-                    INSERT INTO images (filename, original_filename, note_id, date, group_id, user_id, team_id, project_id)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (filename, original_filename, note_id, date, group_id, session['user_id'], team_id, project_id))
-                
-                saved_images.append({
-                    'id': cursor.lastrowid,
-                    'filename': filename,
-                    'original_filename': original_filename
-                })
-        
-        # Process standard file uploads
-        for file in files:
-            if file and file.filename and allowed_file(file.filename):
-                original_filename = secure_filename(file.filename) or 'image'
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-                
-                # Create user directory if not exists
-                # Sanitize username for directory name security
-                username = secure_filename(session.get('username', 'shared'))
-                if not username:
-                    username = 'user_' + str(session.get('user_id', 'unknown'))
-                
-                user_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], username)
-                os.makedirs(user_folder, exist_ok=True)
-                
-                # Filename without path
-                name = f"{session['user_id']}_{timestamp}_{original_filename}"
-                
-                # Save file
-                filepath = os.path.join(user_folder, name)
-                file.save(filepath)
-                
-                # Convert to progressive JPEG
-                try:
-                    updated_filepath = convert_to_progressive_jpeg(filepath)
-                    if updated_filepath != filepath:
-                        name = os.path.basename(updated_filepath)
-                        filepath = updated_filepath
-                except Exception as e:
-                    current_app.logger.error(f'Error processing image {name}: {str(e)}')
-                
-                # Update filename to include user path for access
-                # Use forward slash for web URL compatibility
-                filename = f"{username}/{name}"
-
-                # Create thumbnail
-                try:
-                    create_thumbnail(filepath)
-                except Exception as e:
-                    current_app.logger.error(f'Error creating thumbnail for {name}: {str(e)}')
-                
-                cursor.execute('''
-                    INSERT INTO images (filename, original_filename, note_id, date, group_id, user_id, team_id, project_id)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (filename, original_filename, note_id, date, group_id, session['user_id'], team_id, project_id))
-                saved_images.append({
-                    'id': cursor.lastrowid,
-                    'filename': filename,
-                    'original_filename': original_filename
-                })
+        uploads = collect_uploads(uploaded_chunks, files)
+        saved_images, jobs = insert_images(cursor, uploads, note_id, date, group_id, team_id, project_id)
         
         conn.commit()
+        enqueue_images(current_app._get_current_object(), jobs)
         
         current_app.logger.info(f'User {session["user_id"]} created note: {note_id} in group {group_id}')
         return jsonify({
@@ -409,20 +835,25 @@ def update_note(note_id):
     try:
         # Verify note belongs to user or team
         if team_id:
-            cursor.execute('SELECT id FROM notes WHERE id = ? AND team_id = ? AND project_id = ?', (note_id, team_id, project_id))
+            cursor.execute('''
+                SELECT n.id FROM notes n JOIN groups g ON n.group_id = g.id
+                WHERE n.id = ? AND n.team_id = ? AND n.project_id = ? AND g.deleted_at IS NULL
+            ''', (note_id, team_id, project_id))
         else:
-            cursor.execute('SELECT id FROM notes WHERE id = ? AND user_id = ? AND team_id IS NULL AND project_id = ?',
-                          (note_id, session['user_id'], project_id))
+            cursor.execute('''
+                SELECT n.id FROM notes n JOIN groups g ON n.group_id = g.id
+                WHERE n.id = ? AND n.user_id = ? AND n.team_id IS NULL AND n.project_id = ? AND g.deleted_at IS NULL
+            ''', (note_id, session['user_id'], project_id))
         
         if not cursor.fetchone():
             return jsonify({'error': '笔记不存在或无权限'}), 403
         
         # Ensure target group is under current project and permission scope
         if team_id:
-            cursor.execute('SELECT id FROM groups WHERE id = ? AND team_id = ? AND project_id = ?',
+            cursor.execute('SELECT id FROM groups WHERE id = ? AND team_id = ? AND project_id = ? AND deleted_at IS NULL',
                           (group_id, team_id, project_id))
         else:
-            cursor.execute('SELECT id FROM groups WHERE id = ? AND user_id = ? AND team_id IS NULL AND project_id = ?',
+            cursor.execute('SELECT id FROM groups WHERE id = ? AND user_id = ? AND team_id IS NULL AND project_id = ? AND deleted_at IS NULL',
                           (group_id, session['user_id'], project_id))
 
         if not cursor.fetchone():
@@ -433,22 +864,22 @@ def update_note(note_id):
             SET content = ?, date = ?, group_id = ?, project_id = ?, updated_at = CURRENT_TIMESTAMP
             WHERE id = ?
         ''', (content, date, group_id, project_id, note_id))
+        # Images carry the note's date and group for calendar counts and group deletion
+        cursor.execute('UPDATE images SET date = ?, group_id = ? WHERE note_id = ? AND project_id = ?',
+                      (date, group_id, note_id, project_id))
         
         # Delete images not in keep_images
         if keep_image_ids:
             placeholders = ','.join('?' * len(keep_image_ids))
             cursor.execute(f'''
-                SELECT filename FROM images 
+                SELECT filename, variants, content_hash FROM images 
                 WHERE note_id = ? AND project_id = ? AND id NOT IN ({placeholders})
             ''', [note_id, project_id] + keep_image_ids)
         else:
-            cursor.execute('SELECT filename FROM images WHERE note_id = ? AND project_id = ?', (note_id, project_id))
+            cursor.execute('SELECT filename, variants, content_hash FROM images WHERE note_id = ? AND project_id = ?',
+                          (note_id, project_id))
         
         images_to_delete = cursor.fetchall()
-        for img in images_to_delete:
-            filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], img['filename'])
-            if os.path.exists(filepath):
-                os.remove(filepath)
         
         if keep_image_ids:
             placeholders = ','.join('?' * len(keep_image_ids))
@@ -458,66 +889,13 @@ def update_note(note_id):
             cursor.execute('DELETE FROM images WHERE note_id = ? AND project_id = ?', (note_id, project_id))
         
         # Save new images
-        saved_images = []
-        
-        # Process pre-uploaded chunked files
-        for chunk_file in uploaded_chunks:
-            if chunk_file and 'filename' in chunk_file:
-                filename = chunk_file['filename']
-                original_filename = chunk_file.get('original_filename', 'image')
-                
-                cursor.execute('''
-                    INSERT INTO images (filename, original_filename, note_id, date, group_id, user_id, team_id, project_id)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (filename, original_filename, note_id, date, group_id, session['user_id'], team_id, project_id))
-                saved_images.append({'id': cursor.lastrowid, 'filename': filename})
-        
-        for file in files:
-            if file and file.filename and allowed_file(file.filename):
-                original_filename = secure_filename(file.filename) or 'image'
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-                
-                # Create user directory if not exists
-                # Sanitize username for directory name security
-                current_username = secure_filename(session.get('username', 'shared'))
-                if not current_username:
-                    current_username = 'user_' + str(session.get('user_id', 'unknown'))
-                
-                user_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], current_username)
-                os.makedirs(user_folder, exist_ok=True)
-                
-                # Filename without path
-                name = f"{session['user_id']}_{timestamp}_{original_filename}"
-                
-                # Save file
-                filepath = os.path.join(user_folder, name)
-                file.save(filepath)
-                
-                # Convert to progressive JPEG
-                try:
-                    updated_filepath = convert_to_progressive_jpeg(filepath)
-                    if updated_filepath != filepath:
-                        name = os.path.basename(updated_filepath)
-                        filepath = updated_filepath
-                except Exception as e:
-                    current_app.logger.error(f'Error processing image {name}: {str(e)}')
-                
-                # Create thumbnail
-                try:
-                    create_thumbnail(filepath)
-                except Exception as e:
-                    current_app.logger.error(f'Error creating thumbnail for {name}: {str(e)}')
-
-                # Filename with relative path
-                filename = f"{current_username}/{name}"
-                
-                cursor.execute('''
-                    INSERT INTO images (filename, original_filename, note_id, date, group_id, user_id, team_id, project_id)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (filename, original_filename, note_id, date, group_id, session['user_id'], team_id, project_id))
-                saved_images.append({'id': cursor.lastrowid, 'filename': filename})
+        uploads = collect_uploads(uploaded_chunks, files)
+        saved_images, jobs = insert_images(cursor, uploads, note_id, date, group_id, team_id, project_id)
         
+        # Unlink removed images unless a new upload or another note still uses them
+        release_images(cursor, current_app.config['UPLOAD_FOLDER'], images_to_delete)
         conn.commit()
+        enqueue_images(current_app._get_current_object(), jobs)
         
         current_app.logger.info(f'User {session["user_id"]} updated note: {note_id}')
         return jsonify({'message': '笔记更新成功', 'new_images': saved_images})
@@ -539,26 +917,28 @@ def delete_note(note_id):
     
     # Verify permission
     if team_id:
-        cursor.execute('SELECT id FROM notes WHERE id = ? AND team_id = ? AND project_id = ?', (note_id, team_id, project_id))
+        cursor.execute('''
+            SELECT n.id FROM notes n JOIN groups g ON n.group_id = g.id
+            WHERE n.id = ? AND n.team_id = ? AND n.project_id = ? AND g.deleted_at IS NULL
+        ''', (note_id, team_id, project_id))
     else:
-        cursor.execute('SELECT id FROM notes WHERE id = ? AND user_id = ? AND team_id IS NULL AND project_id = ?',
-                      (note_id, session['user_id'], project_id))
+        cursor.execute('''
+            SELECT n.id FROM notes n JOIN groups g ON n.group_id = g.id
+            WHERE n.id = ? AND n.user_id = ? AND n.team_id IS NULL AND n.project_id = ? AND g.deleted_at IS NULL
+        ''', (note_id, session['user_id'], project_id))
     
     if not cursor.fetchone():
         current_app.logger.warning(f'User {session.get("user_id")} attempted to delete non-existent or unauthorized note: {note_id}')
         return jsonify({'error': '笔记不存在或无权限'}), 403
     
     # Get images to delete files
-    cursor.execute('SELECT filename FROM images WHERE note_id = ? AND project_id = ?', (note_id, project_id))
+    cursor.execute('SELECT filename, variants, content_hash FROM images WHERE note_id = ? AND project_id = ?',
+                  (note_id, project_id))
     images = cursor.fetchall()
     
-    for img in images:
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], img['filename'])
-        if os.path.exists(filepath):
-            os.remove(filepath)
-    
     cursor.execute('DELETE FROM images WHERE note_id = ? AND project_id = ?', (note_id, project_id))
     cursor.execute('DELETE FROM notes WHERE id = ? AND project_id = ?', (note_id, project_id))
+    release_images(cursor, current_app.config['UPLOAD_FOLDER'], images)
     conn.commit()
     
     current_app.logger.info(f'User {session.get("user_id")} deleted note: {note_id}')
@@ -577,30 +957,127 @@ def delete_note_image(note_id, image_id):
     
     # Verify permission
     if team_id:
-        cursor.execute('SELECT id FROM notes WHERE id = ? AND team_id = ? AND project_id = ?', (note_id, team_id, project_id))
+        cursor.execute('''
+            SELECT n.id FROM notes n JOIN groups g ON n.group_id = g.id
+            WHERE n.id = ? AND n.team_id = ? AND n.project_id = ? AND g.deleted_at IS NULL
+        ''', (note_id, team_id, project_id))
     else:
-        cursor.execute('SELECT id FROM notes WHERE id = ? AND user_id = ? AND team_id IS NULL AND project_id = ?',
-                      (note_id, session['user_id'], project_id))
+        cursor.execute('''
+            SELECT n.id FROM notes n JOIN groups g ON n.group_id = g.id
+            WHERE n.id = ? AND n.user_id = ? AND n.team_id IS NULL AND n.project_id = ? AND g.deleted_at IS NULL
+        ''', (note_id, session['user_id'], project_id))
     
     if not cursor.fetchone():
         return jsonify({'error': '笔记不存在或无权限'}), 403
     
-    cursor.execute('SELECT filename FROM images WHERE id = ? AND note_id = ? AND project_id = ?', (image_id, note_id, project_id))
+    cursor.execute('SELECT filename, variants, content_hash FROM images WHERE id = ? AND note_id = ? AND project_id = ?',
+                  (image_id, note_id, project_id))
     image = cursor.fetchone()
     
     if image:
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], image['filename'])
-        if os.path.exists(filepath):
-            os.remove(filepath)
-        
         cursor.execute('DELETE FROM images WHERE id = ? AND project_id = ?', (image_id, project_id))
+        release_images(cursor, current_app.config['UPLOAD_FOLDER'], [image])
         conn.commit()
         current_app.logger.info(f'User {session.get("user_id")} deleted image {image_id} from note {note_id}')
     
-    conn.close()
     return jsonify({'message': '图片删除成功'})
 
 
+@notes_bp.route('/images/status', methods=['GET'])
+@login_required
+def get_images_status():
+    """Get background processing status for images, e.g. ?ids=1,2,3"""
+    try:
+        image_ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()][:IMAGE_BATCH_SIZE]
+    except ValueError:
+        return jsonify({'error': '无效的图片ID'}), 400
+    
+    if not image_ids:
+        return jsonify([])
+    
+    team_id = get_user_team_id()
+    project_id = get_current_project_id()
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    placeholders = ','.join('?' * len(image_ids))
+    
+    if team_id:
+        cursor.execute(f'''
+            SELECT i.id, i.filename, i.status, i.variants FROM images i
+            JOIN groups g ON i.group_id = g.id
+            WHERE i.id IN ({placeholders}) AND i.team_id = ? AND i.project_id = ? AND g.deleted_at IS NULL
+        ''', image_ids + [team_id, project_id])
+    else:
+        cursor.execute(f'''
+            SELECT i.id, i.filename, i.status, i.variants FROM images i
+            JOIN groups g ON i.group_id = g.id
+            WHERE i.id IN ({placeholders}) AND i.user_id = ? AND i.team_id IS NULL AND i.project_id = ?
+              AND g.deleted_at IS NULL
+        ''', image_ids + [session['user_id'], project_id])
+    
+    images = [image_dict(row) for row in cursor.fetchall()]
+    return jsonify(images)
+
+
+# Processed files in the content store never change under their URL
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+@notes_bp.route('/images/<int:image_id>/<path:name>', methods=['GET'])
+@login_required
+def serve_image(image_id, name):
+    """
+    Serve an image's original, thumbnail or variant file, e.g.
+    /api/images/12/cas/ab/<sha256>.jpg. Conditional requests (ETag, 304) and
+    Range are handled by send_file; with IMAGE_ACCEL_REDIRECT set the file is
+    handed to the fronting proxy instead.
+    """
+    team_id = get_user_team_id()
+    project_id = get_current_project_id()
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    if team_id:
+        cursor.execute('''
+            SELECT i.filename, i.status, i.variants, i.content_hash FROM images i
+            JOIN groups g ON i.group_id = g.id
+            WHERE i.id = ? AND i.team_id = ? AND i.project_id = ? AND g.deleted_at IS NULL
+        ''', (image_id, team_id, project_id))
+    else:
+        cursor.execute('''
+            SELECT i.filename, i.status, i.variants, i.content_hash FROM images i
+            JOIN groups g ON i.group_id = g.id
+            WHERE i.id = ? AND i.user_id = ? AND i.team_id IS NULL AND i.project_id = ? AND g.deleted_at IS NULL
+        ''', (image_id, session['user_id'], project_id))
+    
+    image = cursor.fetchone()
+    if not image or name not in image_files(image['filename'], image['variants']):
+        return jsonify({'error': '图片不存在或无权限'}), 404
+    
+    # Content-store names embed the SHA-256 of the upload; once processing has
+    # finished the bytes behind them are final (a pending .jpg is re-encoded in place)
+    immutable = bool(image['content_hash']) and image['status'] != 'pending'
+    
+    accel_prefix = current_app.config.get('IMAGE_ACCEL_REDIRECT')
+    if accel_prefix:
+        response = Response(mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + name
+    else:
+        etag = name.rsplit('/', 1)[-1] if immutable else True
+        response = send_from_directory(os.path.abspath(current_app.config['UPLOAD_FOLDER']), name,
+                                       conditional=True, etag=etag)
+    
+    # Images are scoped per user/team, so only the browser may cache them
+    response.cache_control.no_cache = None if immutable else True
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
 # ============ User Info API ============
 
 @notes_bp.route('/projects', methods=['GET'])
@@ -611,12 +1088,17 @@ def get_projects_for_user():
     cursor = conn.cursor()
     current_project_id = get_current_project_id()
 
-    cursor.execute('SELECT id, name, created_at FROM projects ORDER BY created_at DESC')
+    etag = data_etag(cursor, PROJECTS_SCOPE, current_project_id)
+    response = not_modified(etag)
+    if response:
+        return response
+
+    cursor.execute('SELECT id, name, created_at FROM projects WHERE deleted_at IS NULL ORDER BY created_at DESC')
     projects = [dict(row) for row in cursor.fetchall()]
     for project in projects:
         project['is_current'] = (project['id'] == current_project_id)
 
-    return jsonify(projects)
+    return revalidate(jsonify(projects), etag)
 
 
 @notes_bp.route('/projects/switch', methods=['POST'])
@@ -630,7 +1112,7 @@ def switch_project():
 
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT id, name FROM projects WHERE id = ?', (project_id,))
+    cursor.execute('SELECT id, name FROM projects WHERE id = ? AND deleted_at IS NULL', (project_id,))
     project = cursor.fetchone()
     if not project:
         return jsonify({'error': '项目不存在'}), 404
@@ -653,17 +1135,26 @@ def get_user_info():
     conn = get_db()
     cursor = conn.cursor()
     current_project_id = get_current_project_id()
-    cursor.execute('''
-        SELECT u.id, u.username, u.role, u.status, u.team_id, t.name as team_name,
-               p.id as current_project_id, p.name as current_project_name
-        FROM users u
-        LEFT JOIN user_teams t ON u.team_id = t.id
-        LEFT JOIN projects p ON p.id = ?
-        WHERE u.id = ?
-    ''', (current_project_id, session['user_id']))
-    user = cursor.fetchone()
-    conn.close()
-    
-    if user:
-        return jsonify(dict(user))
-    return jsonify({'error': '用户不存在'}), 404
+    
+    def load_user():
+        cursor.execute('''
+            SELECT u.id, u.username, u.role, u.status, u.team_id, t.name as team_name
+            FROM users u
+            LEFT JOIN user_teams t ON u.team_id = t.id
+            WHERE u.id = ?
+        ''', (session['user_id'],))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    
+    def load_project():
+        cursor.execute('SELECT id, name FROM projects WHERE id = ?', (current_project_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    
+    # Both parts are cached per process; the admin routes invalidate them
+    user = cache.cached('user_info', session['user_id'], load_user)
+    if not user:
+        return jsonify({'error': '用户不存在'}), 404
+    project = cache.cached('project', current_project_id, load_project) or {}
+    
+    return jsonify(dict(user, current_project_id=project.get('id'), current_project_name=project.get('name')))
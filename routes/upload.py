@@ -1,38 +1,208 @@
 from flask import Blueprint, jsonify, request, session, current_app
-from utils import login_required, convert_to_progressive_jpeg, create_thumbnail
+from utils import login_required, get_user_upload_folder
 from werkzeug.utils import secure_filename
+from itsdangerous import URLSafeSerializer, BadSignature
 from datetime import datetime
 import os
 import shutil
-# from PIL import Image # No longer needed here if using utils
+import hashlib
 
 upload_bp = Blueprint('upload', __name__)
 
+# Name of the preallocated file that direct-write chunks land in
+DIRECT_TARGET = 'target'
+COPY_BUFFER_SIZE = 1024 * 1024
+# Salt of the tokens /merge hands out for create_note and update_note to redeem
+UPLOAD_TOKEN_SALT = 'upload-merge'
+
+
+def upload_token(filename):
+    """Token proving the current user merged filename (relative to UPLOAD_FOLDER)"""
+    serializer = URLSafeSerializer(current_app.secret_key, salt=UPLOAD_TOKEN_SALT)
+    return serializer.dumps([session['user_id'], filename])
+
+
+def redeem_upload_token(token):
+    """Filename a token from upload_token names, or None unless the current user merged it"""
+    serializer = URLSafeSerializer(current_app.secret_key, salt=UPLOAD_TOKEN_SALT)
+    try:
+        user_id, filename = serializer.loads(str(token))
+    except (BadSignature, TypeError, ValueError):
+        return None
+    return filename if user_id == session['user_id'] else None
+
+
+def copy_file_into(src_path, dst_file):
+    """Append src_path to the open dst_file, in-kernel where the platform allows it"""
+    with open(src_path, 'rb') as src_file:
+        if hasattr(os, 'copy_file_range'):
+            dst_file.flush()
+            start = os.lseek(dst_file.fileno(), 0, os.SEEK_CUR)
+            try:
+                while os.copy_file_range(src_file.fileno(), dst_file.fileno(), COPY_BUFFER_SIZE * 16):
+                    pass
+                dst_file.seek(0, os.SEEK_END)
+                return
+            except OSError:
+                # e.g. unsupported filesystem; redo this chunk with a buffered copy
+                src_file.seek(0)
+                dst_file.truncate(start)
+                dst_file.seek(start)
+        shutil.copyfileobj(src_file, dst_file, COPY_BUFFER_SIZE)
+
+
+def received_chunks(temp_dir):
+    """
+    Completed chunks of an upload session from one directory scan, as
+    {index: (size, sha256, byte offset or None)}; the offset is recorded for
+    chunks written in place. A chunk counts only once its part_N.done marker
+    exists, so a partially written chunk is never merged.
+    """
+    chunks = {}
+    with os.scandir(temp_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if not (name.startswith('part_') and name.endswith('.done')):
+                continue
+            index = name[len('part_'):-len('.done')]
+            if not index.isdigit():
+                continue
+            with open(entry.path) as marker:
+                fields = marker.read().split()
+            size = int(fields[0]) if len(fields) >= 2 else None
+            checksum = fields[1] if len(fields) >= 2 else None
+            offset = int(fields[2]) if len(fields) >= 3 else None
+            chunks[int(index)] = (size, checksum, offset)
+    return chunks
+
+
+def covers_file(chunks, file_size):
+    """Whether chunks written in place, as (size, sha256, offset), fill file_size bytes without gaps or overlaps"""
+    position = 0
+    for size, _, offset in sorted(chunks, key=lambda chunk: -1 if chunk[2] is None else chunk[2]):
+        if size is None or offset != position:
+            return False
+        position += size
+    return position == file_size
+
+
+def write_chunk_at_offset(temp_dir, stream, offset, total_size):
+    """
+    Write a chunk straight into the preallocated target file at its byte offset.
+    Returns (size, sha256 hex digest) of the written data.
+    """
+    digest = hashlib.sha256()
+    fd = os.open(os.path.join(temp_dir, DIRECT_TARGET), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size < total_size:
+            os.ftruncate(fd, total_size)
+        position = offset
+        while True:
+            data = stream.read(COPY_BUFFER_SIZE)
+            if not data:
+                break
+            if position + len(data) > total_size:
+                raise ValueError('Chunk exceeds declared file size')
+            os.pwrite(fd, data, position)
+            digest.update(data)
+            position += len(data)
+    finally:
+        os.close(fd)
+    return position - offset, digest.hexdigest()
+
+
+def write_chunk_file(chunk_path, stream):
+    """Save a chunk to its own part file. Returns (size, sha256 hex digest)."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(chunk_path, 'wb') as chunk_file:
+        while True:
+            data = stream.read(COPY_BUFFER_SIZE)
+            if not data:
+                break
+            chunk_file.write(data)
+            digest.update(data)
+            size += len(data)
+    return size, digest.hexdigest()
+
+
+def session_temp_dir(file_uuid):
+    """Temp directory of the current user's upload session; the uuid is sanitized"""
+    return os.path.join(current_app.config['UPLOAD_TEMP_FOLDER'], f"{session['user_id']}_{secure_filename(file_uuid)}")
+
+
+@upload_bp.route('/status/<file_uuid>', methods=['GET'])
+@login_required
+def upload_status(file_uuid):
+    """List the chunks already received for an upload session, so clients can resume"""
+    temp_dir = session_temp_dir(file_uuid)
+    chunks = received_chunks(temp_dir) if os.path.isdir(temp_dir) else {}
+    return jsonify({
+        'dzuuid': file_uuid,
+        'chunks': [
+            {'index': index, 'size': size, 'checksum': checksum}
+            for index, (size, checksum, _) in sorted(chunks.items())
+        ]
+    })
+
+
 @upload_bp.route('/chunk', methods=['POST'])
 @login_required
 def upload_chunk():
-    """Handle chunked file upload"""
+    """
+    Handle chunked file upload. Chunks that carry dzchunkbyteoffset and
+    dztotalfilesize are written directly into a preallocated file when
+    UPLOAD_DIRECT_WRITE is on, so merging is a rename. An optional
+    dzchunkchecksum (SHA-256 hex) is verified before the chunk is accepted.
+    """
     file = request.files.get('file')
     if not file:
         return jsonify({'error': 'No file part'}), 400
 
     file_uuid = request.form.get('dzuuid')
-    chunk_index = request.form.get('dzchunkindex')
-    
-    if not file_uuid or chunk_index is None:
+    chunk_index = request.form.get('dzchunkindex', type=int)
+
+    if not file_uuid or chunk_index is None or chunk_index < 0:
         return jsonify({'error': 'Missing chunk metadata'}), 400
 
-    # Secure uuid to prevent directory traversal
-    file_uuid = secure_filename(file_uuid)
-    
-    # Create temp directory for this file
-    temp_dir = os.path.join(current_app.config['UPLOAD_TEMP_FOLDER'], file_uuid)
+    # Create temp directory for this file (uuid is secured against directory traversal)
+    temp_dir = session_temp_dir(file_uuid)
     os.makedirs(temp_dir, exist_ok=True)
 
-    # Save the chunk
-    chunk_filename = f"part_{chunk_index}"
-    file.save(os.path.join(temp_dir, chunk_filename))
-    
+    offset = request.form.get('dzchunkbyteoffset', type=int)
+    total_size = request.form.get('dztotalfilesize', type=int)
+    expected_checksum = (request.form.get('dzchunkchecksum') or '').lower()
+    chunk_path = os.path.join(temp_dir, f"part_{chunk_index}")
+    marker_path = chunk_path + '.done'
+
+    # A re-sent chunk is not complete again until it has been fully rewritten
+    if os.path.exists(marker_path):
+        os.remove(marker_path)
+
+    max_size = current_app.config.get('UPLOAD_MAX_FILE_SIZE')
+    if total_size is not None and max_size and total_size > max_size:
+        return jsonify({'error': 'File too large'}), 413
+
+    direct = current_app.config.get('UPLOAD_DIRECT_WRITE') and offset is not None and total_size is not None
+    if direct:
+        if offset < 0 or offset > total_size:
+            return jsonify({'error': 'Invalid chunk offset'}), 400
+        try:
+            size, checksum = write_chunk_at_offset(temp_dir, file.stream, offset, total_size)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    else:
+        size, checksum = write_chunk_file(chunk_path, file.stream)
+
+    if expected_checksum and expected_checksum != checksum:
+        current_app.logger.warning(f'Checksum mismatch for chunk {chunk_index} of upload {file_uuid}')
+        return jsonify({'error': 'Chunk checksum mismatch', 'checksum': checksum}), 400
+
+    # Marker records that this chunk is complete, with its size, checksum and
+    # (written in place) offset
+    with open(marker_path, 'w') as marker:
+        marker.write(f'{size} {checksum} {offset}' if direct else f'{size} {checksum}')
+
     return jsonify({'message': 'Chunk uploaded successfully'})
 
 
@@ -44,71 +214,71 @@ def merge_chunks():
     file_uuid = data.get('dzuuid')
     filename = data.get('filename')
     total_chunks = data.get('dztotalchunkcount')
-    
-    if not file_uuid or not filename or total_chunks is None:
+
+    if not file_uuid or not filename or not isinstance(total_chunks, int):
         return jsonify({'error': 'Missing merge metadata'}), 400
-        
-    file_uuid = secure_filename(file_uuid)
+
     filename = secure_filename(filename)
-    
-    temp_dir = os.path.join(current_app.config['UPLOAD_TEMP_FOLDER'], file_uuid)
-    if not os.path.exists(temp_dir):
+
+    temp_dir = session_temp_dir(file_uuid)
+    if not os.path.isdir(temp_dir):
         return jsonify({'error': 'Upload session not found'}), 404
-        
+
     # Check if all chunks exist
+    present = received_chunks(temp_dir)
     for i in range(total_chunks):
-        if not os.path.exists(os.path.join(temp_dir, f"part_{i}")):
+        if i not in present:
             return jsonify({'error': f'Missing chunk {i}'}), 400
-            
+
+    chunks = [present[i] for i in range(total_chunks)]
+    direct_target = os.path.join(temp_dir, DIRECT_TARGET)
+    if os.path.exists(direct_target):
+        # Unwritten ranges of the preallocated file would be merged as zeros
+        if not covers_file(chunks, os.path.getsize(direct_target)):
+            return jsonify({'error': 'Chunks do not cover the file'}), 400
+    else:
+        max_size = current_app.config.get('UPLOAD_MAX_FILE_SIZE')
+        if max_size and sum(size or 0 for size, _, _ in chunks) > max_size:
+            return jsonify({'error': 'File too large'}), 413
+
     # Create user directory if not exists
-    current_username = secure_filename(session.get('username', 'shared'))
-    if not current_username:
-        current_username = 'user_' + str(session.get('user_id', 'unknown'))
-    
+    current_username = get_user_upload_folder()
+
     user_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], current_username)
     os.makedirs(user_folder, exist_ok=True)
-    
+
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
     name = f"{session['user_id']}_{timestamp}_{filename}"
     filepath = os.path.join(user_folder, name)
-    
+
     try:
-        with open(filepath, 'wb') as final_file:
-            for i in range(total_chunks):
-                chunk_path = os.path.join(temp_dir, f"part_{i}")
-                with open(chunk_path, 'rb') as chunk_file:
-                    final_file.write(chunk_file.read())
-                    
+        if os.path.exists(direct_target):
+            # Chunks were written in place; temp folder is under UPLOAD_FOLDER so this is a rename
+            os.replace(direct_target, filepath)
+        else:
+            with open(filepath, 'wb') as final_file:
+                for i in range(total_chunks):
+                    chunk_path = os.path.join(temp_dir, f"part_{i}")
+                    copy_file_into(chunk_path, final_file)
+                    # Free each chunk as soon as it is copied to bound extra disk usage
+                    os.remove(chunk_path)
+
         # Clean up temp files
-        shutil.rmtree(temp_dir)
-        
-        # Process image via utility function
-        try:
-            new_filepath = convert_to_progressive_jpeg(filepath)
-            if new_filepath != filepath:
-                # Update name if extension changed (e.g. png -> jpg)
-                name = os.path.basename(new_filepath)
-                filepath = new_filepath
-        except Exception as e:
-            current_app.logger.error(f'Error processing image {filename}: {str(e)}')
-
-        # Create thumbnail
-        try:
-            create_thumbnail(filepath)
-        except Exception as e:
-            current_app.logger.error(f'Error creating thumbnail for {filename}: {str(e)}')
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
-                # Continue without failing completely - just keep original file
+        # Conversion and thumbnailing run in the background once the file is
+        # attached to a note (see jobs.enqueue_images)
 
         # Return the relative path for saving to DB + filename
         relative_path = f"{current_username}/{name}"
-        
+
         return jsonify({
             'message': 'File merged successfully',
             'filename': relative_path,
-            'original_filename': filename
+            'original_filename': filename,
+            'token': upload_token(relative_path)
         })
-        
+
     except Exception as e:
         current_app.logger.error(f'Error merging file {filename}: {str(e)}')
         return jsonify({'error': 'Merge failed'}), 500
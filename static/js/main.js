@@ -612,50 +612,99 @@ function removeEditSelectedImage(index) {
 
 // ============ Chunked Upload ============
 
-function generateUUID() {
-    if (window.crypto && window.crypto.randomUUID) return window.crypto.randomUUID();
-    return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function(c) {
-        var r = Math.random() * 16 | 0, v = c == 'x' ? r : (r & 0x3 | 0x8);
-        return v.toString(16);
-    });
+const CHUNK_SIZE = 4 * 1024 * 1024; // 4MB Chunk
+const CHUNK_CONCURRENCY = 3;
+const CHUNK_MAX_ATTEMPTS = 4;
+
+// crypto.subtle is only available in secure contexts (HTTPS / localhost)
+async function sha256Hex(data) {
+    if (!(window.crypto && window.crypto.subtle)) return null;
+    const hash = await window.crypto.subtle.digest('SHA-256', data);
+    return Array.from(new Uint8Array(hash)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// Random upload session id (crypto.getRandomValues works outside secure contexts too)
+function newUploadId() {
+    const bytes = window.crypto.getRandomValues(new Uint8Array(16));
+    return Array.from(bytes).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+async function getUploadStatus(fileUuid) {
+    try {
+        const response = await fetch(`/api/upload/status/${encodeURIComponent(fileUuid)}`);
+        if (!response.ok) return new Map();
+        const status = await response.json();
+        return new Map(status.chunks.map(chunk => [chunk.index, chunk]));
+    } catch (error) {
+        return new Map();
+    }
 }
 
-async function uploadChunkedFile(file, onProgress) {
-    const CHUNK_SIZE = 4 * 1024 * 1024; // 4MB Chunk
-    const totalChunks = Math.ceil(file.size / CHUNK_SIZE);
+async function uploadChunk(file, fileUuid, index, totalChunks, received) {
+    const start = index * CHUNK_SIZE;
+    const end = Math.min(file.size, start + CHUNK_SIZE);
+    const chunk = file.slice(start, end);
+    const checksum = await sha256Hex(await chunk.arrayBuffer());
     
-    // UUID for this file upload session
-    const fileUuid = generateUUID();
+    // Skip chunks the server already holds intact
+    const existing = received.get(index);
+    if (existing && existing.size === end - start && (!checksum || existing.checksum === checksum)) {
+        return;
+    }
     
-    for (let i = 0; i < totalChunks; i++) {
-        const start = i * CHUNK_SIZE;
-        const end = Math.min(file.size, start + CHUNK_SIZE);
-        const chunk = file.slice(start, end);
-        
+    for (let attempt = 1; ; attempt++) {
         const chunkFormData = new FormData();
         chunkFormData.append('file', chunk);
         chunkFormData.append('dzuuid', fileUuid);
-        chunkFormData.append('dzchunkindex', i);
+        chunkFormData.append('dzchunkindex', index);
         chunkFormData.append('dztotalchunkcount', totalChunks); // Ensure consistent casing
+        chunkFormData.append('dzchunkbyteoffset', start);
+        chunkFormData.append('dztotalfilesize', file.size);
+        if (checksum) {
+            chunkFormData.append('dzchunkchecksum', checksum);
+        }
         
         try {
             const response = await fetch('/api/upload/chunk', {
                 method: 'POST',
                 body: chunkFormData
             });
-            
-            if (!response.ok) {
-                throw new Error(`Upload failed for chunk ${i}`);
+            if (response.ok) return;
+            throw new Error(`Upload failed for chunk ${index}`);
+        } catch (error) {
+            if (attempt >= CHUNK_MAX_ATTEMPTS) {
+                console.error('Chunk upload error:', error);
+                throw error;
             }
-            
+            await sleep(500 * 2 ** attempt);
+        }
+    }
+}
+
+async function uploadChunkedFile(file, fileUuid, onProgress) {
+    const totalChunks = Math.max(1, Math.ceil(file.size / CHUNK_SIZE));
+    
+    // Chunks already received in an earlier, interrupted attempt are skipped
+    const received = await getUploadStatus(fileUuid);
+    
+    // Send up to CHUNK_CONCURRENCY chunks at once
+    let nextIndex = 0;
+    let completed = 0;
+    const worker = async () => {
+        while (nextIndex < totalChunks) {
+            const index = nextIndex++;
+            await uploadChunk(file, fileUuid, index, totalChunks, received);
+            completed++;
             if (onProgress) {
-                onProgress((i + 1) / totalChunks * 100);
+                onProgress(completed / totalChunks * 100);
             }
-        } catch (error) {
-            console.error('Chunk upload error:', error);
-            throw error;
         }
-    }
+    };
+    await Promise.all(Array.from({ length: Math.min(CHUNK_CONCURRENCY, totalChunks) }, worker));
     
     // Merge
     const mergeResponse = await fetch('/api/upload/merge', {
@@ -676,25 +725,29 @@ async function uploadChunkedFile(file, onProgress) {
 }
 
 /**
- * Process files for upload, using chunked upload for large files or large batches.
- * @param {File[]} files - List of files to process
+ * Process queued files for upload, using chunked upload for large files or large batches.
+ * Each queued item keeps its upload session id, so submitting again after a failure resumes.
+ * @param {{file: File, uploadId?: string}[]} items - Queued files to process
  * @returns {Promise<{uploadedChunks: any[], smallFiles: File[]}>}
  */
-async function processFilesForUpload(files) {
+async function processFilesForUpload(items) {
     const CHUNK_THRESHOLD = 5 * 1024 * 1024; // 5MB
     const MAX_BATCH_SIZE = 10 * 1024 * 1024; // 10MB limit for non-chunked batch
     const uploadedChunks = [];
     const smallFiles = [];
     let totalSmallSize = 0;
 
-    for (const file of files) {
+    for (const item of items) {
+        const file = item.file;
         // Determine if we should chunk this file
         // 1. It is individually large (>5MB)
         // 2. OR adding it to the batch would exceed the safe batch size
         if (file.size > CHUNK_THRESHOLD || (totalSmallSize + file.size > MAX_BATCH_SIZE)) {
             showToast(`正在分块上传: ${file.name}...`, 'info');
             // This might throw, caller should handle try/catch
-            const result = await uploadChunkedFile(file);
+            // A new id per queued file: the same file picked twice gets two sessions
+            item.uploadId = item.uploadId || newUploadId();
+            const result = await uploadChunkedFile(file, item.uploadId);
             uploadedChunks.push(result);
         } else {
             smallFiles.push(file);
@@ -733,8 +786,7 @@ function setupFormHandlers() {
         
         try {
             // Process files (using shared chunked logic)
-            const filesToUpload = selectedFiles.map(item => item.file);
-            const { uploadedChunks, smallFiles } = await processFilesForUpload(filesToUpload);
+            const { uploadedChunks, smallFiles } = await processFilesForUpload(selectedFiles);
             
             const formData = new FormData();
             formData.append('content', content);
@@ -775,29 +827,108 @@ function setupFormHandlers() {
 
 async function loadBrowseContent() {
     const groupId = document.getElementById('browseGroup').value;
-    await loadNotes(groupId);
-}
-
-async function loadNotes(groupId) {
+    const query = document.getElementById('browseSearch').value.trim();
+    const dateFrom = document.getElementById('browseFrom').value;
+    const dateTo = document.getElementById('browseTo').value;
+    await loadNotes(groupId, query, dateFrom, dateTo);
+}
+
+const NOTES_PAGE_SIZE = 20;
+// Keyset cursor of the listing, or result offset while searching
+let notesNextCursor = null;
+let notesGroupId = '';
+let notesQuery = '';
+let notesDateFrom = '';
+let notesDateTo = '';
+let notesLoading = false;
+let notesRequestSeq = 0;
+let notesScrollObserver = null;
+
+async function loadNotes(groupId, query, dateFrom, dateTo) {
+    // Start over from the first page; bump the sequence so stale responses are dropped
+    notesGroupId = groupId || '';
+    notesQuery = query || '';
+    notesDateFrom = dateFrom || '';
+    notesDateTo = dateTo || '';
+    notesNextCursor = null;
+    notesLoading = false;
+    notesRequestSeq++;
+    await loadNotesPage(false);
+}
+
+async function loadNotesPage(append) {
+    if (notesLoading) return;
+    notesLoading = true;
+    const requestSeq = notesRequestSeq;
+    
     try {
-        let url = '/api/notes';
-        if (groupId) {
-            url += `?group_id=${groupId}`;
+        const params = new URLSearchParams({ limit: NOTES_PAGE_SIZE });
+        if (notesGroupId) {
+            params.set('group_id', notesGroupId);
+        }
+        if (notesQuery) {
+            params.set('q', notesQuery);
+        }
+        if (notesDateFrom) {
+            params.set('from', notesDateFrom);
+        }
+        if (notesDateTo) {
+            params.set('to', notesDateTo);
         }
+        if (append && notesNextCursor) {
+            params.set(notesQuery ? 'offset' : 'after', notesNextCursor);
+        }
+        
+        const url = notesQuery ? '/api/notes/search' : '/api/notes';
+        const response = await fetch(`${url}?${params.toString()}`);
+        const page = await response.json();
+        if (requestSeq !== notesRequestSeq) return;
         
-        const response = await fetch(url);
-        const notes = await response.json();
-        renderNotes(notes);
+        notesNextCursor = notesQuery ? page.next_offset : page.next_cursor;
+        renderNotes(page.notes, append);
     } catch (error) {
-        showToast('加载笔记失败', 'error');
+        if (requestSeq === notesRequestSeq) {
+            showToast('加载笔记失败', 'error');
+        }
+    } finally {
+        if (requestSeq === notesRequestSeq) {
+            notesLoading = false;
+            observeNotesSentinel();
+        }
+    }
+}
+
+function observeNotesSentinel() {
+    const sentinel = document.getElementById('notesLoadMore');
+    if (!sentinel) return;
+    
+    sentinel.style.display = notesNextCursor ? '' : 'none';
+    if (!notesNextCursor) return;
+    
+    if (!window.IntersectionObserver) {
+        sentinel.onclick = () => loadNotesPage(true);
+        return;
+    }
+    
+    if (!notesScrollObserver) {
+        notesScrollObserver = new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting) && notesNextCursor) {
+                loadNotesPage(true);
+            }
+        }, { rootMargin: '300px' });
     }
+    // Re-observe so a sentinel that is still visible triggers the next page
+    notesScrollObserver.unobserve(sentinel);
+    notesScrollObserver.observe(sentinel);
 }
 
-function renderNotes(notes) {
+function renderNotes(notes, append = false) {
     const notesList = document.getElementById('notesList');
     
-    if (notes.length === 0) {
-        notesList.innerHTML = `
+    if (!append && notes.length === 0) {
+        notesList.innerHTML = notesQuery
+            ? `<div class="empty-state"><p>没有找到匹配的笔记</p></div>`
+            : `
             <div class="empty-state">
                 <p>暂无笔记</p>
                 <p>切换到"记录笔记"标签创建新笔记</p>
@@ -806,17 +937,10 @@ function renderNotes(notes) {
         return;
     }
     
-    notesList.innerHTML = notes.map(note => {
+    const notesHtml = notes.map(note => {
         const imagesHtml = note.images && note.images.length > 0 
             ? `<div class="note-card-images">
-                ${note.images.map(img => {
-                    // Use thumbnail if available, otherwise fallback to original
-                    const thumbSrc = img.thumbnail ? `/static/uploads/${img.thumbnail}` : `/static/uploads/${img.filename}`;
-                    return `
-                    <div class="note-image-item" onclick="showImageModal('/static/uploads/${img.filename}', '${escapeHtml(img.original_filename)}')">
-                        <img src="${thumbSrc}" alt="${escapeHtml(img.original_filename)}" loading="lazy" onerror="this.onerror=null;this.src='/static/uploads/${img.filename}'">
-                    </div>
-                `}).join('')}
+                ${note.images.map(img => renderNoteImage(img)).join('')}
                </div>`
             : '';
         
@@ -835,23 +959,101 @@ function renderNotes(notes) {
                     </div>
                 </div>
                 <div class="note-card-body">
-                    <div class="note-card-content">${formatNoteContentWithLinks(note.content)}</div>
+                    <div class="note-card-content">${note.highlight !== undefined ? note.highlight : formatNoteContentWithLinks(note.content)}</div>
                     ${imagesHtml}
                 </div>
             </div>
         `;
     }).join('');
+    
+    if (append) {
+        notesList.insertAdjacentHTML('beforeend', notesHtml);
+    } else {
+        notesList.innerHTML = notesHtml;
+    }
+    schedulePendingImagePoll();
+}
+
+// Responsive variants by image id, used by the lightbox
+const imageVariants = {};
+
+// Image files are served through the scoped, cacheable image route
+function imageUrl(imageId, path) {
+    return `/api/images/${imageId}/${path}`;
+}
+
+function variantSrcset(imageId, variants, format) {
+    return variants
+        .filter(variant => variant[format])
+        .map(variant => `${imageUrl(imageId, variant[format])} ${variant.width}w`)
+        .join(', ');
+}
+
+function renderNoteImage(img) {
+    // Use thumbnail if available, otherwise fallback to original
+    const originalSrc = imageUrl(img.id, img.filename);
+    const thumbSrc = img.thumbnail && img.status !== 'pending' ? imageUrl(img.id, img.thumbnail) : originalSrc;
+    const variants = img.variants || [];
+    imageVariants[img.id] = variants;
+    
+    // Grid cells are at least 150px wide, two per row on phones
+    const sizes = '(max-width: 768px) 50vw, 200px';
+    const imgHtml = variants.length > 0
+        ? `<picture>
+                <source type="image/webp" srcset="${variantSrcset(img.id, variants, 'webp')}" sizes="${sizes}">
+                <img src="${thumbSrc}" srcset="${variantSrcset(img.id, variants, 'jpeg')}" sizes="${sizes}" alt="${escapeHtml(img.original_filename)}" loading="lazy">
+           </picture>`
+        : `<img src="${thumbSrc}" alt="${escapeHtml(img.original_filename)}" loading="lazy" onerror="this.onerror=null;this.src='${originalSrc}'">`;
+    
+    return `
+        <div class="note-image-item ${img.status === 'pending' ? 'pending' : ''}" data-image-id="${img.id}" data-status="${img.status || 'ready'}"
+             data-original-filename="${escapeHtml(img.original_filename)}"
+             onclick="showImageModal('${originalSrc}', '${escapeHtml(img.original_filename)}', ${img.id})">
+            ${imgHtml}
+        </div>
+    `;
+}
+
+// ============ Image Processing Status ============
+
+let pendingImagePollTimer = null;
+
+function schedulePendingImagePoll(delay = 2000) {
+    if (pendingImagePollTimer) return;
+    if (!document.querySelector('.note-image-item[data-status="pending"]')) return;
+    pendingImagePollTimer = setTimeout(pollPendingImages, delay);
+}
+
+async function pollPendingImages() {
+    pendingImagePollTimer = null;
+    const items = Array.from(document.querySelectorAll('.note-image-item[data-status="pending"]'));
+    if (items.length === 0) return;
+    
+    try {
+        const ids = items.map(item => item.dataset.imageId).join(',');
+        const response = await fetch(`/api/images/status?ids=${ids}`);
+        const images = await response.json();
+        
+        images.filter(img => img.status !== 'pending').forEach(img => {
+            document.querySelectorAll(`.note-image-item[data-image-id="${img.id}"]`).forEach(item => {
+                img.original_filename = item.dataset.originalFilename;
+                item.outerHTML = renderNoteImage(img);
+            });
+        });
+    } catch (error) {
+        console.warn('Image status poll failed', error);
+    }
+    schedulePendingImagePoll(4000);
 }
 
 // ============ Note CRUD ============
 
 async function showEditNoteModal(noteId) {
     try {
-        const response = await fetch('/api/notes');
-        const notes = await response.json();
-        const note = notes.find(n => n.id === noteId);
+        const response = await fetch(`/api/notes/${noteId}`);
+        const note = await response.json();
         
-        if (note) {
+        if (response.ok) {
             document.getElementById('editNoteId').value = note.id;
             document.getElementById('editNoteDate').value = note.date;
             document.getElementById('editNoteGroup').value = note.group_id;
@@ -866,6 +1068,8 @@ async function showEditNoteModal(noteId) {
             renderEditImagePreviews();
             
             showModal('editNoteModal');
+        } else {
+            showToast(note.error || '加载笔记失败', 'error');
         }
     } catch (error) {
         showToast('加载笔记失败', 'error');
@@ -883,11 +1087,12 @@ function renderExistingImages(images) {
     container.innerHTML = images.map(img => {
         const isKept = editKeepImageIds.includes(img.id);
         // Use thumbnail if available, otherwise fallback to original
-        const thumbSrc = img.thumbnail ? `/static/uploads/${img.thumbnail}` : `/static/uploads/${img.filename}`;
+        const originalSrc = imageUrl(img.id, img.filename);
+        const thumbSrc = img.thumbnail ? imageUrl(img.id, img.thumbnail) : originalSrc;
         
         return `
             <div class="existing-image-item ${isKept ? '' : 'removed'}" data-id="${img.id}">
-                <img src="${thumbSrc}" alt="${escapeHtml(img.original_filename)}" loading="lazy" onerror="this.onerror=null;this.src='/static/uploads/${img.filename}'">
+                <img src="${thumbSrc}" alt="${escapeHtml(img.original_filename)}" loading="lazy" onerror="this.onerror=null;this.src='${originalSrc}'">
                 <button type="button" class="remove-btn" onclick="toggleExistingImage(${img.id})">${isKept ? '×' : '+'}</button>
             </div>
         `;
@@ -934,8 +1139,7 @@ async function updateNote() {
     
     try {
         // Process new files (using shared chunked logic)
-        const filesToUpload = editSelectedFiles.map(item => item.file);
-        const { uploadedChunks, smallFiles } = await processFilesForUpload(filesToUpload);
+        const { uploadedChunks, smallFiles } = await processFilesForUpload(editSelectedFiles);
         
         const formData = new FormData();
         formData.append('content', content);
@@ -1007,8 +1211,16 @@ async function deleteNote(noteId) {
 
 // ============ Image Modal ============
 
-function showImageModal(src, title) {
-    document.getElementById('modalImage').src = src;
+function showImageModal(src, title, imageId) {
+    const variants = imageVariants[imageId] || [];
+    const modalImage = document.getElementById('modalImage');
+    const modalImageWebp = document.getElementById('modalImageWebp');
+    
+    // Let the browser pick the variant for the viewport; the original is only
+    // used for images processed before variants existed
+    modalImageWebp.srcset = variantSrcset(imageId, variants, 'webp');
+    modalImage.srcset = variantSrcset(imageId, variants, 'jpeg');
+    modalImage.src = variants.length > 0 ? imageUrl(imageId, variants[0].jpeg) : src;
     document.getElementById('imageModalTitle').textContent = title;
     showModal('imageModal');
 }
@@ -1546,7 +1758,7 @@ async function editProject(projectId, currentName) {
 }
 
 async function deleteProject(projectId) {
-    if (!confirm('确定要删除此项目吗？如果项目下还有品类或笔记将无法删除。')) return;
+    if (!confirm('确定要删除此项目吗？项目下的所有品类、笔记和图片都将被删除。')) return;
 
     try {
         const response = await fetch(`/api/admin/projects/${projectId}`, {
@@ -1641,9 +1853,12 @@ async function assignTeam() {
         const data = await response.json();
         
         if (response.ok) {
-            showToast('用户组分配成功');
+            showToast('用户组分配成功，正在迁移历史数据');
             closeModal('assignTeamModal');
             loadAdminData();
+            if (data.job_id) {
+                pollReassignment(data.job_id);
+            }
         } else {
             showToast(data.error || '分配失败', 'error');
         }
@@ -1652,6 +1867,23 @@ async function assignTeam() {
     }
 }
 
+// Notes, groups and images move to the new team in the background
+async function pollReassignment(jobId, delay = 1000) {
+    try {
+        const response = await fetch(`/api/admin/reassignments/${jobId}`);
+        const job = await response.json();
+        if (job.status === 'running') {
+            setTimeout(() => pollReassignment(jobId, Math.min(delay * 2, 10000)), delay);
+        } else if (job.status === 'done') {
+            showToast(`历史数据迁移完成（${job.moved_rows} 条）`);
+        } else {
+            showToast('历史数据迁移失败', 'error');
+        }
+    } catch (error) {
+        setTimeout(() => pollReassignment(jobId, Math.min(delay * 2, 10000)), delay);
+    }
+}
+
 async function deleteUser(userId) {
     if (!confirm('确定要删除此用户吗？')) return;
     
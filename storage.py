@@ -0,0 +1,143 @@
+"""
+Content-addressed image store.
+
+Uploads are keyed by the SHA-256 of their bytes and kept once under
+UPLOAD_FOLDER/cas/<first two hex chars>/<sha256><ext>; background processing
+then turns that into <sha256>.jpg plus its thumbnail and variants. Every
+images row with the same content_hash shares those files, and they are only
+unlinked when the last referencing row is deleted.
+"""
+from utils import thumbnail_path, image_variant_files
+import hashlib
+import json
+import os
+
+CONTENT_STORE_DIR = 'cas'
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+def hash_file(filepath):
+    """SHA-256 hex digest of a file, read in bounded chunks"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        while True:
+            data = f.read(HASH_BUFFER_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def resolve_upload(upload_folder, user_folder, filename):
+    """
+    Absolute path of a client-supplied upload filename, or None unless it names
+    an existing file directly inside the user's own folder under UPLOAD_FOLDER
+    (where /api/upload/merge writes), never the content store or another
+    user's folder.
+    """
+    root = os.path.realpath(upload_folder)
+    if user_folder == CONTENT_STORE_DIR:
+        return None
+    filepath = os.path.realpath(os.path.join(root, filename))
+    if os.path.dirname(filepath) != os.path.join(root, user_folder) or not os.path.isfile(filepath):
+        return None
+    return filepath
+
+
+def store_upload(cursor, upload_folder, filepath):
+    """
+    Move a freshly saved upload into the content store, or drop it if identical
+    bytes are already stored. Call inside the transaction that inserts the
+    images row so concurrent identical uploads are serialized by the write lock.
+    Returns a dict with filename, status, variants (JSON text or None),
+    content_hash and `process` (True if it still needs background processing).
+    """
+    content_hash = hash_file(filepath)
+    cursor.execute('''
+        SELECT filename, status, variants FROM images
+        WHERE content_hash = ?
+        LIMIT 1
+    ''', (content_hash,))
+    existing = cursor.fetchone()
+    if existing:
+        os.remove(filepath)
+        return {
+            'filename': existing['filename'],
+            'status': existing['status'],
+            'variants': existing['variants'],
+            'content_hash': content_hash,
+            'process': False,
+        }
+
+    ext = os.path.splitext(filepath)[1].lower()
+    filename = f"{CONTENT_STORE_DIR}/{content_hash[:2]}/{content_hash}{ext}"
+    target = os.path.join(upload_folder, filename)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(filepath, target)
+    return {
+        'filename': filename,
+        'status': 'pending',
+        'variants': None,
+        'content_hash': content_hash,
+        'process': True,
+    }
+
+
+def image_files(filename, variants):
+    """Original, thumbnail and variant files of an image (relative to UPLOAD_FOLDER)"""
+    if isinstance(variants, str):
+        variants = json.loads(variants)
+    return [filename, thumbnail_path(filename)] + image_variant_files(variants)
+
+
+def unlink_files(upload_folder, filenames):
+    for name in filenames:
+        try:
+            os.remove(os.path.join(upload_folder, name))
+        except FileNotFoundError:
+            pass  # Never written, or removed by another worker
+
+
+def content_key(img):
+    """What an images row's files are shared by: its content hash, or its filename for legacy rows"""
+    return img['content_hash'] or img['filename']
+
+
+def unreferenced_images(cursor, images):
+    """
+    The deleted image rows (filename, variants, content_hash) whose content no
+    other images row still references, one per content. Call after the DELETE.
+    """
+    unreferenced = []
+    seen = set()
+    for img in images:
+        key = content_key(img)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        if img['content_hash']:
+            cursor.execute('SELECT 1 FROM images WHERE content_hash = ? LIMIT 1', (img['content_hash'],))
+            if cursor.fetchone():
+                continue
+        unreferenced.append(img)
+    return unreferenced
+
+
+def unreferenced_files(cursor, images):
+    """
+    Files of deleted image rows that no other images row still references.
+    Call after the DELETE, before committing.
+    """
+    files = []
+    for img in unreferenced_images(cursor, images):
+        files += image_files(img['filename'], img['variants'])
+    return files
+
+
+def release_images(cursor, upload_folder, images):
+    """
+    Unlink the files of deleted image rows unless another images row still
+    references the same content. Call after the DELETE, before committing.
+    """
+    unlink_files(upload_folder, unreferenced_files(cursor, images))
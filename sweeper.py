@@ -0,0 +1,206 @@
+"""
+Garbage collection for upload storage.
+
+Removes chunk upload sessions abandoned in UPLOAD_TEMP_FOLDER, files merged by
+/api/upload/merge but never attached to a note, and thumbnails or variants
+whose images row is gone. The files in each upload directory are compared to
+the images rows whose filename lies in that directory. Each pass visits only
+a few directories (the user folders and the cas/ shards) and resumes after the
+last one visited, so the uploads tree is never walked in one go.
+
+Runs in a background thread every UPLOAD_GC_INTERVAL seconds, or from the
+command line:
+
+    python sweeper.py [--dirs N] [--max-age SECONDS] [--dry-run]
+"""
+from database import acquire_db, release_db
+from storage import CONTENT_STORE_DIR, image_files
+import argparse
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Remembers the last directory swept, relative to UPLOAD_FOLDER
+CURSOR_FILE = '.gc_cursor'
+
+
+def sweep_temp_sessions(temp_folder, max_age, now, dry_run=False):
+    """
+    Remove chunk upload sessions nothing was written to for max_age seconds.
+    Returns the number of sessions removed.
+    """
+    removed = 0
+    if not os.path.isdir(temp_folder):
+        return removed
+
+    with os.scandir(temp_folder) as sessions:
+        for entry in sessions:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            # Direct writes only touch the target file, so check every entry
+            latest = entry.stat().st_mtime
+            with os.scandir(entry.path) as parts:
+                for part in parts:
+                    latest = max(latest, part.stat().st_mtime)
+            if now - latest < max_age:
+                continue
+            if not dry_run:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def upload_directories(upload_folder, temp_folder):
+    """Directories holding image files (relative to UPLOAD_FOLDER), in sweep order"""
+    directories = []
+    temp_folder = os.path.realpath(temp_folder)
+    with os.scandir(upload_folder) as entries:
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False) or os.path.realpath(entry.path) == temp_folder:
+                continue
+            if entry.name == CONTENT_STORE_DIR:
+                with os.scandir(entry.path) as shards:
+                    directories += [f'{entry.name}/{shard.name}' for shard in shards if shard.is_dir(follow_symlinks=False)]
+            else:
+                directories.append(entry.name)
+    return sorted(directories)
+
+
+def referenced_files(cursor, directory):
+    """Originals, thumbnails and variants of the images rows stored in a directory"""
+    # Every filename starting with "<directory>/" sorts before "<directory>0"
+    cursor.execute('SELECT filename, variants FROM images WHERE filename >= ? AND filename < ?',
+                   (directory + '/', directory + '0'))
+    referenced = set()
+    for row in cursor.fetchall():
+        referenced.update(image_files(row['filename'], row['variants']))
+    return referenced
+
+
+def sweep_directory(upload_folder, directory, max_age, now, dry_run=False):
+    """
+    Remove files in one upload directory that no images row references and
+    that are older than max_age (newer ones may be awaiting attachment or
+    processing). Returns (files removed, bytes freed).
+    """
+    conn = acquire_db()
+    try:
+        referenced = referenced_files(conn.cursor(), directory)
+    finally:
+        release_db(conn)
+
+    removed = freed = 0
+    with os.scandir(os.path.join(upload_folder, directory)) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False) or f'{directory}/{entry.name}' in referenced:
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime < max_age:
+                continue
+            if not dry_run:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+            removed += 1
+            freed += stat.st_size
+    return removed, freed
+
+
+def read_cursor(upload_folder):
+    try:
+        with open(os.path.join(upload_folder, CURSOR_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ''
+
+
+def write_cursor(upload_folder, directory):
+    with open(os.path.join(upload_folder, CURSOR_FILE), 'w') as f:
+        f.write(directory)
+
+
+def sweep(upload_folder, temp_folder, max_age, max_dirs=None, dry_run=False):
+    """
+    Run one garbage collection pass: expired temp sessions plus up to max_dirs
+    upload directories (all of them if None) after the saved cursor.
+    Returns a dict of counts.
+    """
+    now = time.time()
+    stats = {
+        'sessions': sweep_temp_sessions(temp_folder, max_age, now, dry_run),
+        'directories': 0,
+        'files': 0,
+        'bytes': 0,
+    }
+
+    directories = upload_directories(upload_folder, temp_folder)
+    cursor = read_cursor(upload_folder)
+    directories = [d for d in directories if d > cursor] + [d for d in directories if d <= cursor]
+    if max_dirs is not None:
+        directories = directories[:max_dirs]
+
+    for directory in directories:
+        try:
+            removed, freed = sweep_directory(upload_folder, directory, max_age, now, dry_run)
+        except FileNotFoundError:
+            # Directory vanished since it was listed
+            continue
+        stats['directories'] += 1
+        stats['files'] += removed
+        stats['bytes'] += freed
+
+    if directories and not dry_run:
+        write_cursor(upload_folder, directories[-1])
+    return stats
+
+
+def start_sweeper(app):
+    """Sweep in a daemon thread every UPLOAD_GC_INTERVAL seconds (0 disables it)"""
+    interval = app.config.get('UPLOAD_GC_INTERVAL')
+    if not interval:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                stats = sweep(app.config['UPLOAD_FOLDER'], app.config['UPLOAD_TEMP_FOLDER'],
+                              app.config['UPLOAD_GC_MAX_AGE'], app.config.get('UPLOAD_GC_DIRS'))
+            except Exception as e:
+                app.logger.error(f'Upload garbage collection failed: {e}')
+                continue
+            if stats['sessions'] or stats['files']:
+                app.logger.info(f'Upload garbage collection: removed {stats["sessions"]} sessions, '
+                                f'{stats["files"]} files ({stats["bytes"]} bytes)')
+
+    thread = threading.Thread(target=run, name='upload-sweeper', daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    from app import create_app
+
+    parser = argparse.ArgumentParser(description='Remove abandoned uploads and orphan image files.')
+    parser.add_argument('--dirs', type=int, default=None,
+                        help='upload directories to sweep, resuming after the last run (default: all)')
+    parser.add_argument('--max-age', type=int, default=None,
+                        help='only remove files untouched for this many seconds (default: UPLOAD_GC_MAX_AGE)')
+    parser.add_argument('--dry-run', action='store_true', help='report what would be removed')
+    args = parser.parse_args()
+
+    # Only the database; a one-off sweep must not start processing or reaping
+    app = create_app(background_tasks=False)
+    max_age = app.config['UPLOAD_GC_MAX_AGE'] if args.max_age is None else args.max_age
+    stats = sweep(app.config['UPLOAD_FOLDER'], app.config['UPLOAD_TEMP_FOLDER'], max_age, args.dirs, args.dry_run)
+    print(f'{"Would remove" if args.dry_run else "Removed"} {stats["sessions"]} upload sessions and '
+          f'{stats["files"]} files ({stats["bytes"]} bytes) in {stats["directories"]} directories')
+
+
+if __name__ == '__main__':
+    main()
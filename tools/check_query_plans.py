@@ -0,0 +1,212 @@
+"""
+Query plan regression check.
+
+Builds a throwaway database with the real init_db schema, drives the API
+routes through the Flask test client (as a team member and as a user without
+a team), records every SQL statement the routes execute and runs
+EXPLAIN QUERY PLAN on each one. Exits non-zero if a statement on one of the
+scoped tables falls back to a full table SCAN.
+
+Usage: python tools/check_query_plans.py
+"""
+from PIL import Image
+import io
+import os
+import re
+import sys
+import sqlite3
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+# Tables that grow with usage; every statement touching them must use an index.
+SCOPED_TABLES = {'groups', 'notes', 'images'}
+
+# "FROM notes n", "JOIN images AS i", "FROM notes n, groups g": plans name the alias
+# (a column such as ", n.id" or a call such as ", COUNT(" is not a table)
+TABLE_REFERENCE = re.compile(r'(?:\bFROM|\bJOIN|,)\s+(\w+)(?![\w.(])(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+
+# Statements without a query plan worth checking
+SKIPPED_PREFIXES = ('BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA', 'CREATE', 'DROP', 'ALTER', 'ANALYZE', '--')
+
+statements = []
+_connect = sqlite3.connect
+
+
+def traced_connect(*args, **kwargs):
+    """sqlite3.connect replacement that records every executed statement"""
+    conn = _connect(*args, **kwargs)
+    conn.set_trace_callback(statements.append)
+    return conn
+
+
+def image_file(name):
+    buf = io.BytesIO()
+    Image.new('RGB', (64, 48), (40, 160, 60)).save(buf, 'PNG')
+    buf.seek(0)
+    return buf, name
+
+
+def exercise_notes_routes(client):
+    """Run the group/note/project routes for the logged-in user"""
+    group_id = client.post('/api/groups', json={'name': 'plan-check'}).get_json()['id']
+    client.post('/api/groups', json={'name': 'plan-check'})
+    client.put(f'/api/groups/{group_id}', json={'name': 'plan-check-renamed'})
+    client.get('/api/groups')
+
+    note_ids = []
+    for day in range(1, 4):
+        response = client.post('/api/notes', data={
+            'content': f'note {day}',
+            'date': f'2026-01-0{day}',
+            'group_id': str(group_id),
+            'images': [image_file('a.png'), image_file('b.png')],
+        }, content_type='multipart/form-data')
+        note_ids.append(response.get_json()['id'])
+
+    client.get('/api/notes')
+    client.get(f'/api/notes?group_id={group_id}')
+    page = client.get('/api/notes?limit=1').get_json()
+    client.get(f'/api/notes?limit=1&after={page["next_cursor"]}')
+    client.get(f'/api/notes/{note_ids[0]}')
+    client.get('/api/notes?limit=2&from=2026-01-02&to=2026-01-31')
+    client.get(f'/api/notes?limit=2&from=2026-01-01&group_id={group_id}')
+    client.get('/api/notes/calendar?month=2026-01')
+    client.get(f'/api/notes/calendar?month=2026-01&group_id={group_id}')
+    client.get('/api/notes/search?q=note')
+    client.get(f'/api/notes/search?q=no&group_id={group_id}')
+
+    note = client.get(f'/api/notes/{note_ids[0]}').get_json()
+    client.put(f'/api/notes/{note_ids[0]}', data={
+        'content': 'edited',
+        'date': '2026-01-05',
+        'group_id': str(group_id),
+        'keep_images': f'[{note["images"][0]["id"]}]',
+    }, content_type='multipart/form-data')
+    client.delete(f'/api/notes/{note_ids[1]}/images/{client.get(f"/api/notes/{note_ids[1]}").get_json()["images"][0]["id"]}')
+    client.delete(f'/api/notes/{note_ids[2]}')
+
+    client.get('/api/projects')
+    client.get('/api/user/info')
+
+    doomed = client.post('/api/groups', json={'name': 'plan-check-doomed'}).get_json()['id']
+    client.post('/api/notes', data={
+        'content': 'to delete', 'date': '2026-01-09', 'group_id': str(doomed),
+        'images': [image_file('c.png')],
+    }, content_type='multipart/form-data')
+    client.delete(f'/api/groups/{doomed}')
+
+
+def exercise_admin_routes(client, member_id):
+    """Run the admin routes; returns the id of a created team"""
+    client.get('/api/admin/users')
+    client.get('/api/admin/users/pending')
+    client.post(f'/api/admin/users/{member_id}/approve')
+    team_id = client.post('/api/admin/teams', json={'name': 'plan-team'}).get_json()['id']
+    client.put(f'/api/admin/teams/{team_id}', json={'name': 'plan-team'})
+    client.get('/api/admin/teams')
+    job_id = client.put(f'/api/admin/users/{member_id}/team', json={'team_id': team_id}).get_json()['job_id']
+    # The member's data moves in a background thread; wait so its statements are recorded
+    while client.get(f'/api/admin/reassignments/{job_id}').get_json()['status'] == 'running':
+        time.sleep(0.05)
+
+    project_id = client.post('/api/admin/projects', json={'name': 'plan-project'}).get_json()['id']
+    client.put(f'/api/admin/projects/{project_id}', json={'name': 'plan-project-2'})
+    client.get('/api/admin/projects')
+    client.post('/api/projects/switch', json={'project_id': project_id})
+    client.post('/api/projects/switch', json={'project_id': 1})
+    client.delete(f'/api/admin/projects/{project_id}')
+    client.get('/api/admin/deletions')
+    client.get(f'/api/admin/deletions/{client.get("/api/admin/deletions").get_json()[0]["id"]}')
+
+    spare_team = client.post('/api/admin/teams', json={'name': 'plan-spare'}).get_json()['id']
+    client.delete(f'/api/admin/teams/{spare_team}')
+    return team_id
+
+
+def collect_statements():
+    from app import create_app
+
+    app = create_app()
+    app.config['TESTING'] = True
+    # Only the routes are checked; one-off migration backfills may scan
+    del statements[:]
+
+    admin = app.test_client()
+    admin.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    exercise_notes_routes(admin)
+
+    member = app.test_client()
+    member.post('/register', data={'username': 'member', 'password': 'member', 'confirm_password': 'member'})
+    with app.app_context():
+        from database import get_db
+        member_id = get_db().execute("SELECT id FROM users WHERE username = 'member'").fetchone()['id']
+    exercise_admin_routes(admin, member_id)
+
+    member.post('/login', data={'username': 'member', 'password': 'member'})
+    exercise_notes_routes(member)
+    member.post('/api/change-password', json={'old_password': 'member', 'new_password': 'member2'})
+
+    # Deleted groups and projects are reaped in a background thread; wait so its statements are recorded
+    with app.app_context():
+        from database import get_db
+        while get_db().execute("SELECT COUNT(*) FROM deletion_jobs WHERE status IN ('pending', 'running')").fetchone()[0]:
+            time.sleep(0.05)
+
+
+def table_names(sql):
+    """Map every table name and alias in `sql` to its table"""
+    names = {}
+    for table, alias in TABLE_REFERENCE.findall(sql):
+        names[table] = table
+        if alias:
+            names[alias] = table
+    return names
+
+
+def full_scans(conn, sql):
+    """Return the plan lines of `sql` that scan a scoped table without an index"""
+    rows = conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+    names = table_names(sql)
+    failures = []
+    for row in rows:
+        detail = row[3]
+        words = detail.split()
+        if len(words) >= 2 and words[0] == 'SCAN' and 'INDEX' not in detail:
+            if names.get(words[1], words[1]) in SCOPED_TABLES:
+                failures.append(detail)
+    return failures
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='caiyuan-plans-')
+    os.chdir(workdir)
+    sqlite3.connect = traced_connect
+    try:
+        collect_statements()
+    finally:
+        sqlite3.connect = _connect
+
+    conn = sqlite3.connect(os.path.join(workdir, 'notes.db'))
+    checked = set()
+    failed = 0
+    for sql in statements:
+        normalized = ' '.join(sql.split())
+        if not normalized or normalized.upper().startswith(SKIPPED_PREFIXES) or normalized in checked:
+            continue
+        checked.add(normalized)
+        failures = full_scans(conn, sql)
+        if failures:
+            failed += 1
+            print('FULL SCAN:', normalized)
+            for detail in failures:
+                print('    ', detail)
+
+    print(f'Checked {len(checked)} statements in {workdir}, {failed} with full table scans')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
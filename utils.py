@@ -1,92 +1,141 @@
 from functools import wraps
-from flask import session, redirect, url_for, jsonify, current_app
+from flask import session, redirect, url_for, jsonify
+from werkzeug.utils import secure_filename
+import logging
 import os
+import time
 from PIL import Image, ImageOps
 
+logger = logging.getLogger(__name__)
+
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
-def convert_to_progressive_jpeg(filepath):
-    """
-    Convert image to progressive JPEG if it's a supported image type.
-    Returns the new filepath (extension might change to .jpg).
-    """
-    try:
-        # Simple extension check
-        file_ext = os.path.splitext(filepath)[1].lower()
-        if file_ext not in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']:
-            return filepath
+CONVERTIBLE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
 
-        base_name = os.path.splitext(filepath)[0]
-        new_filepath = base_name + ".jpg"
-        temp_filepath = base_name + ".temp.jpg"
+# Thumbnail files written next to each processed image: filename prefix -> bounding box
+THUMBNAIL_SIZES = {'thumb_': (300, 300)}
 
-        with Image.open(filepath) as img:
-            # Fix orientation based on EXIF data
-            try:
-                img = ImageOps.exif_transpose(img)
-            except Exception:
-                pass
-                
-            if img.mode in ('RGBA', 'P'):
-                img = img.convert('RGB')
-            img.save(temp_filepath, "JPEG", quality=85, optimize=True, progressive=True)
-            
-        # Replace original with new file
-        if filepath != new_filepath: 
-            if os.path.exists(filepath):
-                os.remove(filepath)
-        
-        if os.path.exists(new_filepath):
-             os.remove(new_filepath)
-             
-        os.rename(temp_filepath, new_filepath)
-        return new_filepath
-        
-    except Exception as e:
-        # Log error? current_app might not be available if outside request context or not initialized
-        # but utils is used in routes so usually fine.
-        try:
-           current_app.logger.error(f"Error converting image {filepath}: {e}")
-        except:
-           pass
-           
-        # Cleanup temp if exists
-        # ...
-        return filepath
-
-def create_thumbnail(image_path, size=(300, 300)):
+# Responsive variants: each width is a square bounding box, written as
+# w{width}_<name> in every format of VARIANT_FORMATS (served via srcset)
+VARIANT_WIDTHS = [150, 300, 800, 1600]
+VARIANT_FORMATS = {'jpeg': ('.jpg', {'quality': 82, 'progressive': True}),
+                   'webp': ('.webp', {'quality': 80, 'method': 4})}
+
+def fit_within(size, box):
+    """Size of an image of `size` scaled down (never up) to fit in `box`, keeping aspect ratio"""
+    width, height = size
+    scale = min(box[0] / width, box[1] / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def variant_filename(filename, width, fmt):
+    """Path of the `fmt` variant at `width` for an image filename (same folder)"""
+    dirname, name = os.path.split(filename)
+    stem = os.path.splitext(name)[0]
+    return os.path.join(dirname, f"w{width}_{stem}{VARIANT_FORMATS[fmt][0]}")
+
+def process_image_file(filepath, thumbnail_sizes=None, variant_widths=None, timings=None):
     """
-    Generate a thumbnail for an image.
-    Saves it as thumb_<filename> in the same directory.
-    Returns the path to the thumbnail.
+    Decode an image once, fix its EXIF orientation and write the full
+    progressive JPEG, every thumbnail and every responsive variant from the
+    same in-memory image.
+    Returns (new filepath, {prefix: thumbnail path}, variants) where variants is a
+    list of {'width', 'height', <format>: path} dicts, largest first. The
+    extension might change to .jpg. Unsupported files are returned unchanged;
+    files that fail to process are too, with no thumbnails or variants (any
+    output written before the failure is removed).
+    If a `timings` dict is given, the seconds spent decoding, writing the full
+    image, resizing and encoding the thumbnails/variants are added to it.
     """
+    timings = {} if timings is None else timings
+    for stage in ('decode', 'full', 'resize', 'encode'):
+        timings.setdefault(stage, 0.0)
+    thumbnail_sizes = THUMBNAIL_SIZES if thumbnail_sizes is None else thumbnail_sizes
+    variant_widths = VARIANT_WIDTHS if variant_widths is None else variant_widths
+    file_ext = os.path.splitext(filepath)[1].lower()
+    if file_ext not in CONVERTIBLE_EXTENSIONS:
+        return filepath, {}, []
+
+    base_name = os.path.splitext(filepath)[0]
+    new_filepath = base_name + ".jpg"
+    temp_filepath = base_name + ".temp.jpg"
+    dirname, new_name = os.path.split(new_filepath)
+    thumbnails = {}
+    variants = []
+    written = [temp_filepath]
+
+    # Largest box first so each smaller output is resized from the previous one
+    steps = [(size, prefix, None) for prefix, size in thumbnail_sizes.items()]
+    steps += [((width, width), None, width) for width in variant_widths]
+    steps.sort(key=lambda step: step[0], reverse=True)
+
     try:
-        if not os.path.exists(image_path):
-            return None
-        
-        filename = os.path.basename(image_path)
-        dirname = os.path.dirname(image_path)
-        thumb_filename = f"thumb_{filename}"
-        thumb_path = os.path.join(dirname, thumb_filename)
-        
-        with Image.open(image_path) as img:
+        start = time.perf_counter()
+        with Image.open(filepath) as source:
             # Fix orientation based on EXIF data
             try:
-                img = ImageOps.exif_transpose(img)
+                img = ImageOps.exif_transpose(source)
             except Exception:
-                pass
+                img = source
 
-            # Convert to RGB if necessary (e.g. for PNG with transparency if saving as JPG, though we'll keep format)
-            if img.mode in ('RGBA', 'P'):
+            if img.mode not in ('RGB', 'L'):
                 img = img.convert('RGB')
-            
-            img.thumbnail(size)
-            img.save(thumb_path)
-            
-        return thumb_path
+            img.load()
+            timings['decode'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            img.save(temp_filepath, "JPEG", quality=85, optimize=True, progressive=True)
+            timings['full'] += time.perf_counter() - start
+
+            current = img
+            for box, prefix, width in steps:
+                target = fit_within(current.size, box)
+                if target != current.size:
+                    start = time.perf_counter()
+                    current = current.resize(target, Image.BICUBIC, reducing_gap=2.0)
+                    timings['resize'] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                if prefix is not None:
+                    thumb_path = os.path.join(dirname, prefix + new_name)
+                    written.append(thumb_path)
+                    current.save(thumb_path, "JPEG", quality=85)
+                    thumbnails[prefix] = thumb_path
+                    timings['encode'] += time.perf_counter() - start
+                    continue
+
+                # Small originals fit several boxes at the same size; keep one
+                if variants and variants[-1]['width'] == current.size[0]:
+                    continue
+                variant = {'width': current.size[0], 'height': current.size[1]}
+                for fmt, (_, options) in VARIANT_FORMATS.items():
+                    variant[fmt] = variant_filename(new_filepath, width, fmt)
+                    written.append(variant[fmt])
+                    current.save(variant[fmt], fmt.upper(), **options)
+                variants.append(variant)
+                timings['encode'] += time.perf_counter() - start
     except Exception as e:
-        print(f"Error creating thumbnail: {e}")
-        return None
+        # Runs in worker processes without an app context
+        logger.error(f"Error processing image {filepath}: {e}")
+        for path in written:
+            if os.path.exists(path):
+                os.remove(path)
+        return filepath, {}, []
+
+    # Replace original with new file
+    if filepath != new_filepath and os.path.exists(filepath):
+        os.remove(filepath)
+    os.replace(temp_filepath, new_filepath)
+    return new_filepath, thumbnails, variants
+
+def thumbnail_path(filename):
+    """Derive thumbnail path (thumb_{name} in the same folder) for an image filename"""
+    parts = filename.split('/')
+    parts[-1] = 'thumb_' + parts[-1]
+    return '/'.join(parts)
+
+def image_variant_files(variants):
+    """All variant file paths listed in an image's variants"""
+    return [variant[fmt] for variant in variants or [] for fmt in VARIANT_FORMATS if fmt in variant]
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
@@ -116,6 +165,11 @@ def get_user_team_id():
     """Get current user's team_id"""
     return session.get('team_id')
 
+def get_user_upload_folder():
+    """Name of the current user's folder under UPLOAD_FOLDER"""
+    folder = secure_filename(session.get('username', 'shared'))
+    return folder or 'user_' + str(session.get('user_id', 'unknown'))
+
 def get_current_project_id():
     """Get current project id from session, fallback to default project '种植'."""
     project_id = session.get('current_project_id')
@@ -123,18 +177,8 @@ def get_current_project_id():
         return project_id
 
     # Lazy import avoids circular imports between utils and database modules.
-    from database import get_db
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM projects WHERE name = ?', ('种植',))
-    project = cursor.fetchone()
-    if project:
-        session['current_project_id'] = project['id']
-        return project['id']
-
-    cursor.execute('SELECT id FROM projects ORDER BY id ASC LIMIT 1')
-    project = cursor.fetchone()
-    if project:
-        session['current_project_id'] = project['id']
-        return project['id']
-    return None
+    from database import get_db, cached_default_project_id
+    project_id = cached_default_project_id(get_db().cursor())
+    if project_id:
+        session['current_project_id'] = project_id
+    return project_id
@@ -0,0 +1,17 @@
+"""
+Production entry point.
+
+The app is created once in the server's master process (prefork=True):
+init_db runs there before any worker is forked, and each worker then calls
+app.init_worker (gunicorn.conf.py does this in post_fork) to open its own
+connections and, in one worker, start the background tasks.
+
+Usage:
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Any other WSGI server works the same way as long as it loads wsgi:app and
+calls init_worker(app) in every worker process after forking.
+"""
+from app import create_app
+
+app = create_app(prefork=True)